@@ -0,0 +1,101 @@
+"""
+Benchmark of the concurrent update handling: latency of `/help` while long scans run.
+
+The bot runs in a separate process against a local fake Bot API and a fake VirusTotal API that
+takes `--scan-delay` seconds to answer. A few chats send documents to scan and, meanwhile, other
+chats send `/help` commands, which are timed from the moment they are made available until their
+reply arrives. It is measured with every `MAX_CONCURRENT_UPDATES` given, 1 being the sequential
+handling.
+
+```bash
+python tests/benchmarks/bench_concurrency.py --concurrency 1 16 --scans 4 --scan-delay 2
+```
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from fakes import FakeBotApi, FakeVirusTotal, document_update, help_update, serve, start_bot, stop_bot
+
+
+SCANNER_CHATS = 1000000
+
+
+async def measure(concurrency: int, scans: int, scan_delay: float, updates: int, rate: float):
+    """
+    Run the bot with a concurrency cap and feed it the scans and the `/help` commands.
+
+    Parameters:
+    -----------
+    - concurrency: int
+        The `MAX_CONCURRENT_UPDATES` of the bot.
+    - scans: int
+        The number of documents sent, each one from its own chat, before the `/help` commands.
+    - scan_delay: float
+        Seconds the fake VirusTotal API takes to answer.
+    - updates: int
+        The number of `/help` commands sent.
+    - rate: float
+        `/help` commands sent per second.
+
+    Returns:
+    --------
+    - result: dict
+        The latency percentiles of `/help`.
+    """
+    api = FakeBotApi()
+    api.expected_replies = set(range(1, updates + 1))
+    api_runner, api_port = await serve(api.app())
+    vt_runner, vt_port = await serve(FakeVirusTotal(scan_delay).app())
+    bot = start_bot(api_port, ["--mode", "polling"], vt_port=vt_port, env={"MAX_CONCURRENT_UPDATES": str(concurrency)})
+    try:
+        await asyncio.wait_for(api.ready.wait(), 30)
+        for scan in range(scans):
+            api.push(document_update(scan + 1, SCANNER_CHATS + scan, f"scan{scan}", size=1024))
+        pushed_at = {}
+        start = time.perf_counter()
+        for chat_id in range(1, updates + 1):
+            await asyncio.sleep(max(0.0, start + (chat_id - 1) / rate - time.perf_counter()))
+            pushed_at[chat_id] = time.perf_counter()
+            api.push(help_update(scans + chat_id, chat_id))
+        await asyncio.wait_for(api.replies.wait(), 60 + scans * scan_delay)
+    finally:
+        stop_bot(bot)
+        await api_runner.cleanup()
+        await vt_runner.cleanup()
+
+    latencies = sorted((api.sent_at[chat_id] - pushed_at[chat_id]) * 1000 for chat_id in pushed_at)
+    return {
+        "max_concurrent_updates": concurrency,
+        "scans": scans,
+        "scan_delay_s": scan_delay,
+        "help_updates": updates,
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1], 2),
+        "max_ms": round(latencies[-1], 2),
+    }
+
+
+def run(concurrency: list, scans: int, scan_delay: float, updates: int, rate: float):
+    """
+    Run the benchmark.
+
+    Returns:
+    --------
+    - results: list
+        One entry per concurrency cap.
+    """
+    return [asyncio.run(measure(cap, scans, scan_delay, updates, rate)) for cap in concurrency]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16], help="MAX_CONCURRENT_UPDATES values")
+    parser.add_argument("--scans", type=int, default=4)
+    parser.add_argument("--scan-delay", type=float, default=2, help="seconds VirusTotal takes to answer")
+    parser.add_argument("--updates", type=int, default=200, help="/help commands sent")
+    parser.add_argument("--rate", type=float, default=50, help="/help commands sent per second")
+    args = parser.parse_args()
+    print(json.dumps(run(args.concurrency, args.scans, args.scan_delay, args.updates, args.rate), indent=2))
@@ -0,0 +1,103 @@
+"""
+Benchmark of the file hashing: the previous whole-file `read()` implementation against the
+chunked `get_file_digests`.
+
+Each measurement runs in a fresh process so the peak RSS of one run does not leak into the next.
+
+```bash
+python tests/benchmarks/bench_hashing.py --sizes 1 16 128
+```
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from virus_total_telegram_bot.utils import get_file_digests
+
+
+def read_whole_file_sha256(file_path: str):
+    """The implementation of `get_file_sha256` before the chunked hashing"""
+    with open(file_path, 'rb') as f:
+        return {'sha256': hashlib.sha256(f.read()).hexdigest()}
+
+
+IMPLEMENTATIONS = {
+    "read_whole_file_sha256": read_whole_file_sha256,
+    "chunked_sha256": lambda file_path: get_file_digests(file_path, ('sha256',)),
+    "chunked_md5_sha1_sha256": get_file_digests,
+}
+
+
+def _peak_rss_kb():
+    # ru_maxrss survives the exec of the spawned process, so it would report the peak RSS of the
+    # parent process when this is larger. VmHWM belongs to the new address space instead.
+    try:
+        with open("/proc/self/status", encoding="ascii") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _measure(implementation: str, file_path: str, queue: multiprocessing.Queue):
+    baseline = _peak_rss_kb()
+    start = time.perf_counter()
+    IMPLEMENTATIONS[implementation](file_path)
+    elapsed = time.perf_counter() - start
+    queue.put({"elapsed": elapsed, "peak_rss_increase_kb": _peak_rss_kb() - baseline})
+
+
+def run(sizes: list, repeat: int):
+    """
+    Run the benchmark.
+
+    Parameters:
+    -----------
+    - sizes: list
+        The sizes of the hashed files, in megabytes.
+    - repeat: int
+        The number of runs per implementation and size. The fastest one is reported.
+
+    Returns:
+    --------
+    - results: list
+        One entry per implementation and size.
+    """
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for size in sizes:
+        with tempfile.NamedTemporaryFile() as f:
+            for _ in range(size):
+                f.write(os.urandom(1024 * 1024))
+            f.flush()
+            for implementation in IMPLEMENTATIONS:
+                runs = []
+                for _ in range(repeat):
+                    queue = context.Queue()
+                    process = context.Process(target=_measure, args=(implementation, f.name, queue))
+                    process.start()
+                    runs.append(queue.get())
+                    process.join()
+                best = min(runs, key=lambda r: r["elapsed"])
+                results.append({
+                    "implementation": implementation,
+                    "size_mb": size,
+                    "throughput_mb_s": round(size / best["elapsed"], 2),
+                    "peak_rss_increase_kb": max(r["peak_rss_increase_kb"] for r in runs),
+                })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 16, 128], help="file sizes, in megabytes")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    print(json.dumps(run(args.sizes, args.repeat), indent=2))
@@ -0,0 +1,193 @@
+"""
+Load test: throughput, latency percentiles and peak memory of the bot under thousands of updates.
+
+The bot runs its real application in a separate process against a local fake Bot API and a
+fake VirusTotal API, with no network. The fakes answer after `--bot-latency` and `--vt-latency`
+seconds, the Bot API refuses `--bot-flood-rate` of the messages with a flood control error,
+VirusTotal fails `--vt-error-rate` of the calls and its analyses take `--analysis-duration`
+seconds. The bot sends up to `--messages-per-second` messages per second. `--updates` updates, every one from its own chat, are made
+available at `--rate` updates per second (all at once with 0), mixing `/help` commands, URLs and
+documents as given by `--mix`. Every URL and document is new to VirusTotal, so it is scanned or
+uploaded and its analysis polled.
+
+An update is timed from the moment it is made available until the last message of its reply (the
+results of the analysis or an error) arrives. The updates and the documents are generated from
+`--seed`, so the runs can be repeated.
+
+```bash
+python tests/benchmarks/bench_load.py --updates 2000 --rate 200 --mix help=1 url=2 file=2 --analysis-duration 2
+```
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from fakes import (
+    FakeBotApi, FakeVirusTotal, document_update, help_update, peak_memory, serve, start_bot, stop_bot, url_update
+)
+from virus_total_telegram_bot.strings import ENGLISH, dialogs
+
+
+KINDS = ("help", "url", "file")
+# texts of the progress message before the results
+INTERIM = tuple(
+    dialogs[dialog][key][ENGLISH]
+    for dialog, key in (("text_received", "analyzing"), ("file_received", "downloading"), ("file_received", "analyzing"))
+)
+
+
+def percentile(values: list, fraction: float):
+    """The value below which `fraction` of the sorted `values` are"""
+    return values[max(0, round(len(values) * fraction) - 1)]
+
+
+def generate(updates: int, mix: dict, size: int, seed: int):
+    """
+    Generate the updates of a run.
+
+    Parameters:
+    -----------
+    - updates: int
+        The number of updates.
+    - mix: dict
+        The weight of every kind of update.
+    - size: int
+        The size of every document, in bytes.
+    - seed: int
+
+    Returns:
+    --------
+    - generated: tuple
+        The kind and the update of every chat, and the contents of the documents by file id.
+    """
+    generator = random.Random(seed)
+    kinds = generator.choices(list(mix), weights=list(mix.values()), k=updates)
+    chats, files = {}, {}
+    for chat_id, kind in enumerate(kinds, start=1):
+        if kind == "help":
+            update = help_update(chat_id)
+        elif kind == "url":
+            update = url_update(chat_id, chat_id, f"https://site{seed}-{chat_id}.example.com/page")
+        else:
+            files[f"doc{chat_id}"] = generator.getrandbits(size * 8).to_bytes(size, "little")
+            update = document_update(chat_id, chat_id, f"doc{chat_id}", size=size)
+        chats[chat_id] = (kind, update)
+    return chats, files
+
+
+def summarize(latencies: list):
+    """The count and the latency percentiles of some updates, in milliseconds"""
+    latencies = sorted(latencies)
+    if not latencies:
+        return {"updates": 0}
+    return {
+        "updates": len(latencies),
+        "p50_ms": round(percentile(latencies, 0.5), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+        "max_ms": round(latencies[-1], 2),
+    }
+
+
+async def measure(args: argparse.Namespace):
+    """
+    Run the bot against the fakes and feed it the updates.
+
+    Returns:
+    --------
+    - result: dict
+        The throughput, the latency percentiles, overall and by kind of update, and the peak memory.
+    """
+    chats, files = generate(args.updates, args.mix, args.size, args.seed)
+    api = FakeBotApi(latency=args.bot_latency, flood_rate=args.bot_flood_rate, seed=args.seed)
+    api.files.update(files)
+    api.interim = INTERIM
+    api.expected_finished = set(chats)
+    vt_api = FakeVirusTotal(
+        args.vt_latency, error_rate=args.vt_error_rate, analysis_duration=args.analysis_duration, seed=args.seed
+    )
+    api_runner, api_port = await serve(api.app())
+    vt_runner, vt_port = await serve(vt_api.app())
+    bot = start_bot(api_port, ["--mode", "polling", "--workers", str(args.workers)], vt_port=vt_port, env={
+        "FILES_MAX_SIZE": str(args.size // (1024 * 1024) + 1),
+        "MAX_CONCURRENT_UPDATES": str(args.concurrency),
+        "ANALYSIS_POLL_INTERVAL": "1",
+        "ANALYSIS_POLL_BATCH_SIZE": str(args.updates),
+        "TELEGRAM_MESSAGES_PER_SECOND": str(args.messages_per_second),
+    })
+    pushed_at = {}
+    try:
+        await asyncio.wait_for(api.ready.wait(), 30)
+        await asyncio.sleep(args.warmup)
+        start = time.perf_counter()
+        for index, (chat_id, (_, update)) in enumerate(chats.items()):
+            if args.rate:
+                await asyncio.sleep(max(0.0, start + index / args.rate - time.perf_counter()))
+            pushed_at[chat_id] = time.perf_counter()
+            api.push(update)
+        try:
+            await asyncio.wait_for(api.finished.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            pass
+        peak = peak_memory(bot.pid)
+    finally:
+        stop_bot(bot)
+        await api_runner.cleanup()
+        await vt_runner.cleanup()
+
+    finished = {chat_id: sent_at for chat_id, (sent_at, _, _) in api.finished_at.items() if chat_id in pushed_at}
+    latencies = {kind: [] for kind in KINDS}
+    for chat_id, sent_at in finished.items():
+        latencies[chats[chat_id][0]].append((sent_at - pushed_at[chat_id]) * 1000)
+    elapsed = max(finished.values(), default=start) - start
+    errors = sum(
+        1 for chat_id, (_, _, parse_mode) in api.finished_at.items() if chats[chat_id][0] != "help" and not parse_mode
+    )
+    return {
+        "updates": len(pushed_at),
+        "finished": len(finished),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_updates_s": round(len(finished) / elapsed, 2) if elapsed else None,
+        "latency": summarize([latency for values in latencies.values() for latency in values]),
+        "latency_by_kind": {kind: summarize(values) for kind, values in latencies.items() if kind in args.mix},
+        "peak_memory_mb": round(peak / (1024 * 1024), 1) if peak is not None else None,
+        "bot_floods": api.floods,
+        "vt_calls": vt_api.calls,
+        "vt_errors": vt_api.errors,
+    }
+
+
+def parse_mix(values: list):
+    """Parse the `kind=weight` pairs of `--mix`"""
+    mix = {}
+    for value in values:
+        kind, _, weight = value.partition("=")
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f"unknown kind of update {kind}, expected one of {', '.join(KINDS)}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--updates", type=int, default=2000, help="updates sent, each one from its own chat")
+    parser.add_argument("--rate", type=float, default=200, help="updates sent per second, 0 to send them at once")
+    parser.add_argument("--mix", nargs="+", default=["help=1", "url=2", "file=2"], help="kind=weight of the updates")
+    parser.add_argument("--size", type=int, default=64 * 1024, help="bytes per document")
+    parser.add_argument("--bot-latency", type=float, default=0.01, help="seconds the Bot API takes to answer")
+    parser.add_argument("--bot-flood-rate", type=float, default=0, help="fraction of the messages refused by the Bot API")
+    parser.add_argument("--messages-per-second", type=int, default=30, help="TELEGRAM_MESSAGES_PER_SECOND of the bot")
+    parser.add_argument("--vt-latency", type=float, default=0.05, help="seconds VirusTotal takes to answer")
+    parser.add_argument("--vt-error-rate", type=float, default=0, help="fraction of the VirusTotal calls failing")
+    parser.add_argument("--analysis-duration", type=float, default=2, help="seconds a VirusTotal analysis takes")
+    parser.add_argument("--concurrency", type=int, default=16, help="MAX_CONCURRENT_UPDATES of the bot")
+    parser.add_argument("--workers", type=int, default=0, help="worker processes of the bot")
+    parser.add_argument("--warmup", type=float, default=1, help="seconds waited before sending the updates")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds waited for the replies")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    args.mix = parse_mix(args.mix)
+    print(json.dumps(asyncio.run(measure(args)), indent=2))
@@ -0,0 +1,122 @@
+"""
+Benchmark of the update delivery: long polling against the webhook mode.
+
+The bot runs in a separate process against a local fake Bot API server, which feeds both modes
+the same synthetic load of `/help` commands, one chat per update, and times every update from
+the moment it is made available until the reply for its chat arrives.
+
+```bash
+python tests/benchmarks/bench_webhook.py --updates 500 --rate 100
+```
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import aiohttp
+
+from fakes import SECRET_TOKEN, FakeBotApi, free_port, help_update, serve, start_bot, stop_bot
+
+
+async def push_webhook(session: aiohttp.ClientSession, webhook_url: str, update: dict):
+    """Deliver an update to the webhook of the bot, like Telegram would"""
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET_TOKEN}
+    for _ in range(50):
+        try:
+            async with session.post(webhook_url, json=update, headers=headers) as response:
+                response.raise_for_status()
+                return
+        except aiohttp.ClientConnectionError:
+            # the bot registers the webhook before its server accepts connections
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"webhook at {webhook_url} is not reachable")
+
+
+async def measure(mode: str, updates: int, rate: float):
+    """
+    Run the bot in a mode and feed it the synthetic load.
+
+    Parameters:
+    -----------
+    - mode: str
+        `polling` or `webhook`.
+    - updates: int
+        The number of updates sent.
+    - rate: float
+        Updates sent per second.
+
+    Returns:
+    --------
+    - result: dict
+        The latency percentiles and the throughput of the mode.
+    """
+    api = FakeBotApi()
+    api.expected_replies = set(range(1, updates + 1))
+    runner, api_port = await serve(api.app())
+    webhook_port = free_port()
+    webhook_url = f"http://127.0.0.1:{webhook_port}/webhook"
+    bot = start_bot(api_port, [
+        "--mode", mode, "--listen", "127.0.0.1", "--port", str(webhook_port), "--path", "webhook",
+        "--webhook-url", webhook_url, "--secret-token", SECRET_TOKEN,
+    ])
+    try:
+        await asyncio.wait_for(api.ready.wait(), 30)
+        pushed_at = {}
+        interval = 1 / rate
+        async with aiohttp.ClientSession() as session:
+            start = time.perf_counter()
+            deliveries = []
+            for update_id in range(1, updates + 1):
+                await asyncio.sleep(max(0.0, start + (update_id - 1) * interval - time.perf_counter()))
+                update = help_update(update_id)
+                pushed_at[update_id] = time.perf_counter()
+                if mode == "webhook":
+                    deliveries.append(asyncio.create_task(push_webhook(session, webhook_url, update)))
+                else:
+                    api.push(update)
+            await asyncio.gather(*deliveries)
+            await asyncio.wait_for(api.replies.wait(), 60)
+    finally:
+        stop_bot(bot)
+        await runner.cleanup()
+
+    latencies = sorted((api.sent_at[chat_id] - pushed_at[chat_id]) * 1000 for chat_id in pushed_at)
+    elapsed = max(api.sent_at.values()) - min(pushed_at.values())
+    return {
+        "mode": mode,
+        "updates": updates,
+        "rate": rate,
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1], 2),
+        "max_ms": round(latencies[-1], 2),
+        "throughput_updates_s": round(updates / elapsed, 2),
+    }
+
+
+def run(updates: int, rate: float):
+    """
+    Run the benchmark.
+
+    Parameters:
+    -----------
+    - updates: int
+        The number of updates sent to each mode.
+    - rate: float
+        Updates sent per second.
+
+    Returns:
+    --------
+    - results: list
+        One entry per mode.
+    """
+    return [asyncio.run(measure(mode, updates, rate)) for mode in ("polling", "webhook")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--updates", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=100, help="updates sent per second")
+    args = parser.parse_args()
+    print(json.dumps(run(args.updates, args.rate), indent=2))
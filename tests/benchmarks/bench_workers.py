@@ -0,0 +1,100 @@
+"""
+Benchmark of the multi-process worker mode: throughput of file analyses against the workers.
+
+The bot runs in a separate process against a local fake Bot API and a fake VirusTotal API. Every
+chat sends a document of `--size` bytes, which the bot downloads, hashes and looks up, and the
+time from the first document made available until the results of the last one arrive is
+measured with every `--workers` given, 0 being the single-process mode. The documents are sent
+`WARMUP` seconds after the bot starts polling, once the worker processes are up.
+
+```bash
+python tests/benchmarks/bench_workers.py --workers 0 1 2 4 --files 200 --size 8388608
+```
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from fakes import FakeBotApi, FakeVirusTotal, document_update, serve, start_bot, stop_bot
+
+
+WARMUP = 5
+
+
+async def measure(workers: int, files: int, size: int):
+    """
+    Run the bot with a number of workers and feed it the documents.
+
+    Parameters:
+    -----------
+    - workers: int
+        The `--workers` of the bot.
+    - files: int
+        The number of documents sent, each one from its own chat.
+    - size: int
+        The size of every document, in bytes.
+
+    Returns:
+    --------
+    - result: dict
+        The elapsed time and the throughput.
+    """
+    api = FakeBotApi()
+    api.expected_results = set(range(1, files + 1))
+    for chat_id in api.expected_results:
+        api.files[f"doc{chat_id}"] = os.urandom(size)
+    api_runner, api_port = await serve(api.app())
+    vt_runner, vt_port = await serve(FakeVirusTotal(0).app())
+    bot = start_bot(
+        api_port, ["--mode", "polling", "--workers", str(workers)], vt_port=vt_port,
+        env={
+            "FILES_MAX_SIZE": str(size // (1024 * 1024) + 1),
+            # every document is admitted at once, whatever worker leases it, so none is rejected and
+            # waited for forever: the download budget is split between the workers
+            "DOWNLOADS_MAX_SIZE": str(max(workers, 1) * files * (size // (1024 * 1024) + 1)),
+            "MAX_JOBS_PER_USER": str(files),
+        }
+    )
+    try:
+        await asyncio.wait_for(api.ready.wait(), 30)
+        await asyncio.sleep(WARMUP)
+        start = time.perf_counter()
+        for chat_id in api.expected_results:
+            api.push(document_update(chat_id, chat_id, f"doc{chat_id}", size=size))
+        await asyncio.wait_for(api.results.wait(), 600)
+    finally:
+        stop_bot(bot)
+        await api_runner.cleanup()
+        await vt_runner.cleanup()
+
+    elapsed = max(api.results_at.values()) - start
+    return {
+        "workers": workers,
+        "files": files,
+        "size_bytes": size,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_files_s": round(files / elapsed, 2),
+    }
+
+
+def run(workers: list, files: int, size: int):
+    """
+    Run the benchmark.
+
+    Returns:
+    --------
+    - results: list
+        One entry per number of workers.
+    """
+    return [asyncio.run(measure(count, files, size)) for count in workers]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4], help="worker processes")
+    parser.add_argument("--files", type=int, default=200, help="documents sent")
+    parser.add_argument("--size", type=int, default=8 * 1024 * 1024, help="bytes per document")
+    args = parser.parse_args()
+    print(json.dumps(run(args.workers, args.files, args.size), indent=2))
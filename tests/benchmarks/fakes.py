@@ -0,0 +1,360 @@
+"""
+Local fakes of the Telegram Bot API and of the VirusTotal API, and helpers to run the bot
+against them, for the benchmarks.
+"""
+import asyncio
+import base64
+import hashlib
+import os
+import random
+import signal
+import socket
+import subprocess  # nosec
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+
+
+TOKEN = "123456:bench"
+SECRET_TOKEN = "bench-secret"
+STATS = {"harmless": 60, "malicious": 0, "suspicious": 0, "undetected": 10, "type-unsupported": 0}
+
+
+def free_port():
+    """Get a free local port"""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def message_update(update_id: int, chat_id: int, **message):
+    """An update with a message sent from a private chat"""
+    user = {"id": chat_id, "is_bot": False, "first_name": "bench", "username": f"user{chat_id}"}
+    return {
+        "update_id": update_id,
+        "message": dict(
+            message_id=update_id, date=int(time.time()), chat={"id": chat_id, "type": "private"}, **{"from": user},
+            **message
+        ),
+    }
+
+
+def help_update(update_id: int, chat_id: int = None):
+    """A `/help` command, sent from its own chat unless `chat_id` is given"""
+    return message_update(
+        update_id, update_id if chat_id is None else chat_id,
+        text="/help", entities=[{"type": "bot_command", "offset": 0, "length": 5}]
+    )
+
+
+def url_update(update_id: int, chat_id: int, url: str):
+    """A message with a URL sent from a chat"""
+    return message_update(update_id, chat_id, text=url, entities=[{"type": "url", "offset": 0, "length": len(url)}])
+
+
+def document_update(update_id: int, chat_id: int, file_id: str, size: int):
+    """A document sent from a chat"""
+    document = {"file_id": file_id, "file_unique_id": file_id, "file_name": f"{file_id}.bin", "file_size": size}
+    return message_update(update_id, chat_id, document=document)
+
+
+async def serve(application: web.Application):
+    """
+    Serve an aiohttp application on a free local port.
+
+    Returns:
+    --------
+    - served: tuple
+        The runner, to clean it up, and the port.
+    """
+    runner = web.AppRunner(application)
+    await runner.setup()
+    port = free_port()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner, port
+
+
+class FakeBotApi():
+    """
+    The few Bot API methods the bot calls, answered locally after `latency` seconds. Messages are
+    refused with a flood control error asking to retry after a second with a probability of
+    `flood_rate`, drawn from a generator seeded with `seed`.
+
+    Updates are made available to `getUpdates` with `push`, and edited messages count as sent
+    again. The time the first message sent to every chat arrives is kept in `sent_at`, and the time the first Markdown message, the results
+    of an analysis, arrives is kept in `results_at`. The time the first message that does not
+    start with one of the `interim` texts arrives is kept in `finished_at`, with the message.
+    """
+
+    def __init__(self, latency: float = 0, flood_rate: float = 0, seed: int = 0):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.floods = 0
+        self._random = random.Random(seed)
+        self.updates = []
+        self.new_updates = asyncio.Event()
+        self.sent_at = {}
+        self.replies = asyncio.Event()
+        self.expected_replies = set()
+        self.results_at = {}
+        self.results = asyncio.Event()
+        self.expected_results = set()
+        self.interim = ()
+        self.finished_at = {}
+        self.finished = asyncio.Event()
+        self.expected_finished = set()
+        self.ready = asyncio.Event()
+        self.files = {}
+        self._message_id = 0
+
+    def app(self):
+        """The aiohttp application serving the methods"""
+        application = web.Application()
+        application.router.add_post(f"/bot{TOKEN}/{{method}}", self.handle)
+        application.router.add_get(f"/file/bot{TOKEN}/{{file_path}}", self.download)
+        return application
+
+    async def handle(self, request: web.Request):
+        """Dispatch a Bot API method"""
+        method = request.match_info["method"]
+        params = await self._params(request)
+        if method not in ("getUpdates", "setWebhook"):
+            await asyncio.sleep(self.latency)
+        if method in ("sendMessage", "editMessageText") and self.flood_rate and self._random.random() < self.flood_rate:
+            self.floods += 1
+            return web.json_response({
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            }, status=429)
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "getUpdates":
+            result = await self._get_updates(int(params.get("offset") or 0), float(params.get("timeout") or 0))
+        elif method == "setWebhook":
+            self.ready.set()
+            result = True
+        elif method == "sendMessage":
+            result = self._send_message(int(params["chat_id"]), params.get("text", ""), params.get("parse_mode"))
+        elif method == "editMessageText":
+            result = self._send_message(
+                int(params["chat_id"]), params.get("text", ""), params.get("parse_mode"), int(params["message_id"])
+            )
+        elif method == "getFile":
+            file_id = params["file_id"]
+            content = self.files.setdefault(file_id, f"file {file_id}".encode())
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": len(content), "file_path": file_id}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def download(self, request: web.Request):
+        """Download a file"""
+        await asyncio.sleep(self.latency)
+        return web.Response(body=self.files[request.match_info["file_path"]])
+
+    def push(self, update: dict):
+        """Make an update available to `getUpdates`"""
+        self.updates.append(update)
+        self.new_updates.set()
+
+    async def _params(self, request: web.Request):
+        if request.content_type == "application/json":
+            return await request.json()
+        return dict(await request.post())
+
+    async def _get_updates(self, offset: int, timeout: float):
+        self.ready.set()
+        self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        if not self.updates:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return [update for update in self.updates if update["update_id"] >= offset]
+
+    def _send_message(self, chat_id: int, text: str, parse_mode: str = None, message_id: int = None):
+        self.sent_at.setdefault(chat_id, time.perf_counter())
+        if self.expected_replies.issubset(self.sent_at):
+            self.replies.set()
+        if parse_mode:
+            self.results_at.setdefault(chat_id, time.perf_counter())
+            if self.expected_results.issubset(self.results_at):
+                self.results.set()
+        if chat_id not in self.finished_at and not text.startswith(self.interim):
+            self.finished_at[chat_id] = (time.perf_counter(), text, parse_mode)
+            if self.expected_finished.issubset(self.finished_at):
+                self.finished.set()
+        if message_id is None:
+            self._message_id += 1
+            message_id = self._message_id
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": text,
+        }
+
+
+class FakeVirusTotal():
+    """
+    The parts of the VirusTotal API the bot calls, answered locally after `delay` seconds.
+
+    Without `analysis_duration`, every file and URL already has a recent report. Otherwise they
+    are unknown until they are uploaded or scanned, and their analysis completes
+    `analysis_duration` seconds later. Every call fails with a transient error with a probability
+    of `error_rate`, drawn from a generator seeded with `seed` so runs can be repeated.
+    """
+
+    def __init__(self, delay: float, error_rate: float = 0, analysis_duration: float = None, seed: int = 0):
+        self.delay = delay
+        self.error_rate = error_rate
+        self.analysis_duration = analysis_duration
+        self.calls = {}
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._known = set()
+        self._analyses = {}
+
+    def app(self):
+        """The aiohttp application serving the API"""
+        application = web.Application(middlewares=[self.answer], client_max_size=1024 ** 3)
+        application.router.add_get("/api/v3/files/upload_url", self.upload_url)
+        application.router.add_post("/api/v3/upload", self.upload)
+        application.router.add_post("/api/v3/urls", self.scan_url)
+        application.router.add_get("/api/v3/analyses/{analysis_id}", self.analysis)
+        application.router.add_get("/api/v3/{collection}/{object_id}", self.report)
+        return application
+
+    @web.middleware
+    async def answer(self, request: web.Request, handler):
+        """Count the call, wait `delay` seconds and fail it with a probability of `error_rate`"""
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        self.calls[route] = self.calls.get(route, 0) + 1
+        await asyncio.sleep(self.delay)
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response({"error": {"code": "TransientError", "message": "fake error"}}, status=503)
+        return await handler(request)
+
+    async def report(self, request: web.Request):
+        """The report of a file or a URL"""
+        object_type = "file" if request.match_info["collection"] == "files" else "url"
+        object_id = request.match_info["object_id"]
+        if self.analysis_duration is not None and (object_type, object_id) not in self._known:
+            return web.json_response({"error": {"code": "NotFoundError", "message": "not found"}}, status=404)
+        attributes = {"last_analysis_stats": STATS, "last_analysis_date": int(time.time())}
+        return web.json_response({"data": {"type": object_type, "id": object_id, "attributes": attributes}})
+
+    async def upload_url(self, request: web.Request):
+        """The URL files are uploaded to"""
+        return web.json_response({"data": str(request.url.with_path("/api/v3/upload"))})
+
+    async def upload(self, request: web.Request):
+        """Upload a file and start its analysis"""
+        digest = hashlib.sha256()
+        reader = await request.multipart()
+        part = await reader.next()
+        while True:
+            chunk = await part.read_chunk()
+            if not chunk:
+                break
+            digest.update(chunk)
+        return self._start_analysis("file", digest.hexdigest())
+
+    async def scan_url(self, request: web.Request):
+        """Scan a URL and start its analysis"""
+        url = (await request.post())["url"]
+        return self._start_analysis("url", base64.urlsafe_b64encode(url.encode()).decode().strip("="))
+
+    async def analysis(self, request: web.Request):
+        """The analysis of an upload or a scan, completed `analysis_duration` seconds after it started"""
+        analysis_id = request.match_info["analysis_id"]
+        if analysis_id not in self._analyses:
+            return web.json_response({"error": {"code": "NotFoundError", "message": "not found"}}, status=404)
+        completes_at, known = self._analyses[analysis_id]
+        attributes = {"status": "queued", "stats": {}}
+        if time.monotonic() >= completes_at:
+            self._known.add(known)
+            attributes = {"status": "completed", "stats": STATS, "date": int(time.time())}
+        return web.json_response({"data": {"type": "analysis", "id": analysis_id, "attributes": attributes}})
+
+    def _start_analysis(self, object_type: str, object_id: str):
+        analysis_id = f"{object_type}-{object_id}-{len(self._analyses)}"
+        self._analyses[analysis_id] = (time.monotonic() + (self.analysis_duration or 0), (object_type, object_id))
+        attributes = {"status": "queued", "stats": {}}
+        return web.json_response({"data": {"type": "analysis", "id": analysis_id, "attributes": attributes}})
+
+
+def peak_memory(pid: int):
+    """
+    Parameters:
+    -----------
+    - pid: int
+        The process, such as the bot started with `start_bot`.
+
+    Returns:
+    --------
+    - peak: int or None
+        The peak resident memory of the process and of its children, in bytes, or None where
+        `/proc` is not available.
+    """
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children", encoding="utf-8") as f:
+            children = [int(child) for child in f.read().split()]
+        peak = 0
+        for process in [pid] + children:
+            with open(f"/proc/{process}/status", encoding="utf-8") as f:
+                peak += next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmHWM:"))
+        return peak
+    except (OSError, StopIteration):
+        return None
+
+
+def start_bot(api_port: int, options: list, vt_port: int = None, env: dict = None):
+    """
+    Start the bot in a separate process against the fakes.
+
+    Parameters:
+    -----------
+    - api_port: int
+        The port of the fake Bot API.
+    - options: list
+        The command line options of the bot.
+    - vt_port: int
+        The port of the fake VirusTotal API, if any.
+    - env: dict
+        More environment variables of the bot.
+
+    Returns:
+    --------
+    - bot: subprocess.Popen object
+    """
+    paths = tempfile.mkdtemp()
+    bot_env = dict(
+        os.environ,
+        VIRUS_TOTAL_BOT_APIKEY=TOKEN,
+        VIRUS_TOTAL_APIKEY="bench",
+        BOT_API_URL=f"http://127.0.0.1:{api_port}/bot",
+        BOT_API_FILE_URL=f"http://127.0.0.1:{api_port}/file/bot",
+        VT_REQUESTS_PER_MINUTE="100000",
+        VT_REQUESTS_PER_DAY="100000",
+        LOGS_PATH=paths,
+        ARTIFACTS_PATH=paths,
+        **(env or {})
+    )
+    if vt_port is not None:
+        bot_env["VT_API_URL"] = f"http://127.0.0.1:{vt_port}"
+    command = [sys.executable, "-m", "virus_total_telegram_bot.cli", *options]
+    return subprocess.Popen(command, env=bot_env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)  # nosec
+
+
+def stop_bot(bot: subprocess.Popen):
+    """Stop the bot started with `start_bot`"""
+    bot.send_signal(signal.SIGINT)
+    try:
+        bot.wait(10)
+    except subprocess.TimeoutExpired:
+        bot.kill()
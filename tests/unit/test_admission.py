@@ -0,0 +1,52 @@
+"""Unit tests for the admission module."""
+import pytest
+
+from virus_total_telegram_bot.admission import AdmissionController
+from virus_total_telegram_bot.utils import Results
+
+
+MEGABYTE = 1024 * 1024
+
+
+@pytest.mark.unit
+def test_admit_caps_the_jobs_of_every_user():
+    background = {1: 1}
+    controller = AdmissionController(
+        max_jobs_per_user=2, max_inflight_size=10, unknown_size=5, background_jobs=lambda user_id: background.get(user_id, 0)
+    )
+    admission, rejection = controller.admit(1)
+    assert rejection is None
+    assert controller.admit(1) == (None, Results.TOO_MANY_JOBS)
+    other, rejection = controller.admit(2)
+    assert rejection is None
+    controller.release(admission)
+    background.clear()
+    assert controller.admit(1)[1] is None
+    controller.release(other)
+    assert controller.counters() == {"requests": 1, "inflight_size": 0}
+
+
+@pytest.mark.unit
+def test_admit_download_enforces_the_inflight_budget():
+    controller = AdmissionController(max_jobs_per_user=5, max_inflight_size=10, unknown_size=5)
+    first, _ = controller.admit(1)
+    second, _ = controller.admit(2)
+    third, _ = controller.admit(3)
+    assert controller.admit_download(first, 6 * MEGABYTE) is None
+    assert controller.admit_download(second, 5 * MEGABYTE) == Results.DOWNLOADS_BUSY
+    assert controller.admit_download(second, None) == Results.DOWNLOADS_BUSY
+    assert controller.admit_download(third, 4 * MEGABYTE) is None
+    assert controller.counters()["inflight_size"] == 10 * MEGABYTE
+    controller.release(first)
+    controller.release(third)
+    assert controller.admit_download(second, None) is None
+    assert controller.counters()["inflight_size"] == 5 * MEGABYTE
+
+
+@pytest.mark.unit
+def test_admit_download_admits_a_file_over_the_budget_when_nothing_else_downloads():
+    controller = AdmissionController(max_jobs_per_user=5, max_inflight_size=1, unknown_size=5)
+    admission, _ = controller.admit(1)
+    assert controller.admit_download(admission, 3 * MEGABYTE) is None
+    other, _ = controller.admit(2)
+    assert controller.admit_download(other, 1) == Results.DOWNLOADS_BUSY
@@ -0,0 +1,13 @@
+"""Unit tests for the app module."""
+import pytest
+
+from virus_total_telegram_bot.app import budget_share
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("budget, processes", [(4, 4), (4, 3), (500, 8), (30, 7), (1, 1)])
+def test_budget_shares_add_up_to_the_budget(budget, processes):
+    shares = [budget_share(budget, processes, index) for index in range(processes)]
+    assert sum(shares) == budget
+    assert max(shares) - min(shares) <= 1
+    assert min(shares) >= 1
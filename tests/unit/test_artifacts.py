@@ -0,0 +1,167 @@
+"""Unit tests for the artifacts module."""
+import asyncio
+import hashlib
+import os
+import sqlite3
+import time
+
+import pytest
+
+from virus_total_telegram_bot.artifacts import ArtifactCollector, ArtifactStore
+
+
+def download(store, content):
+    temp_path = store.temp_path()
+    with open(temp_path, "wb") as f:
+        f.write(content)
+    digests = {name: hashlib.new(name, content).hexdigest() for name in ('md5', 'sha1', 'sha256')}
+    return temp_path, digests
+
+
+@pytest.mark.unit
+def test_store_migrates_an_index_without_last_uses(tmp_path):
+    # the index as created before the collector
+    db = sqlite3.connect(str(tmp_path / "artifacts.sqlite3"))
+    db.execute(
+        "CREATE TABLE objects (sha256 TEXT PRIMARY KEY, md5 TEXT NOT NULL, sha1 TEXT NOT NULL, "
+        "size INTEGER NOT NULL, stored_at REAL NOT NULL)"
+    )
+    db.execute(
+        "CREATE TABLE refs (user_id INTEGER NOT NULL, sha256 TEXT NOT NULL, file_name TEXT NOT NULL, "
+        "file_unique_id TEXT, referenced_at REAL NOT NULL, PRIMARY KEY (user_id, sha256, file_name))"
+    )
+    db.execute("INSERT INTO objects VALUES ('abc', 'md5', 'sha1', 11, 1000.0)")
+    db.commit()
+    db.close()
+
+    store = ArtifactStore(str(tmp_path))
+    assert store._db.execute("SELECT used_at FROM objects").fetchall() == [(1000.0,)]  # pylint: disable=protected-access
+    assert store._db.execute("PRAGMA user_version").fetchone()[0] == 3  # pylint: disable=protected-access
+    store.close()
+    ArtifactStore(str(tmp_path)).close()
+
+
+@pytest.mark.unit
+def test_put_stores_files_by_sha256(tmp_path):
+    store = ArtifactStore(str(tmp_path))
+    temp_path, digests = download(store, b"hello world")
+    path = store.put(temp_path, digests)
+    sha256 = digests['sha256']
+    assert path == os.path.join(str(tmp_path), "objects", sha256[:2], sha256[2:4], sha256)
+    assert not os.path.exists(temp_path)
+    with open(path, "rb") as f:
+        assert f.read() == b"hello world"
+    store.close()
+
+
+@pytest.mark.unit
+def test_put_deduplicates_files(tmp_path):
+    store = ArtifactStore(str(tmp_path))
+    temp_path, digests = download(store, b"hello world")
+    path = store.put(temp_path, digests)
+    store.add_reference(1, digests['sha256'], "a.txt", "unique-a")
+    mtime = os.stat(path).st_mtime_ns
+
+    temp_path, digests = download(store, b"hello world")
+    assert store.put(temp_path, digests) == path
+    store.add_reference(2, digests['sha256'], "b.txt", "unique-b")
+    assert not os.path.exists(temp_path)
+    assert os.stat(path).st_mtime_ns == mtime
+    assert os.listdir(store.tmp_path) == []
+    assert store.references(1) == [(digests['sha256'], "a.txt")]
+    assert store.references(2) == [(digests['sha256'], "b.txt")]
+    store.close()
+
+
+@pytest.mark.unit
+def test_find_by_telegram_unique_id(tmp_path):
+    store = ArtifactStore(str(tmp_path))
+    temp_path, digests = download(store, b"hello world")
+    path = store.put(temp_path, digests)
+    store.add_reference(1, digests['sha256'], "a.txt", "unique-a")
+    assert store.find("unique-a") == digests
+    assert store.find("unique-b") is None
+    os.remove(path)
+    assert store.find("unique-a") is None
+    store.close()
+
+
+def store_file(store, content, used_at):
+    temp_path, digests = download(store, content)
+    store.put(temp_path, digests)
+    store._db.execute("UPDATE objects SET used_at = ? WHERE sha256 = ?", (used_at, digests['sha256']))
+    store._db.commit()
+    return store.object_path(digests['sha256'])
+
+
+@pytest.mark.unit
+def test_collector_removes_expired_files(tmp_path):
+    store = ArtifactStore(str(tmp_path))
+    now = time.time()
+    old = store_file(store, b"old", now - 3 * 3600)
+    recent = store_file(store, b"recent", now - 3600)
+    collector = ArtifactCollector(store, max_size=1, max_age=2, interval=60, batch_size=10)
+    asyncio.run(collector.collect())
+    assert not os.path.exists(old)
+    assert os.path.exists(recent)
+    assert collector.counters() == {"bytes_reclaimed": 3, "files_removed": 1, "footprint": 6}
+    store.close()
+
+
+@pytest.mark.unit
+def test_collector_enforces_the_budget_least_recently_used_first(tmp_path):
+    store = ArtifactStore(str(tmp_path))
+    now = time.time()
+    megabyte = 1024 * 1024
+    paths = [store_file(store, bytes([i]) * megabyte, now - 3600 * (10 - i)) for i in range(5)]
+    in_use = store_file(store, b"x" * megabyte, now)
+    collector = ArtifactCollector(store, max_size=3, max_age=24, interval=60, batch_size=2)
+    asyncio.run(collector.collect())
+    assert [os.path.exists(path) for path in paths] == [False, False, False, True, True]
+    assert os.path.exists(in_use)
+    assert collector.counters() == {"bytes_reclaimed": 3 * megabyte, "files_removed": 3, "footprint": 3 * megabyte}
+    store.close()
+
+
+@pytest.mark.unit
+def test_collector_removes_abandoned_downloads(tmp_path):
+    store = ArtifactStore(str(tmp_path))
+    abandoned, _ = download(store, b"partial")
+    os.utime(abandoned, (time.time() - 3600, time.time() - 3600))
+    downloading, _ = download(store, b"partial")
+    asyncio.run(ArtifactCollector(store, max_size=1, max_age=1, interval=60, batch_size=10).collect())
+    assert not os.path.exists(abandoned)
+    assert os.path.exists(downloading)
+    store.close()
+
+
+@pytest.mark.unit
+def test_collector_keeps_pinned_files(tmp_path):
+    store = ArtifactStore(str(tmp_path))
+    now = time.time()
+    temp_path, digests = download(store, b"uploading")
+    pinned = store.put(temp_path, digests, holder="request")
+    store._db.execute("UPDATE objects SET used_at = ?", (now - 3 * 3600,))
+    store._db.commit()
+    collector = ArtifactCollector(store, max_size=1, max_age=2, interval=60, batch_size=10)
+    asyncio.run(collector.collect())
+    assert os.path.exists(pinned)
+    store.unpin("request")
+    asyncio.run(collector.collect())
+    assert not os.path.exists(pinned)
+    store.close()
+
+
+@pytest.mark.unit
+def test_collector_moves_the_files_stored_per_user_into_the_store(tmp_path):
+    os.makedirs(tmp_path / "42")
+    (tmp_path / "42" / "a.txt").write_bytes(b"hello world")
+    os.makedirs(tmp_path / "43")
+    store = ArtifactStore(str(tmp_path))
+    asyncio.run(ArtifactCollector(store, max_size=1, max_age=1, interval=60, batch_size=10).collect())
+    sha256 = hashlib.sha256(b"hello world").hexdigest()
+    assert store.references(42) == [(sha256, "a.txt")]
+    assert os.path.exists(store.object_path(sha256))
+    assert os.listdir(tmp_path / "42") == []
+    assert not os.path.exists(tmp_path / "43")
+    store.close()
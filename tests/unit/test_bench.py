@@ -0,0 +1,36 @@
+"""Unit tests for the bench module."""
+import pytest
+import vt
+
+from virus_total_telegram_bot.bench import bench_file_sha256, compare, measure, recorded_analysis
+from virus_total_telegram_bot.utils import get_analysis_stats, parse_file_info
+
+
+@pytest.mark.unit
+def test_measure_reports_microseconds_per_call():
+    result = measure(lambda: None, repeat=2)
+    assert result["loops"] >= 1
+    assert 0 <= result["best_us"] <= result["median_us"]
+
+
+@pytest.mark.unit
+def test_bench_file_sha256_names_every_size():
+    results = bench_file_sha256((1024, 4096), repeat=1)
+    assert list(results) == ["get_file_sha256[1024]", "get_file_sha256[4096]"]
+    assert all(result["mb_s"] > 0 for result in results.values())
+
+
+@pytest.mark.unit
+def test_recorded_analysis_is_a_report_the_bot_can_parse():
+    report = vt.Object.from_dict(recorded_analysis("file"))
+    stats = get_analysis_stats(report)
+    assert stats["malicious"] + stats["undetected"] == len(report.last_analysis_results)
+    assert "**Malicious**: 4" in parse_file_info(stats)
+
+
+@pytest.mark.unit
+def test_compare_reports_the_regressions_over_the_tolerance():
+    baseline = {"benchmarks": {"fast": {"best_us": 10.0}, "slow": {"best_us": 10.0}, "gone": {"best_us": 1.0}}}
+    results = {"benchmarks": {"fast": {"best_us": 10.5}, "slow": {"best_us": 15.0}, "new": {"best_us": 3.0}}}
+    assert compare(results, baseline, tolerance=0.1) == {"slow": 1.5}
+    assert compare(results, baseline, tolerance=0.01) == {"fast": 1.05, "slow": 1.5}
@@ -0,0 +1,93 @@
+"""Unit tests for the cache module."""
+import sqlite3
+import time
+
+import pytest
+from unittest.mock import patch
+
+from virus_total_telegram_bot.cache import VerdictCache, is_positive_verdict
+
+
+CLEAN = {"harmless": 70, "malicious": 0, "suspicious": 0, "undetected": 10}
+FLAGGED = {"harmless": 60, "malicious": 8, "suspicious": 2, "undetected": 10}
+
+
+@pytest.fixture
+def verdict_cache(tmp_path):
+    cache = VerdictCache(str(tmp_path / "verdicts.sqlite3"), max_entries=2, positive_ttl=24, negative_ttl=1)
+    yield cache
+    cache.close()
+
+
+@pytest.mark.unit
+def test_is_positive_verdict():
+    assert is_positive_verdict(FLAGGED)
+    assert not is_positive_verdict(CLEAN)
+
+
+@pytest.mark.unit
+def test_verdict_cache_hit_and_miss(verdict_cache):
+    assert verdict_cache.get(VerdictCache.url_key("abc")) is None
+    verdict_cache.set(VerdictCache.url_key("abc"), CLEAN)
+    assert verdict_cache.get(VerdictCache.url_key("abc")) == CLEAN
+    assert verdict_cache.counters() == {"hits": 1, "misses": 1, "evictions": 0, "memory_entries": 1}
+
+
+@pytest.mark.unit
+def test_verdict_cache_evicts_least_recently_used(verdict_cache):
+    verdict_cache.set("file:a", CLEAN)
+    verdict_cache.set("file:b", CLEAN)
+    verdict_cache.get("file:a")
+    verdict_cache.set("file:c", CLEAN)
+    assert verdict_cache.counters()["evictions"] == 1
+    assert list(verdict_cache._memory) == ["file:a", "file:c"]  # pylint: disable=protected-access
+    # evicted entries are still served from disk
+    assert verdict_cache.get("file:b") == CLEAN
+
+
+@pytest.mark.unit
+def test_verdict_cache_ttl_depends_on_verdict(verdict_cache):
+    with patch("virus_total_telegram_bot.cache.time.time", return_value=0):
+        verdict_cache.set("file:clean", CLEAN)
+        verdict_cache.set("file:flagged", FLAGGED)
+    with patch("virus_total_telegram_bot.cache.time.time", return_value=2 * 3600):
+        assert verdict_cache.get("file:clean") is None
+        assert verdict_cache.get("file:flagged") == FLAGGED
+
+
+@pytest.mark.unit
+def test_verdict_cache_survives_restarts(tmp_path):
+    db_path = str(tmp_path / "verdicts.sqlite3")
+    cache = VerdictCache(db_path, max_entries=2, positive_ttl=24, negative_ttl=1)
+    cache.set("file:a", FLAGGED)
+    cache.close()
+    cache = VerdictCache(db_path, max_entries=2, positive_ttl=24, negative_ttl=1)
+    assert cache.get("file:a") == FLAGGED
+    cache.close()
+
+
+@pytest.mark.unit
+def test_caches_of_several_processes_share_the_database(tmp_path):
+    first = VerdictCache(str(tmp_path / "verdicts.sqlite3"), max_entries=2, positive_ttl=24, negative_ttl=1)
+    second = VerdictCache(str(tmp_path / "verdicts.sqlite3"), max_entries=2, positive_ttl=24, negative_ttl=1)
+    assert first._db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"  # pylint: disable=protected-access
+    first.set(VerdictCache.url_key("abc"), CLEAN)
+    assert second.get(VerdictCache.url_key("abc")) == CLEAN
+    first.close()
+    second.close()
+
+
+@pytest.mark.unit
+def test_verdict_cache_keeps_verdicts_in_memory_while_the_database_is_locked(tmp_path):
+    db_path = str(tmp_path / "verdicts.sqlite3")
+    cache = VerdictCache(db_path, max_entries=2, positive_ttl=24, negative_ttl=1)
+    other = sqlite3.connect(db_path)
+    other.execute("BEGIN EXCLUSIVE")
+    started = time.monotonic()
+    cache.set(VerdictCache.url_key("abc"), CLEAN)
+    assert cache.get(VerdictCache.url_key("abc")) == CLEAN
+    assert cache.get(VerdictCache.url_key("def")) is None
+    assert time.monotonic() - started < 1
+    other.rollback()
+    other.close()
+    cache.close()
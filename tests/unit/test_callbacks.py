@@ -0,0 +1,224 @@
+"""Unit tests for the callbacks module."""
+import asyncio
+import hashlib
+import itertools
+import os
+import time
+from datetime import datetime
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+import vt
+from telegram import Chat, Document, Message, MessageEntity, Update, User
+from telegram.ext import ExtBot
+
+from virus_total_telegram_bot.admission import AdmissionController
+from virus_total_telegram_bot.artifacts import ArtifactStore
+from virus_total_telegram_bot.cache import VerdictCache
+from virus_total_telegram_bot.callbacks import file, text
+from virus_total_telegram_bot.config import load_configuration
+from virus_total_telegram_bot.jobs import AnalysisScheduler
+from virus_total_telegram_bot.singleflight import SingleFlight
+from virus_total_telegram_bot.utils import Results
+
+
+STATS = {"harmless": 70, "malicious": 2, "suspicious": 0, "undetected": 10, "type-unsupported": 0}
+CONTENT = b"not a virus"
+SHA256 = hashlib.sha256(CONTENT).hexdigest()
+
+
+def report(collection, object_id):
+    return vt.Object(collection, object_id, {"last_analysis_stats": STATS, "last_analysis_date": int(time.time())})
+
+
+def not_found():
+    return vt.error.APIError("NotFoundError", "not found")
+
+
+def completed_analysis():
+    return vt.Object("analysis", "analysis-id", {"status": "completed", "stats": STATS})
+
+
+@pytest.fixture
+def cfg(tmp_path):
+    environment = {"VIRUS_TOTAL_BOT_APIKEY": "bot", "VIRUS_TOTAL_APIKEY": "key", "FILES_MAX_SIZE": "1"}
+    with patch.dict(os.environ, environment):
+        return load_configuration(str(tmp_path), str(tmp_path))
+
+
+@pytest.fixture
+def context(tmp_path):
+    message_ids = itertools.count(100)
+    bot = MagicMock(spec=ExtBot)
+    bot.send_message = AsyncMock(side_effect=lambda **kwargs: MagicMock(message_id=next(message_ids)))
+    bot.edit_message_text = AsyncMock()
+    downloaded = MagicMock()
+    downloaded.download_to_drive = AsyncMock(side_effect=lambda path: open(path, "wb").write(CONTENT))
+    bot.get_file = AsyncMock(return_value=downloaded)
+
+    client = MagicMock()
+    client.get_object_async = AsyncMock(side_effect=not_found())
+    client.scan_url_async = AsyncMock(return_value=completed_analysis())
+    client.scan_file_async = AsyncMock(return_value=completed_analysis())
+    scheduler = AnalysisScheduler(client, poll_interval=1, batch_size=4)
+
+    context = MagicMock()
+    context.bot = bot
+    context.application.create_task = lambda coroutine: asyncio.get_running_loop().create_task(coroutine)
+    context.bot_data = {
+        'verdict_cache': VerdictCache(str(tmp_path / "verdicts.sqlite3"), max_entries=10, positive_ttl=1, negative_ttl=1),
+        'vt_client': client,
+        'analysis_scheduler': scheduler,
+        'admission_controller': AdmissionController(
+            max_jobs_per_user=5, max_inflight_size=1, unknown_size=1, background_jobs=scheduler.user_jobs),
+        'single_flight': SingleFlight(),
+        'artifact_store': ArtifactStore(str(tmp_path)),
+    }
+    yield context
+    context.bot_data['verdict_cache'].close()
+    context.bot_data['artifact_store'].close()
+
+
+def message(user_id=1, **kwargs):
+    user = User(id=user_id, first_name="john", is_bot=False, username=f"user{user_id}")
+    return Update(user_id, message=Message(
+        message_id=1, date=datetime.now(), chat=Chat(id=user_id, type=Chat.PRIVATE), from_user=user, **kwargs))
+
+
+def document(size=len(CONTENT)):
+    return message(document=Document("file-id", "unique-id", file_name="file.bin", file_size=size))
+
+
+def served(logger):
+    """The records of the `request_served` events logged"""
+    return [call.kwargs for call in logger.info.call_args_list if call.args[0] == "request_served"]
+
+
+def serve(handler, *updates, context, cfg):
+    async def scenario():
+        await asyncio.gather(*(handler(update, context, cfg) for update in updates))
+
+    with patch("virus_total_telegram_bot.utils.logger") as logger:
+        asyncio.run(scenario())
+    return served(logger)
+
+
+@pytest.mark.unit
+def test_file_report_is_looked_up_before_uploading(context, cfg):
+    client = context.bot_data['vt_client']
+    client.get_object_async.side_effect = None
+    client.get_object_async.return_value = report("file", SHA256)
+    [record] = serve(file, document(), context=context, cfg=cfg)
+    client.get_object_async.assert_awaited_once_with('/files/{}', SHA256)
+    client.scan_file_async.assert_not_awaited()
+    assert record["result"] == Results.SUCCESS
+    assert record["file_hash"] == SHA256
+
+
+@pytest.mark.unit
+def test_unknown_file_is_uploaded_after_the_lookup(context, cfg):
+    client = context.bot_data['vt_client']
+    calls = []
+
+    async def lookup(*args):
+        calls.append("lookup")
+        raise not_found()
+
+    async def upload(f):
+        calls.append("upload")
+        return completed_analysis()
+
+    client.get_object_async.side_effect = lookup
+    client.scan_file_async.side_effect = upload
+    [record] = serve(file, document(), context=context, cfg=cfg)
+    assert calls == ["lookup", "upload"]
+    assert record["result"] == Results.SUCCESS
+    assert context.bot_data['verdict_cache'].get(VerdictCache.file_key(SHA256)) == STATS
+
+
+@pytest.mark.unit
+def test_cached_verdict_skips_virustotal(context, cfg):
+    url = "https://example.com/"
+    context.bot_data['verdict_cache'].set(VerdictCache.url_key(vt.url_id(url)), STATS)
+    [record] = serve(text, message(text=url), context=context, cfg=cfg)
+    context.bot_data['vt_client'].get_object_async.assert_not_awaited()
+    context.bot_data['vt_client'].scan_url_async.assert_not_awaited()
+    assert record["result"] == Results.SUCCESS
+    assert "stage_vt_report" not in record
+
+
+@pytest.mark.unit
+def test_concurrent_requests_for_a_url_share_the_leader_result(context, cfg):
+    async def slow_lookup(*args):
+        await asyncio.sleep(0.05)
+        raise not_found()
+
+    client = context.bot_data['vt_client']
+    client.get_object_async.side_effect = slow_lookup
+    records = serve(text, message(1, text="https://example.com"), message(2, text="https://example.com"),
+                    context=context, cfg=cfg)
+    client.get_object_async.assert_awaited_once()
+    client.scan_url_async.assert_awaited_once()
+    assert sorted(record["flight_role"] for record in records) == ["follower", "leader"]
+    assert [record["result"] for record in records] == [Results.SUCCESS, Results.SUCCESS]
+
+
+@pytest.mark.unit
+def test_several_urls_are_answered_with_one_table(context, cfg):
+    urls = "https://example.com https://example.org"
+    entities = [MessageEntity(MessageEntity.URL, 0, 19), MessageEntity(MessageEntity.URL, 20, 19)]
+    with patch("virus_total_telegram_bot.callbacks.logger") as logger:
+        [record] = serve(text, message(text=urls, entities=entities), context=context, cfg=cfg)
+    bot = context.bot
+    bot.send_message.assert_awaited_once()
+    table = bot.edit_message_text.await_args.kwargs["text"]
+    assert "example.com" in table and "example.org" in table
+    assert record["result"] == Results.SUCCESS
+    # the URLs are analyzed concurrently, so their stages are recorded apart from the request
+    assert {"stage_batch", "stage_send_message"} <= set(record)
+    assert "stage_vt_report" not in record
+    analyzed = [call.kwargs for call in logger.info.call_args_list if call.args[0] == "batch_url_analyzed"]
+    assert sorted(event["url"] for event in analyzed) == ["https://example.com/", "https://example.org/"]
+    assert all("stage_vt_report" in event and "stage_vt_scan" in event for event in analyzed)
+
+
+@pytest.mark.unit
+def test_too_big_file_is_rejected_before_the_download(context, cfg):
+    [record] = serve(file, document(size=2 * 1024 * 1024), context=context, cfg=cfg)
+    context.bot.get_file.assert_not_awaited()
+    assert record["result"] == Results.FILE_TOO_BIG
+
+
+@pytest.mark.unit
+def test_file_over_the_download_budget_is_rejected_while_others_download(context, cfg):
+    controller = context.bot_data['admission_controller']
+    downloading, _ = controller.admit(2)
+    assert controller.admit_download(downloading, len(CONTENT)) is None
+    [record] = serve(file, document(size=1024 * 1024), context=context, cfg=cfg)
+    context.bot.get_file.assert_not_awaited()
+    assert record["result"] == Results.DOWNLOADS_BUSY
+
+
+@pytest.mark.unit
+def test_file_request_records_its_stages(context, cfg):
+    [record] = serve(file, document(), context=context, cfg=cfg)
+    for name in ("download", "hashing", "store", "cache", "vt_report", "vt_upload", "send_message"):
+        assert record[f"stage_{name}"] >= 0
+    assert sum(value for key, value in record.items() if key.startswith("stage_")) <= record["elapsed"] + 1
+
+
+@pytest.mark.unit
+def test_file_request_edits_a_single_progress_message(context, cfg):
+    serve(file, document(), context=context, cfg=cfg)
+    bot = context.bot
+    bot.send_message.assert_awaited_once()
+    edits = bot.edit_message_text.await_args_list
+    assert [edit.kwargs["message_id"] for edit in edits] == [100, 100]
+    assert "file.bin" in edits[-1].kwargs["text"]
+
+
+@pytest.mark.unit
+def test_file_gone_before_the_upload_is_answered_with_an_error(context, cfg):
+    context.bot_data['vt_client'].scan_file_async.side_effect = FileNotFoundError("gone")
+    [record] = serve(file, document(), context=context, cfg=cfg)
+    assert record["result"] == Results.ERROR
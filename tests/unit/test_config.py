@@ -0,0 +1,105 @@
+"""Unit tests for the config module."""
+import json
+import logging
+import os
+import queue
+
+import pytest
+from pydantic import ValidationError  # pylint: disable=no-name-in-module
+from unittest.mock import MagicMock, patch
+
+from virus_total_telegram_bot.config import (
+    AsyncQueueHandler,
+    JsonLinesFormatter,
+    LazyPayload,
+    PayloadProcessor,
+    load_configuration
+)
+
+
+def environment(**variables):
+    return patch.dict(os.environ, {"VIRUS_TOTAL_BOT_APIKEY": "bot", "VIRUS_TOTAL_APIKEY": "key1, key2", **variables})
+
+
+@pytest.mark.unit
+def test_load_configuration_splits_the_apikeys(tmp_path):
+    with environment():
+        cfg = load_configuration(str(tmp_path), str(tmp_path))
+    assert cfg.virus_total_apikeys == ["key1", "key2"]
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("apikeys", ["", " , "])
+def test_load_configuration_requires_an_apikey(tmp_path, apikeys):
+    with environment(VIRUS_TOTAL_APIKEY=apikeys), pytest.raises(ValidationError, match="at least one key"):
+        load_configuration(str(tmp_path), str(tmp_path))
+
+
+@pytest.mark.unit
+def test_load_configuration_rejects_budgets_too_small_for_the_workers(tmp_path):
+    with environment(WORKERS="4"):
+        assert load_configuration(str(tmp_path), str(tmp_path)).workers == 4
+    with environment(WORKERS="8"), pytest.raises(ValidationError, match="vt_requests_per_minute"):
+        load_configuration(str(tmp_path), str(tmp_path))
+
+
+@pytest.mark.unit
+def test_load_configuration_rejects_unknown_modes(tmp_path):
+    with environment(BOT_MODE="webhook"):
+        assert load_configuration(str(tmp_path), str(tmp_path)).bot_mode == "webhook"
+    with environment(BOT_MODE="webhok"), pytest.raises(ValidationError, match="bot_mode"):
+        load_configuration(str(tmp_path), str(tmp_path))
+
+
+@pytest.mark.unit
+def test_async_queue_handler_drops_records_when_the_queue_is_full():
+    record_queue = queue.Queue(maxsize=1)
+    handler = AsyncQueueHandler(record_queue)
+    first = logging.LogRecord("test", logging.INFO, __file__, 1, {"event": "first"}, None, None)
+    second = logging.LogRecord("test", logging.INFO, __file__, 2, {"event": "second"}, None, None)
+    handler.handle(first)
+    handler.handle(second)
+    assert record_queue.get_nowait() is first
+    assert first.msg == {"event": "first"}
+    assert handler.dropped == 1
+
+
+@pytest.mark.unit
+def test_payload_processor_logs_payloads_lazily_and_truncated():
+    analysis = MagicMock()
+    analysis.id = "abc"
+    analysis.to_dict.return_value = {"id": "abc", "attributes": {"results": "x" * 100}}
+    processor = PayloadProcessor(fields=("analysis",), max_length=50, sample_rate=1)
+    event_dict = processor(None, None, {"event": "file_received_analysis", "analysis": analysis, "text": "y" * 60})
+    assert isinstance(event_dict["analysis"], LazyPayload)
+    analysis.to_dict.assert_not_called()
+    assert event_dict["analysis"].__structlog__().endswith("... (94 more characters)")
+    assert event_dict["text"] == "y" * 50 + "... (10 more characters)"
+
+    short = processor(None, None, {"analysis": {"id": "abc"}})
+    assert short["analysis"].__structlog__() == {"id": "abc"}
+
+
+@pytest.mark.unit
+def test_payload_processor_samples_payloads():
+    processor = PayloadProcessor(fields=("analysis",), max_length=50, sample_rate=0.25)
+    with patch("virus_total_telegram_bot.config.random.random", side_effect=[0.1, 0.5]):
+        sampled = processor(None, None, {"analysis": {"id": "abc"}})
+        left_out = processor(None, None, {"analysis": {"id": "abc"}})
+    assert isinstance(sampled["analysis"], LazyPayload)
+    assert left_out["analysis"] == {"id": "abc", "sampled": False}
+
+
+@pytest.mark.unit
+def test_payload_processor_archives_whole_payloads():
+    archive = MagicMock(spec=logging.Logger)
+    processor = PayloadProcessor(fields=("analysis",), max_length=5, sample_rate=1, archive=archive)
+    payload = {"id": "abc", "attributes": {"results": "x" * 100}}
+    event_dict = processor(None, None, {
+        "timestamp": "2023-01-17 10:00.00", "event": "text_received_analysis", "request_id": "r1", "analysis": payload
+    })
+    assert event_dict["analysis"] == {"id": "abc", "archived": True}
+    record = logging.LogRecord("archive", logging.INFO, __file__, 1, archive.info.call_args[0][0], None, None)
+    assert json.loads(JsonLinesFormatter().format(record)) == {
+        "timestamp": "2023-01-17 10:00.00", "event": "text_received_analysis", "request_id": "r1", "analysis": payload
+    }
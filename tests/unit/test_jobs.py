@@ -0,0 +1,180 @@
+"""Unit tests for the jobs module."""
+import asyncio
+
+import pytest
+import vt
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from virus_total_telegram_bot.jobs import AnalysisScheduler, AnalysisTimeout, Job, JobStatus
+
+
+def analysis(analysis_id, status):
+    return vt.Object("analysis", analysis_id, {"status": status, "stats": {}})
+
+
+def job(target="https://example.com"):
+    return Job(request_id="abcdef", user_id=1, chat_id=1, action="text", target=target)
+
+
+@pytest.mark.unit
+def test_scheduler_resolves_completed_analyses():
+    async def scenario():
+        client = MagicMock(spec=vt.Client)
+        client.get_object_async = AsyncMock(side_effect=[
+            analysis("a", "queued"), analysis("a", "in-progress"), analysis("a", "completed")
+        ])
+        scheduler = AnalysisScheduler(client, poll_interval=1, batch_size=10)
+        future = scheduler.submit(job(), analysis("a", "queued"))
+
+        await scheduler.poll()
+        assert scheduler.counters() == {JobStatus.QUEUED: 1, JobStatus.RUNNING: 0}
+        await scheduler.poll()
+        assert scheduler.counters() == {JobStatus.QUEUED: 0, JobStatus.RUNNING: 1}
+        await scheduler.poll()
+        assert future.done() and future.result().status == "completed"
+        assert scheduler.jobs() == []
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.unit
+def test_scheduler_shares_polls_of_the_same_analysis():
+    async def scenario():
+        client = MagicMock(spec=vt.Client)
+        client.get_object_async = AsyncMock(return_value=analysis("a", "completed"))
+        scheduler = AnalysisScheduler(client, poll_interval=1, batch_size=10)
+        futures = [scheduler.submit(job(), analysis("a", "queued")) for _ in range(3)]
+        await scheduler.poll()
+        assert client.get_object_async.await_count == 1
+        assert all(future.done() for future in futures)
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.unit
+def test_scheduler_polls_in_batches():
+    async def scenario():
+        client = MagicMock(spec=vt.Client)
+        client.get_object_async = AsyncMock(side_effect=lambda _, analysis_id: analysis(analysis_id, "queued"))
+        scheduler = AnalysisScheduler(client, poll_interval=1, batch_size=2)
+        for analysis_id in "abc":
+            scheduler.submit(job(), analysis(analysis_id, "queued"))
+        await scheduler.poll()
+        await scheduler.poll()
+        polled = [call.args[1] for call in client.get_object_async.await_args_list]
+        assert polled == ["a", "b", "c", "a"]
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.unit
+def test_scheduler_errors():
+    async def scenario():
+        client = MagicMock(spec=vt.Client)
+        client.get_object_async = AsyncMock(side_effect=[
+            vt.error.APIError("TransientError", "try again"), vt.error.APIError("NotFoundError", "gone")
+        ])
+        scheduler = AnalysisScheduler(client, poll_interval=1, batch_size=10)
+        future = scheduler.submit(job(), analysis("a", "queued"))
+        await scheduler.poll()
+        assert not future.done()
+        await scheduler.poll()
+        with pytest.raises(vt.error.APIError):
+            future.result()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.unit
+def test_scheduler_gives_up_analyses_failing_too_many_polls():
+    async def scenario():
+        client = MagicMock(spec=vt.Client)
+        client.get_object_async = AsyncMock(side_effect=vt.error.APIError("TransientError", "try again"))
+        scheduler = AnalysisScheduler(client, poll_interval=1, batch_size=10, max_failures=2)
+        future = scheduler.submit(job(), analysis("a", "queued"))
+        await scheduler.poll()
+        assert not future.done()
+        await scheduler.poll()
+        with pytest.raises(AnalysisTimeout):
+            future.result()
+        assert scheduler.user_jobs(1) == 0
+        await scheduler.poll()
+        assert client.get_object_async.await_count == 2
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.unit
+def test_scheduler_gives_up_analyses_pending_for_too_long():
+    async def scenario():
+        client = MagicMock(spec=vt.Client)
+        client.get_object_async = AsyncMock(return_value=analysis("a", "queued"))
+        scheduler = AnalysisScheduler(client, poll_interval=1, batch_size=10, max_age=60)
+        with patch("virus_total_telegram_bot.jobs.time.monotonic", return_value=1000):
+            future = scheduler.submit(job(), analysis("a", "queued"), key="url:abc")
+            await scheduler.poll()
+        assert not future.done()
+        with patch("virus_total_telegram_bot.jobs.time.monotonic", return_value=1061):
+            await scheduler.poll()
+        assert client.get_object_async.await_count == 1
+        with pytest.raises(AnalysisTimeout):
+            future.result()
+        assert scheduler.join("url:abc", job()) is None
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.unit
+def test_scheduler_stop_cancels_pending_jobs():
+    async def scenario():
+        scheduler = AnalysisScheduler(MagicMock(spec=vt.Client), poll_interval=60, batch_size=10)
+        await scheduler.start()
+        future = scheduler.submit(job(), analysis("a", "queued"))
+        await scheduler.stop()
+        assert future.cancelled()
+        assert scheduler.jobs() == []
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.unit
+def test_scheduler_joins_pending_analyses_by_key():
+    async def scenario():
+        client = MagicMock(spec=vt.Client)
+        client.get_object_async = AsyncMock(return_value=analysis("a", "completed"))
+        scheduler = AnalysisScheduler(client, poll_interval=1, batch_size=10)
+        assert scheduler.join("url:abc", job()) is None
+        leader = scheduler.submit(job(), analysis("a", "queued"), key="url:abc")
+        follower = scheduler.join("url:abc", job())
+        assert len(scheduler.jobs()) == 2
+        await scheduler.poll()
+        assert leader.result() is follower.result()
+        assert scheduler.join("url:abc", job()) is None
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.unit
+def test_scheduler_resumes_jobs_of_other_processes():
+    async def scenario():
+        client = MagicMock(spec=vt.Client)
+        client.get_object_async = AsyncMock(return_value=analysis("a", "completed"))
+        scheduler = AnalysisScheduler(client, poll_interval=1, batch_size=10, max_age=60)
+        submitted = job()
+        scheduler.submit(submitted, analysis("a", "queued"))
+        resumed = Job.from_dict(submitted.to_dict())
+        assert vars(resumed) == vars(submitted)
+
+        other = AnalysisScheduler(client, poll_interval=1, batch_size=10, max_age=60)
+        resumed.start_time -= 120 * 1000
+        future = other.resume(resumed, "url:abc")
+        await other.poll()
+        with pytest.raises(AnalysisTimeout):
+            future.result()
+        assert client.get_object_async.await_count == 0
+
+        future = other.resume(Job.from_dict(submitted.to_dict()), "url:abc")
+        await other.poll()
+        assert future.result().status == "completed"
+
+    asyncio.run(scenario())
@@ -0,0 +1,49 @@
+"""Unit tests for the metrics module."""
+import pytest
+
+from virus_total_telegram_bot.metrics import Counter, FunctionMetric, Histogram, Registry
+
+
+@pytest.mark.unit
+def test_counter_and_gauge_render_in_the_text_format():
+    registry = Registry()
+    calls = registry.register(Counter("calls_total", "Calls.", ("method",)))
+    calls.inc(method="get")
+    calls.inc(2, method="get")
+    calls.inc(method='say "hi"\n')
+    registry.register(FunctionMetric("depth", "Depth.", "gauge", lambda: 7))
+    registry.register(FunctionMetric("tasks", "Tasks.", "gauge", lambda: {"ready": 1, "failed": 0}, ("status",)))
+    assert registry.render() == (
+        "# HELP calls_total Calls.\n"
+        "# TYPE calls_total counter\n"
+        'calls_total{method="get"} 3\n'
+        'calls_total{method="say \\"hi\\"\\n"} 1\n'
+        "# HELP depth Depth.\n"
+        "# TYPE depth gauge\n"
+        "depth 7\n"
+        "# HELP tasks Tasks.\n"
+        "# TYPE tasks gauge\n"
+        'tasks{status="ready"} 1\n'
+        'tasks{status="failed"} 0\n'
+    )
+
+
+@pytest.mark.unit
+def test_histogram_counts_cumulative_buckets():
+    histogram = Histogram("duration_seconds", "Duration.", ("action",), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.7, 3):
+        histogram.observe(value, action="file")
+    samples = {(name, labels[-1] if name.endswith("_bucket") else None): value for name, _, labels, value in histogram.samples()}
+    assert samples[("duration_seconds_bucket", "0.1")] == 1
+    assert samples[("duration_seconds_bucket", "1")] == 3
+    assert samples[("duration_seconds_bucket", "+Inf")] == 4
+    assert samples[("duration_seconds_count", None)] == 4
+    assert samples[("duration_seconds_sum", None)] == pytest.approx(4.25)
+
+
+@pytest.mark.unit
+def test_failing_metrics_are_left_out():
+    registry = Registry()
+    registry.register(FunctionMetric("broken", "Broken.", "gauge", lambda: 1 / 0))
+    registry.register(FunctionMetric("fine", "Fine.", "gauge", lambda: 1))
+    assert registry.render() == "# HELP fine Fine.\n# TYPE fine gauge\nfine 1\n"
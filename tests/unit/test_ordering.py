@@ -0,0 +1,72 @@
+"""Unit tests for the ordering module."""
+import asyncio
+
+import pytest
+from unittest.mock import MagicMock
+
+from telegram import Update
+
+from virus_total_telegram_bot.ordering import UpdateSerializer
+
+
+def update(chat_id, user_id=None):
+    update = MagicMock(spec=Update)
+    update.effective_chat.id = chat_id
+    update.effective_user.id = chat_id if user_id is None else user_id
+    return update
+
+
+@pytest.mark.unit
+def test_serializer_keeps_the_order_of_each_chat():
+    async def scenario():
+        serializer = UpdateSerializer(max_concurrency=10)
+        handled = []
+
+        async def callback(update, context, name, delay):
+            await asyncio.sleep(delay)
+            handled.append(name)
+
+        handler = serializer.wrap(callback)
+        await asyncio.gather(
+            handler(update(1), None, "slow", 0.05),
+            handler(update(1), None, "fast", 0),
+            handler(update(2), None, "other chat", 0),
+        )
+        assert handled == ["other chat", "slow", "fast"]
+        assert serializer.counters() == {"running": 0, "keys": 0}
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.unit
+def test_serializer_keeps_the_order_of_each_user_across_chats():
+    async def scenario():
+        serializer = UpdateSerializer(max_concurrency=10)
+        handled = []
+
+        async def callback(update, context, name, delay):
+            await asyncio.sleep(delay)
+            handled.append(name)
+
+        handler = serializer.wrap(callback)
+        await asyncio.gather(handler(update(-1, user_id=1), None, "group", 0.05), handler(update(1), None, "private", 0))
+        assert handled == ["group", "private"]
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.unit
+def test_serializer_caps_the_updates_handled_at_once():
+    async def scenario():
+        serializer = UpdateSerializer(max_concurrency=2)
+        running = []
+
+        async def callback(update, context):
+            running.append(serializer.counters()["running"])
+            await asyncio.sleep(0.01)
+
+        handler = serializer.wrap(callback)
+        await asyncio.gather(*(handler(update(chat_id), None) for chat_id in range(6)))
+        assert max(running) == 2
+
+    asyncio.run(scenario())
@@ -0,0 +1,68 @@
+"""Unit tests for the progress module."""
+import asyncio
+
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+
+from telegram.error import BadRequest
+from telegram.ext import ExtBot
+
+from virus_total_telegram_bot.progress import ProgressMessage
+from virus_total_telegram_bot.ratelimit import MessagePriority
+
+
+def fake_bot(message_id=7):
+    bot = MagicMock(spec=ExtBot)
+    bot.send_message = AsyncMock(return_value=MagicMock(message_id=message_id))
+    bot.edit_message_text = AsyncMock()
+    return bot
+
+
+@pytest.mark.unit
+def test_progress_message_is_sent_once_and_then_edited():
+    bot = fake_bot()
+    progress = ProgressMessage(bot, chat_id=1)
+
+    async def scenario():
+        await progress.update("downloading")
+        await progress.update("analyzing")
+        await progress.update("analyzing")
+        await progress.update("*results*", parse_mode="Markdown", priority=MessagePriority.RESULTS)
+
+    asyncio.run(scenario())
+    bot.send_message.assert_awaited_once_with(
+        chat_id=1, text="downloading", parse_mode=None, rate_limit_args=MessagePriority.PROGRESS)
+    assert [call.kwargs for call in bot.edit_message_text.await_args_list] == [
+        {"chat_id": 1, "message_id": 7, "text": "analyzing", "parse_mode": None,
+         "rate_limit_args": MessagePriority.PROGRESS},
+        {"chat_id": 1, "message_id": 7, "text": "*results*", "parse_mode": "Markdown",
+         "rate_limit_args": MessagePriority.RESULTS},
+    ]
+
+
+@pytest.mark.unit
+def test_progress_message_of_a_job_is_edited_right_away():
+    bot = fake_bot()
+    asyncio.run(ProgressMessage(bot, chat_id=1, message_id=3).update("results"))
+    bot.send_message.assert_not_awaited()
+    bot.edit_message_text.assert_awaited_once_with(
+        chat_id=1, message_id=3, text="results", parse_mode=None, rate_limit_args=MessagePriority.PROGRESS)
+
+
+@pytest.mark.unit
+def test_progress_message_is_sent_again_when_it_cannot_be_edited():
+    bot = fake_bot(message_id=8)
+    bot.edit_message_text.side_effect = BadRequest("Message to edit not found")
+    progress = ProgressMessage(bot, chat_id=1, message_id=3)
+    asyncio.run(progress.update("results"))
+    bot.send_message.assert_awaited_once_with(
+        chat_id=1, text="results", parse_mode=None, rate_limit_args=MessagePriority.PROGRESS)
+    assert progress.message_id == 8
+
+
+@pytest.mark.unit
+def test_progress_message_not_modified_is_not_sent_again():
+    bot = fake_bot()
+    bot.edit_message_text.side_effect = BadRequest("Message is not modified")
+    asyncio.run(ProgressMessage(bot, chat_id=1, message_id=3).update("results"))
+    bot.send_message.assert_not_awaited()
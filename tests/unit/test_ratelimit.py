@@ -0,0 +1,145 @@
+"""Unit tests for the ratelimit module."""
+import asyncio
+
+import pytest
+from unittest.mock import patch
+
+from telegram.error import RetryAfter
+
+from virus_total_telegram_bot.ratelimit import (
+    MessagePriority, QuotaLimiter, TelegramRateLimiter, TokenBucket, quota_owner
+)
+
+
+@pytest.mark.unit
+def test_token_bucket():
+    with patch("virus_total_telegram_bot.ratelimit.time.monotonic", return_value=0):
+        bucket = TokenBucket(capacity=4, period=60)
+        for _ in range(4):
+            bucket.take()
+        assert bucket.wait_time() == 15
+    with patch("virus_total_telegram_bot.ratelimit.time.monotonic", return_value=30):
+        assert bucket.available() == 2
+    with patch("virus_total_telegram_bot.ratelimit.time.monotonic", return_value=600):
+        assert bucket.available() == 4
+
+
+@pytest.mark.unit
+def test_quota_limiter_serves_owners_round_robin():
+    async def scenario():
+        limiter = QuotaLimiter(per_minute=1, per_day=1000)
+        minute_bucket, _ = limiter.buckets
+        minute_bucket.rate = 200
+        served = []
+
+        async def call(owner, name):
+            quota_owner.set(owner)
+            await limiter.acquire()
+            served.append(name)
+
+        await limiter.acquire()
+        tasks = [asyncio.create_task(call("alice", f"alice-{i}")) for i in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(call("bob", "bob-0")))
+        await asyncio.sleep(0)
+        assert limiter.counters()["queue_depth"] == 4
+        await asyncio.gather(*tasks)
+        assert served == ["alice-0", "bob-0", "alice-1", "alice-2"]
+        assert limiter.queue_depth() == 0
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.unit
+def test_quota_limiter_respects_the_daily_budget():
+    async def scenario():
+        limiter = QuotaLimiter(per_minute=100, per_day=2)
+        await limiter.acquire()
+        await limiter.acquire()
+        assert limiter.counters()["remaining_per_day"] == 0
+        waiting = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        await limiter.close()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+
+    asyncio.run(scenario())
+
+
+def send(limiter, chat_id, sent, name, priority=None, callback=None):
+    """Send a message through the limiter, recording when it is sent"""
+    async def default_callback():
+        sent.append(name)
+        return name
+
+    return limiter.process_request(
+        callback or default_callback, (), {}, "sendMessage", {"chat_id": chat_id} if chat_id else {}, priority
+    )
+
+
+@pytest.mark.unit
+def test_telegram_rate_limiter_sends_results_before_progress():
+    async def scenario():
+        limiter = TelegramRateLimiter(per_second=1, per_chat_per_minute=60, max_retries=3)
+        limiter.bucket.rate = 200
+        sent = []
+        await send(limiter, 1, sent, "first")
+        tasks = [
+            asyncio.create_task(send(limiter, 2, sent, "progress", MessagePriority.PROGRESS)),
+            asyncio.create_task(send(limiter, 3, sent, "reply")),
+            asyncio.create_task(send(limiter, 4, sent, "results", MessagePriority.RESULTS)),
+        ]
+        await asyncio.sleep(0)
+        assert limiter.counters()["queue_depth"] == 3
+        await asyncio.gather(*tasks)
+        assert sent == ["first", "results", "reply", "progress"]
+        assert limiter.queue_depth() == 0
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.unit
+def test_telegram_rate_limiter_does_not_hold_other_chats_behind_a_busy_chat():
+    async def scenario():
+        limiter = TelegramRateLimiter(per_second=100, per_chat_per_minute=1, max_retries=3)
+        sent = []
+        await send(limiter, 1, sent, "first")
+        busy = asyncio.create_task(send(limiter, 1, sent, "second", MessagePriority.RESULTS))
+        await asyncio.sleep(0)
+        await send(limiter, 2, sent, "other chat")
+        # requests not sent to a chat are never held
+        await send(limiter, None, sent, "download")
+        assert sent == ["first", "other chat", "download"]
+        assert not busy.done()
+        await limiter.shutdown()
+        with pytest.raises(asyncio.CancelledError):
+            await busy
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.unit
+def test_telegram_rate_limiter_waits_for_retry_after():
+    async def scenario():
+        limiter = TelegramRateLimiter(per_second=100, per_chat_per_minute=100, max_retries=1)
+        attempts = []
+
+        async def flooded():
+            attempts.append(asyncio.get_running_loop().time())
+            if len(attempts) == 1:
+                raise RetryAfter(0.05)
+            return True
+
+        assert await send(limiter, 1, [], "message", callback=flooded) is True
+        assert attempts[1] - attempts[0] >= 0.04
+        assert limiter.counters()["retries"] == 1
+
+        async def always_flooded():
+            raise RetryAfter(0)
+
+        with pytest.raises(RetryAfter):
+            await send(limiter, 1, [], "message", callback=always_flooded)
+        assert limiter.counters()["retries"] == 3
+
+    asyncio.run(scenario())
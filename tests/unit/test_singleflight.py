@@ -0,0 +1,59 @@
+"""Unit tests for the singleflight module."""
+import asyncio
+
+import pytest
+
+from virus_total_telegram_bot.singleflight import FlightRole, SingleFlight
+
+
+@pytest.mark.unit
+def test_single_flight_coalesces_concurrent_calls():
+    async def scenario():
+        flights = SingleFlight()
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "result"
+
+        results = await asyncio.gather(*(flights.do("key", call) for _ in range(3)))
+        assert len(calls) == 1
+        assert results == [("result", FlightRole.LEADER), ("result", FlightRole.FOLLOWER), ("result", FlightRole.FOLLOWER)]
+        assert flights.in_flight() == 0
+        # once the flight lands, the next call runs again
+        assert await flights.do("key", call) == ("result", FlightRole.LEADER)
+        assert len(calls) == 2
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.unit
+def test_single_flight_shares_errors():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def call():
+            await asyncio.sleep(0.01)
+            raise ValueError("failed")
+
+        results = await asyncio.gather(flights.do("key", call), flights.do("key", call), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert flights.in_flight() == 0
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.unit
+def test_single_flight_keys_are_independent():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def call(value):
+            await asyncio.sleep(0.01)
+            return value
+
+        results = await asyncio.gather(flights.do("a", lambda: call("a")), flights.do("b", lambda: call("b")))
+        assert results == [("a", FlightRole.LEADER), ("b", FlightRole.LEADER)]
+
+    asyncio.run(scenario())
@@ -0,0 +1,140 @@
+"""Unit tests for the virustotal module."""
+import asyncio
+import io
+
+import pytest
+import vt
+from unittest.mock import AsyncMock, patch
+
+from virus_total_telegram_bot.ratelimit import QuotaLimiter
+from virus_total_telegram_bot.virustotal import VirusTotalClient, VirusTotalPool
+
+
+def pool(keys=2):
+    return VirusTotalPool(
+        [f"apikey{index}" for index in range(keys)], connections_limit=4, keepalive_timeout=30,
+        requests_per_minute=4, requests_per_day=500, ejection_time=60
+    )
+
+
+@pytest.mark.unit
+def test_virus_total_client_reuses_its_session():
+    async def scenario():
+        client = VirusTotalClient("apikey", connections_limit=4, keepalive_timeout=30, limiter=QuotaLimiter(4, 500))
+        session = client._get_session()  # pylint: disable=protected-access
+        assert client._get_session() is session  # pylint: disable=protected-access
+        assert session.connector.limit == 4
+        assert session.headers['X-Apikey'] == "apikey"
+        await client.close_async()
+        assert session.closed
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.unit
+def test_virus_total_client_session_matches_the_one_of_vt_py():
+    # VirusTotalClient overrides a private method of vt.Client, pinned to this version
+    assert vt.__version__ == "0.17.5"
+
+    async def scenario():
+        client = VirusTotalClient(
+            "apikey", connections_limit=4, keepalive_timeout=30, limiter=QuotaLimiter(4, 500),
+            agent="bot", timeout=60, headers={"X-Tool": "bot"}
+        )
+        upstream = vt.Client("apikey", agent="bot", timeout=60, headers={"X-Tool": "bot"})
+        session = client._get_session()  # pylint: disable=protected-access
+        upstream_session = upstream._get_session()  # pylint: disable=protected-access
+        assert dict(session.headers) == dict(upstream_session.headers)
+        assert session.timeout == upstream_session.timeout
+        assert session.trust_env == upstream_session.trust_env
+        assert session.connector._ssl == upstream_session.connector._ssl  # pylint: disable=protected-access
+        await client.close_async()
+        await upstream.close_async()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.unit
+def test_virus_total_client_calls_wait_for_the_limiter():
+    async def scenario():
+        limiter = QuotaLimiter(per_minute=4, per_day=500)
+        limiter.acquire = AsyncMock()
+        client = VirusTotalClient("apikey", connections_limit=4, keepalive_timeout=30, limiter=limiter)
+        with patch("vt.Client.get_async", AsyncMock()) as get_async:
+            await client.get_async("/files/{}", "abcdef")
+        get_async.assert_awaited_once()
+        limiter.acquire.assert_awaited_once()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.unit
+def test_virus_total_pool_spreads_calls_across_keys():
+    async def scenario():
+        vt_pool = pool()
+
+        def answer(client, name):
+            async def get_object_async(*args, **kwargs):  # pylint: disable=unused-argument
+                await client.limiter.acquire()
+                return name
+            return get_object_async
+
+        first, second = vt_pool.clients
+        first.get_object_async = answer(first, "first")
+        second.get_object_async = answer(second, "second")
+        assert await vt_pool.get_object_async("/files/{}", "abcdef") == "first"
+        # the first key has one request less left this minute now
+        assert await vt_pool.get_object_async("/files/{}", "abcdef") == "second"
+        assert await vt_pool.get_object_async("/files/{}", "abcdef") == "first"
+        assert vt_pool.counters()["remaining_per_minute"] == 5
+        await vt_pool.close_async()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.unit
+def test_virus_total_pool_ejects_keys_out_of_quota():
+    async def scenario():
+        vt_pool = pool()
+        first, second = vt_pool.clients
+        first.scan_file_async = AsyncMock(side_effect=vt.error.APIError("QuotaExceededError", "quota"))
+        second.scan_file_async = AsyncMock(side_effect=lambda f, wait_for_completion: f.read())
+        file = io.BytesIO(b"content")
+        file.read()
+        file.seek(0)
+        assert await vt_pool.scan_file_async(file) == b"content"
+        assert vt_pool.counters()["ejected_keys"] == 1
+        assert vt_pool.counters()["keys"] == 2
+        await vt_pool.close_async()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.unit
+def test_virus_total_pool_raises_when_every_key_fails():
+    async def scenario():
+        vt_pool = pool()
+        for client in vt_pool.clients:
+            client.scan_url_async = AsyncMock(side_effect=vt.error.APIError("WrongCredentialsError", "wrong key"))
+        with pytest.raises(vt.error.APIError):
+            await vt_pool.scan_url_async("https://example.com")
+        assert vt_pool.counters()["ejected_keys"] == 2
+        await vt_pool.close_async()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.unit
+def test_virus_total_pool_does_not_retry_other_errors():
+    async def scenario():
+        vt_pool = pool()
+        first, second = vt_pool.clients
+        first.scan_url_async = AsyncMock(side_effect=vt.error.APIError("InvalidArgumentError", "bad url"))
+        second.scan_url_async = AsyncMock()
+        with pytest.raises(vt.error.APIError):
+            await vt_pool.scan_url_async("not a url")
+        second.scan_url_async.assert_not_awaited()
+        assert vt_pool.counters()["ejected_keys"] == 0
+        await vt_pool.close_async()
+
+    asyncio.run(scenario())
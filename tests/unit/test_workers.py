@@ -0,0 +1,67 @@
+"""Unit tests for the workers module."""
+import asyncio
+
+import pytest
+from unittest.mock import AsyncMock, patch
+from telegram import Update, User
+from telegram.ext import ApplicationBuilder, ExtBot, TypeHandler
+
+from virus_total_telegram_bot.workers import JobJournal, Worker
+from virus_total_telegram_bot.workqueue import TaskStatus, WorkQueue
+
+
+@pytest.mark.unit
+def test_worker_retries_the_updates_whose_handler_raised(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.sqlite3"), visibility_timeout=60, max_attempts=2, retry_delay=0)
+    handled = []
+
+    async def handler(update, context):
+        handled.append(update.update_id)
+        if len(handled) == 1:
+            raise RuntimeError("boom")
+
+    async def scenario():
+        application = ApplicationBuilder().token("123:abc").updater(None).build()
+        application.add_handler(TypeHandler(Update, handler))
+        bot_user = User(id=123, first_name="bot", is_bot=True, username="bot")
+        with patch.object(ExtBot, "get_me", AsyncMock(return_value=bot_user)):
+            await application.initialize()
+        worker = Worker(application, queue, "worker", max_tasks=1, journal=JobJournal(queue, "worker"))
+        task_id = queue.put("chat:1", {"update_id": 7})
+
+        await worker.handle(*queue.lease("worker"))
+        assert queue.counters()[TaskStatus.READY] == 1
+        assert queue.lease("worker") == (task_id, {"update_id": 7}, 2)
+        await worker.handle(task_id, {"update_id": 7}, 2)
+        assert queue.counters() == {TaskStatus.READY: 0, TaskStatus.LEASED: 0, TaskStatus.FAILED: 0}
+        await application.shutdown()
+
+    asyncio.run(scenario())
+    assert handled == [7, 7]
+    queue.close()
+
+
+@pytest.mark.unit
+def test_results_of_a_stopped_worker_are_resumed_by_another(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.sqlite3"), visibility_timeout=60, max_attempts=2, retry_delay=0)
+    payload = {"job": {"request_id": "abcdef"}, "cache_key": "url:abc"}
+
+    async def scenario():
+        stopped = JobJournal(queue, "stopped")
+        task_id = await stopped.record("job:abcdef", payload)
+        assert await queue.run(queue.lease, "other") is None
+        await stopped.release_all()
+
+        application = ApplicationBuilder().token("123:abc").updater(None).build()
+        journal = JobJournal(queue, "other")
+        worker = Worker(application, queue, "other", max_tasks=1, journal=journal)
+        with patch("virus_total_telegram_bot.workers.resume_in_background", AsyncMock()) as resume:
+            await worker.handle(*queue.lease("other"))
+            assert journal.task_ids == {task_id}
+            await asyncio.sleep(0.01)
+        assert resume.await_args.args[1] == payload
+        assert journal.task_ids == set()
+        assert queue.counters() == {TaskStatus.READY: 0, TaskStatus.LEASED: 0, TaskStatus.FAILED: 0}
+
+    asyncio.run(scenario())
+    queue.close()
@@ -0,0 +1,89 @@
+"""Unit tests for the workqueue module."""
+import asyncio
+import sqlite3
+
+import pytest
+from unittest.mock import patch
+
+from virus_total_telegram_bot.workqueue import TaskStatus, WorkQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.sqlite3"), visibility_timeout=60, max_attempts=2, retry_delay=0)
+    yield queue
+    queue.close()
+
+
+@pytest.mark.unit
+def test_lease_and_complete(queue):
+    task_id = queue.put("chat:1", {"update_id": 1})
+    assert queue.lease("worker") == (task_id, {"update_id": 1}, 1)
+    assert queue.lease("worker") is None
+    assert queue.counters() == {TaskStatus.READY: 0, TaskStatus.LEASED: 1, TaskStatus.FAILED: 0}
+    queue.complete(task_id, "worker")
+    assert queue.counters() == {TaskStatus.READY: 0, TaskStatus.LEASED: 0, TaskStatus.FAILED: 0}
+
+
+@pytest.mark.unit
+def test_tasks_with_the_same_key_are_leased_in_order(queue):
+    first = queue.put("chat:1", {"update_id": 1})
+    second = queue.put("chat:1", {"update_id": 2})
+    other = queue.put("chat:2", {"update_id": 3})
+    assert queue.lease("a")[0] == first
+    assert queue.lease("b")[0] == other
+    assert queue.lease("b") is None
+    queue.complete(first, "a")
+    assert queue.lease("b")[0] == second
+
+
+@pytest.mark.unit
+def test_expired_leases_are_leased_again(queue, tmp_path):
+    task_id = queue.put("chat:1", {"update_id": 1})
+    with patch("virus_total_telegram_bot.workqueue.time.time", return_value=1000):
+        queue._db.execute("UPDATE tasks SET available_at = 0")
+        assert queue.lease("dead")[0] == task_id
+    with patch("virus_total_telegram_bot.workqueue.time.time", return_value=1030):
+        assert queue.extend(task_id, "dead")
+        assert queue.lease("alive") is None
+    with patch("virus_total_telegram_bot.workqueue.time.time", return_value=1100):
+        assert queue.lease("alive") == (task_id, {"update_id": 1}, 2)
+        assert not queue.extend(task_id, "dead")
+        queue.complete(task_id, "dead")
+        assert queue.counters()[TaskStatus.LEASED] == 1
+
+
+@pytest.mark.unit
+def test_failed_tasks_are_retried_up_to_max_attempts(queue):
+    task_id = queue.put("chat:1", {"update_id": 1})
+    queue.fail(queue.lease("worker")[0], "worker", "boom")
+    assert queue.lease("worker") == (task_id, {"update_id": 1}, 2)
+    queue.fail(task_id, "worker", "boom")
+    assert queue.lease("worker") is None
+    assert queue.counters()[TaskStatus.FAILED] == 1
+
+
+@pytest.mark.unit
+def test_tasks_put_leased_and_released(queue):
+    task_id = queue.put("job:abc", {"job": {}}, owner="worker")
+    assert queue.lease("other") is None
+    assert queue.extend(task_id, "worker")
+    queue.release(task_id, "worker")
+    assert queue.lease("other") == (task_id, {"job": {}}, 1)
+
+
+@pytest.mark.unit
+def test_run_waits_for_the_lock_of_the_database_off_the_event_loop(queue, tmp_path):
+    other = sqlite3.connect(str(tmp_path / "queue.sqlite3"))
+    other.execute("BEGIN IMMEDIATE")
+
+    async def scenario():
+        leasing = asyncio.create_task(queue.run(queue.lease, "worker"))
+        # the event loop keeps running while the lease waits for the lock
+        await asyncio.sleep(0.1)
+        assert not leasing.done()
+        other.rollback()
+        return await leasing
+
+    assert asyncio.run(scenario()) is None
+    other.close()
@@ -0,0 +1,121 @@
+"""
+Admission control of the requests, before any download or call to VirusTotal.
+"""
+import structlog
+
+from virus_total_telegram_bot.utils import Results
+
+
+logger = structlog.get_logger()
+
+
+class Admission():
+    """
+    The resources held by an admitted request, released with `AdmissionController.release`.
+    """
+
+    def __init__(self, user_id: int, size: int = 0):
+        self.user_id = user_id
+        self.size = size
+
+
+class AdmissionController():
+    """
+    Decides from the metadata of a request alone whether it is handled.
+
+    A user cannot have more than `max_jobs_per_user` requests being handled and analyses waiting
+    in the background at the same time, and the files being downloaded cannot add up to more
+    than `max_inflight_size` megabytes. A single file bigger than the budget is only admitted when
+    nothing else is being downloaded, so it is not rejected forever.
+    """
+
+    def __init__(self, max_jobs_per_user: int, max_inflight_size: int, unknown_size: int, background_jobs=None):
+        """
+        Parameters:
+        -----------
+        - max_jobs_per_user: int
+            The maximum number of requests and background analyses of a user at the same time.
+        - max_inflight_size: int
+            The maximum size of the files being downloaded at the same time, in megabytes.
+        - unknown_size: int
+            The size reserved for a file whose size is unknown, in megabytes.
+        - background_jobs: callable
+            Function getting the number of analyses a user is waiting for in the background.
+        """
+        self.max_jobs_per_user = max_jobs_per_user
+        self.max_inflight_size = max_inflight_size * 1024 * 1024
+        self.unknown_size = unknown_size * 1024 * 1024
+        self.background_jobs = background_jobs or (lambda user_id: 0)
+        self.inflight_size = 0
+        self._jobs = {}
+
+    def admit(self, user_id: int):
+        """
+        Admit a request of a user.
+
+        Parameters:
+        -----------
+        - user_id: int
+            The telegram id of the user.
+
+        Returns:
+        --------
+        - admitted: tuple
+            The `Admission` and None, or None and the `Results` value the request is rejected with.
+        """
+        jobs = self._jobs.get(user_id, 0)
+        if jobs + self.background_jobs(user_id) >= self.max_jobs_per_user:
+            logger.info("request_rejected", user_id=user_id, reason=Results.TOO_MANY_JOBS, jobs=jobs)
+            return None, Results.TOO_MANY_JOBS
+        self._jobs[user_id] = jobs + 1
+        return Admission(user_id), None
+
+    def admit_download(self, admission: Admission, size: int):
+        """
+        Reserve the download of a file for an admitted request.
+
+        Parameters:
+        -----------
+        - admission: Admission object
+        - size: int
+            The size of the file in bytes, as announced by Telegram, or None if it is unknown.
+
+        Returns:
+        --------
+        - rejection: str or None
+            The `Results` value the download is rejected with, or None if it is admitted.
+        """
+        if size is None:
+            size = self.unknown_size
+        if self.inflight_size and self.inflight_size + size > self.max_inflight_size:
+            logger.info(
+                "request_rejected", user_id=admission.user_id, reason=Results.DOWNLOADS_BUSY,
+                size=size, inflight_size=self.inflight_size
+            )
+            return Results.DOWNLOADS_BUSY
+        self.inflight_size += size
+        admission.size += size
+        return None
+
+    def release(self, admission: Admission):
+        """
+        Release the resources of a request once it is handled.
+
+        Parameters:
+        -----------
+        - admission: Admission object
+        """
+        self.inflight_size -= admission.size
+        admission.size = 0
+        jobs = self._jobs.pop(admission.user_id) - 1
+        if jobs:
+            self._jobs[admission.user_id] = jobs
+
+    def counters(self):
+        """
+        Returns:
+        --------
+        - counters: dict
+            The requests being handled and the bytes being downloaded.
+        """
+        return {"requests": sum(self._jobs.values()), "inflight_size": self.inflight_size}
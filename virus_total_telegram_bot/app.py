@@ -1,36 +1,266 @@
 """Entrypoint of the app"""
+import os
 from functools import partial
 
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters
+from telegram.ext import Application, ApplicationBuilder, CommandHandler, MessageHandler, filters
 
+from virus_total_telegram_bot.admission import AdmissionController
+from virus_total_telegram_bot.artifacts import ArtifactCollector, ArtifactStore
+from virus_total_telegram_bot.cache import VerdictCache
 from virus_total_telegram_bot.entities import Config
+from virus_total_telegram_bot.jobs import AnalysisScheduler
+from virus_total_telegram_bot.metrics import REGISTRY, MetricsServer, add_service_metrics
+from virus_total_telegram_bot.ordering import UpdateSerializer
+from virus_total_telegram_bot.ratelimit import TelegramRateLimiter
+from virus_total_telegram_bot.singleflight import SingleFlight
+from virus_total_telegram_bot.virustotal import VirusTotalPool
 from virus_total_telegram_bot.callbacks import (
     start,
     bot_help,
+    status,
     text,
     file
 )
 
 
-def run(cfg: Config):
+async def on_startup(application: Application):
+    """
+    Start the background tasks of the bot.
+
+    Parameters:
+    -----------
+    - application: telegram.ext.Application object
+    """
+    if 'analysis_scheduler' in application.bot_data:
+        await application.bot_data['analysis_scheduler'].start()
+    if 'artifact_collector' in application.bot_data:
+        await application.bot_data['artifact_collector'].start()
+    if 'metrics_server' in application.bot_data:
+        await application.bot_data['metrics_server'].start()
+
+
+async def on_shutdown(application: Application):
+    """
+    Stop the background tasks and release the resources shared by all the requests when the bot stops.
+
+    Parameters:
+    -----------
+    - application: telegram.ext.Application object
+    """
+    if 'analysis_scheduler' in application.bot_data:
+        await application.bot_data['analysis_scheduler'].stop()
+    if 'artifact_collector' in application.bot_data:
+        await application.bot_data['artifact_collector'].stop()
+    if 'metrics_server' in application.bot_data:
+        await application.bot_data['metrics_server'].stop()
+    if 'vt_client' in application.bot_data:
+        await application.bot_data['vt_client'].close_async()
+    if 'verdict_cache' in application.bot_data:
+        application.bot_data['verdict_cache'].close()
+    application.bot_data['artifact_store'].close()
+
+
+def budget_share(budget: int, processes: int, index: int):
     """
-    Entrypoint of the service.
+    Get the share of a budget of one of the processes sharing it. The shares add up to the budget,
+    the first processes taking one more unit each when it does not split evenly.
+
+    Parameters:
+    -----------
+    - budget: int
+    - processes: int
+        The number of processes sharing the budget, no more than the budget.
+    - index: int
+        The number of the process, from 0.
+
+    Returns:
+    --------
+    - share: int
+    """
+    return budget // processes + (1 if index < budget % processes else 0)
+
+
+def application_builder(cfg: Config, processes: int = 1, index: int = 0):
+    """
+    Get the builder of the application, configured to reach the Bot API within its flood limits.
 
     Parameters:
     -----------
     - cfg: virus_total_telegram_bot.entities.Config
         The Config instance for the service.
+    - processes: int
+        The number of processes sending messages, which share the global message budget.
+    - index: int
+        The number of the process, from 0.
+
+    Returns:
+    --------
+    - builder: telegram.ext.ApplicationBuilder object
     """
-    application = ApplicationBuilder().token(cfg.bot_apikey).build()
+    rate_limiter = TelegramRateLimiter(
+        per_second=budget_share(cfg.telegram_messages_per_second, processes, index),
+        per_chat_per_minute=cfg.telegram_chat_messages_per_minute,
+        max_retries=cfg.telegram_max_retries
+    )
+    return (
+        ApplicationBuilder()
+        .token(cfg.bot_apikey)
+        .base_url(cfg.bot_api_url)
+        .base_file_url(cfg.bot_api_file_url)
+        .rate_limiter(rate_limiter)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+
 
-    start_handler = CommandHandler('start', partial(start, files_max_size=cfg.files_max_size))
-    help_handler = CommandHandler('help', partial(bot_help, files_max_size=cfg.files_max_size))
-    text_handler = MessageHandler(filters.TEXT, partial(text, cfg=cfg))
-    file_handler = MessageHandler(filters.Document.ALL, partial(file, cfg=cfg))
+def add_services(application: Application, cfg: Config, processes: int = 1, index: int = 0):
+    """
+    Create the services shared by all the requests handled by the application.
+
+    Parameters:
+    -----------
+    - application: telegram.ext.Application object
+    - cfg: virus_total_telegram_bot.entities.Config
+        The Config instance for the service.
+    - processes: int
+        The number of processes calling VirusTotal and downloading files, which share the budget
+        of every API key and the download budget.
+    - index: int
+        The number of the process, from 0.
+    """
+    application.bot_data['verdict_cache'] = VerdictCache(
+        db_path=os.path.join(cfg.artifacts_path, "verdicts.sqlite3"),
+        max_entries=cfg.cache_max_entries,
+        positive_ttl=cfg.cache_positive_ttl,
+        negative_ttl=cfg.cache_negative_ttl
+    )
+    application.bot_data['vt_client'] = VirusTotalPool(
+        cfg.virus_total_apikeys,
+        connections_limit=cfg.vt_connections_limit,
+        keepalive_timeout=cfg.vt_keepalive_timeout,
+        requests_per_minute=budget_share(cfg.vt_requests_per_minute, processes, index),
+        requests_per_day=budget_share(cfg.vt_requests_per_day, processes, index),
+        ejection_time=cfg.vt_key_ejection_time,
+        host=cfg.vt_api_url
+    )
+    application.bot_data['analysis_scheduler'] = AnalysisScheduler(
+        application.bot_data['vt_client'],
+        poll_interval=cfg.analysis_poll_interval,
+        batch_size=cfg.analysis_poll_batch_size,
+        max_age=cfg.analysis_max_age,
+        max_failures=cfg.analysis_max_poll_failures
+    )
+    application.bot_data['admission_controller'] = AdmissionController(
+        max_jobs_per_user=cfg.max_jobs_per_user,
+        max_inflight_size=budget_share(cfg.downloads_max_size, processes, index),
+        unknown_size=cfg.files_max_size,
+        background_jobs=application.bot_data['analysis_scheduler'].user_jobs
+    )
+    application.bot_data['single_flight'] = SingleFlight()
+    application.bot_data['telegram_limiter'] = application.bot.rate_limiter
+    application.bot_data['artifact_store'] = ArtifactStore(cfg.artifacts_path)
+
+
+def add_artifact_collector(application: Application, cfg: Config):
+    """
+    Create the collector of the artifact store of the application.
+
+    Parameters:
+    -----------
+    - application: telegram.ext.Application object
+    - cfg: virus_total_telegram_bot.entities.Config
+        The Config instance for the service.
+    """
+    application.bot_data['artifact_collector'] = ArtifactCollector(
+        application.bot_data['artifact_store'],
+        max_size=cfg.artifacts_max_size,
+        max_age=cfg.artifacts_max_age,
+        interval=cfg.artifacts_gc_interval,
+        batch_size=cfg.artifacts_gc_batch_size
+    )
+
+
+def add_handlers(application: Application, cfg: Config):
+    """
+    Add the handlers of the commands, texts and files to the application.
+
+    Parameters:
+    -----------
+    - application: telegram.ext.Application object
+    - cfg: virus_total_telegram_bot.entities.Config
+        The Config instance for the service.
+    """
+    # updates are handed to their own task as they arrive, the serializer keeps the order of
+    # every chat and caps how many are handled at once
+    serializer = application.bot_data['update_serializer'] = UpdateSerializer(cfg.max_concurrent_updates)
+    start_handler = CommandHandler('start', serializer.wrap(partial(start, files_max_size=cfg.files_max_size)))
+    help_handler = CommandHandler('help', serializer.wrap(partial(bot_help, files_max_size=cfg.files_max_size)))
+    status_handler = CommandHandler('status', serializer.wrap(status))
+    text_handler = MessageHandler(filters.TEXT, serializer.wrap(partial(text, cfg=cfg)))
+    file_handler = MessageHandler(filters.Document.ALL, serializer.wrap(partial(file, cfg=cfg)))
 
     application.add_handler(start_handler)
     application.add_handler(help_handler)
+    application.add_handler(status_handler)
     application.add_handler(text_handler)
     application.add_handler(file_handler)
 
-    application.run_polling()
+
+def add_metrics(application: Application, cfg: Config, port: int = None):
+    """
+    Measure the services of the application and serve the metrics, if a metrics port is set.
+
+    Parameters:
+    -----------
+    - application: telegram.ext.Application object
+    - cfg: virus_total_telegram_bot.entities.Config
+        The Config instance for the service.
+    - port: int
+        The port to serve the metrics on, `cfg.metrics_port` by default.
+    """
+    if not cfg.metrics_port:
+        return
+    add_service_metrics(REGISTRY, application.bot_data)
+    application.bot_data['metrics_server'] = MetricsServer(
+        REGISTRY, listen=cfg.metrics_listen, port=port or cfg.metrics_port
+    )
+
+
+def serve(application: Application, cfg: Config):
+    """
+    Receive updates, with a webhook or with long polling, until the bot is stopped.
+
+    Parameters:
+    -----------
+    - application: telegram.ext.Application object
+    - cfg: virus_total_telegram_bot.entities.Config
+        The Config instance for the service.
+    """
+    if cfg.bot_mode == "webhook":
+        application.run_webhook(
+            listen=cfg.webhook_listen,
+            port=cfg.webhook_port,
+            url_path=cfg.webhook_path,
+            webhook_url=cfg.webhook_url,
+            secret_token=cfg.webhook_secret_token,
+            max_connections=cfg.webhook_max_connections
+        )
+    else:
+        application.run_polling()
+
+
+def run(cfg: Config):
+    """
+    Entrypoint of the service, receiving and handling the updates in this process.
+
+    Parameters:
+    -----------
+    - cfg: virus_total_telegram_bot.entities.Config
+        The Config instance for the service.
+    """
+    application = application_builder(cfg).concurrent_updates(True).build()
+    add_services(application, cfg)
+    add_artifact_collector(application, cfg)
+    add_handlers(application, cfg)
+    add_metrics(application, cfg)
+    serve(application, cfg)
@@ -0,0 +1,492 @@
+"""
+Content-addressed store of the files received by the bot.
+
+Every file is stored once, under its sha256, no matter how many users send it or how they name it.
+The users, names and Telegram ids of the files are kept as references in a SQLite index, and a
+collector running in the background keeps the store within its disk budget.
+"""
+import asyncio
+import functools
+import os
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import structlog
+
+from virus_total_telegram_bot.utils import get_file_digests
+
+
+logger = structlog.get_logger()
+
+# the schema of the index, one migration per version, recorded in `PRAGMA user_version`
+MIGRATIONS = (
+    (
+        "CREATE TABLE IF NOT EXISTS objects ("
+        "sha256 TEXT PRIMARY KEY, md5 TEXT NOT NULL, sha1 TEXT NOT NULL, size INTEGER NOT NULL, "
+        "stored_at REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS refs ("
+        "user_id INTEGER NOT NULL, sha256 TEXT NOT NULL, file_name TEXT NOT NULL, file_unique_id TEXT, "
+        "referenced_at REAL NOT NULL, PRIMARY KEY (user_id, sha256, file_name))",
+        "CREATE INDEX IF NOT EXISTS refs_file_unique_id ON refs (file_unique_id)",
+    ),
+    (
+        "ALTER TABLE objects ADD COLUMN used_at REAL NOT NULL DEFAULT 0",
+        "UPDATE objects SET used_at = stored_at",
+        "CREATE INDEX IF NOT EXISTS objects_used_at ON objects (used_at)",
+    ),
+    (
+        "CREATE TABLE IF NOT EXISTS pins ("
+        "sha256 TEXT NOT NULL, holder TEXT NOT NULL, pinned_at REAL NOT NULL, PRIMARY KEY (sha256, holder))",
+        "CREATE INDEX IF NOT EXISTS pins_holder ON pins (holder)",
+    ),
+)
+
+
+class ArtifactStore():
+    """
+    Stores files under `objects/<sha256[0:2]>/<sha256[2:4]>/<sha256>` in the artifacts path.
+
+    Files are downloaded to `tmp/` first and renamed into place, so an object is either complete
+    or missing. Storing a file that is already there only adds a reference to the index.
+
+    A request pins the files it finds or stores until it releases them with `unpin`, and pinned
+    files are never removed. Finding, storing and removing files take the write lock of the index
+    first, so a file is either pinned before it is chosen for removal or found missing.
+
+    A query may wait for another process to release the index, and storing a file moves it on
+    disk, so coroutines go through `run`, which calls the methods in a thread dedicated to the store.
+    """
+
+    def __init__(self, root: str):
+        """
+        Parameters:
+        -----------
+        - root: str
+            The artifacts path.
+        """
+        self.root = root
+        self.objects_path = os.path.join(root, "objects")
+        self.tmp_path = os.path.join(root, "tmp")
+        os.makedirs(self.objects_path, exist_ok=True)
+        os.makedirs(self.tmp_path, exist_ok=True)
+        # shared by the ingress and the worker processes, which wait for each other's writes
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="artifact-store")
+        self._db = sqlite3.connect(os.path.join(root, "artifacts.sqlite3"), timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._migrate()
+
+    @contextmanager
+    def _transaction(self):
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._db.rollback()
+            raise
+        self._db.commit()
+
+    def _migrate(self):
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(objects)")]
+        if version == 0 and "used_at" in columns:
+            # created with the used_at column before the index had versions
+            version = 2
+            self._db.execute(f"PRAGMA user_version = {version}")
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            for statement in migration:
+                self._db.execute(statement)
+            self._db.execute(f"PRAGMA user_version = {number}")
+            self._db.commit()
+            logger.info("artifact_index_migrated", version=number)
+
+    async def run(self, method, *args, **kwargs):
+        """
+        Call a method of the store from the thread of the store, without blocking the event loop.
+
+        Parameters:
+        -----------
+        - method: callable
+            The method of the store, such as `put`.
+        - args, kwargs
+            The arguments of the method.
+
+        Returns:
+        --------
+        - result
+            What the method returns.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(method, *args, **kwargs))
+
+    def object_path(self, sha256: str):
+        """
+        Parameters:
+        -----------
+        - sha256: str
+            The sha256 hash of the file.
+
+        Returns:
+        --------
+        - path: str
+            The path the file is stored at.
+        """
+        return os.path.join(self.objects_path, sha256[0:2], sha256[2:4], sha256)
+
+    def temp_path(self):
+        """
+        Returns:
+        --------
+        - path: str
+            A new path to download a file to, before its hash is known.
+        """
+        return os.path.join(self.tmp_path, uuid.uuid4().hex)
+
+    def find(self, file_unique_id: str, holder: str = None):
+        """
+        Find a file already stored, by its Telegram unique id, so it does not need to be downloaded again.
+
+        Parameters:
+        -----------
+        - file_unique_id: str
+            The unique id Telegram gives to the file.
+        - holder: str
+            The request the file is pinned for, if it is found.
+
+        Returns:
+        --------
+        - digests: dict or None
+            The md5, sha1 and sha256 of the file, or None if it is not stored.
+        """
+        with self._transaction():
+            row = self._db.execute(
+                "SELECT objects.md5, objects.sha1, objects.sha256 FROM refs JOIN objects USING (sha256) "
+                "WHERE refs.file_unique_id = ? LIMIT 1",
+                (file_unique_id,)
+            ).fetchone()
+            if row is None or not os.path.exists(self.object_path(row[2])):
+                return None
+            self._use(row[2], holder)
+        return {'md5': row[0], 'sha1': row[1], 'sha256': row[2]}
+
+    def put(self, temp_path: str, digests: dict, holder: str = None):
+        """
+        Move a downloaded file into the store, unless it is stored already.
+
+        Parameters:
+        -----------
+        - temp_path: str
+            The path the file was downloaded to, from `temp_path`.
+        - digests: dict
+            The md5, sha1 and sha256 of the file.
+        - holder: str
+            The request the file is pinned for.
+
+        Returns:
+        --------
+        - path: str
+            The path the file is stored at.
+        """
+        sha256 = digests['sha256']
+        path = self.object_path(sha256)
+        with self._transaction():
+            stored = self._db.execute("SELECT 1 FROM objects WHERE sha256 = ?", (sha256,)).fetchone()
+            if stored is not None and os.path.exists(path):
+                os.remove(temp_path)
+                self._use(sha256, holder)
+                logger.info("artifact_deduplicated", sha256=sha256)
+                return path
+            size = os.path.getsize(temp_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+            now = time.time()
+            self._db.execute(
+                "INSERT OR REPLACE INTO objects (sha256, md5, sha1, size, stored_at, used_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (sha256, digests['md5'], digests['sha1'], size, now, now)
+            )
+            self._use(sha256, holder)
+        logger.info("artifact_stored", sha256=sha256, size=size)
+        return path
+
+    def _use(self, sha256: str, holder: str):
+        now = time.time()
+        self._db.execute("UPDATE objects SET used_at = ? WHERE sha256 = ?", (now, sha256))
+        if holder is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO pins (sha256, holder, pinned_at) VALUES (?, ?, ?)", (sha256, holder, now))
+
+    def unpin(self, holder: str):
+        """
+        Release the files pinned for a request, once it no longer needs them.
+
+        Parameters:
+        -----------
+        - holder: str
+            The request the files were pinned for.
+        """
+        self._db.execute("DELETE FROM pins WHERE holder = ?", (holder,))
+        self._db.commit()
+
+    def add_reference(self, user_id: int, sha256: str, file_name: str, file_unique_id: str = None):
+        """
+        Record that a user sent a stored file.
+
+        Parameters:
+        -----------
+        - user_id: int
+            The telegram id of the user.
+        - sha256: str
+            The sha256 hash of the file.
+        - file_name: str
+            The name the user gave to the file.
+        - file_unique_id: str
+            The unique id Telegram gives to the file.
+        """
+        self._db.execute(
+            "INSERT OR REPLACE INTO refs (user_id, sha256, file_name, file_unique_id, referenced_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (user_id, sha256, file_name, file_unique_id, time.time())
+        )
+        self._db.commit()
+
+    def references(self, user_id: int):
+        """
+        Parameters:
+        -----------
+        - user_id: int
+            The telegram id of the user.
+
+        Returns:
+        --------
+        - references: list
+            Tuples of sha256 and file name of the files sent by the user, newest first.
+        """
+        return self._db.execute(
+            "SELECT sha256, file_name FROM refs WHERE user_id = ? ORDER BY referenced_at DESC",
+            (user_id,)
+        ).fetchall()
+
+    def footprint(self):
+        """
+        Returns:
+        --------
+        - footprint: int
+            The bytes taken by the stored files.
+        """
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+
+    def remove_unused(self, limit: int, used_before: float, max_size: int, pinned_since: float):
+        """
+        Remove files that are not pinned: the ones not used since `used_before` and, while the store
+        takes more than `max_size` bytes, the least recently used ones. They are forgotten by the
+        index and removed from the disk under the same lock.
+
+        Parameters:
+        -----------
+        - limit: int
+            The maximum number of files removed.
+        - used_before: float
+            The files not used since this timestamp are removed whatever the footprint.
+        - max_size: int
+            The maximum bytes taken by the stored files.
+        - pinned_since: float
+            Pins older than this timestamp were left by a process that stopped, and are ignored.
+
+        Returns:
+        --------
+        - candidates: int
+            The number of files chosen for removal, at most `limit`.
+        - sizes: list
+            The sizes of the files removed, without the ones already gone from the disk.
+        """
+        with self._transaction():
+            footprint = self.footprint()
+            candidates = self._db.execute(
+                "SELECT sha256, size, used_at FROM objects WHERE NOT EXISTS ("
+                "SELECT 1 FROM pins WHERE pins.sha256 = objects.sha256 AND pins.pinned_at >= ?) "
+                "ORDER BY used_at LIMIT ?",
+                (pinned_since, limit)
+            ).fetchall()
+            victims = {}
+            for sha256, size, used_at in candidates:
+                if used_at >= used_before and footprint <= max_size:
+                    break
+                victims[self.object_path(sha256)] = (sha256, size)
+                footprint -= size
+            self._db.executemany("DELETE FROM objects WHERE sha256 = ?", [(sha256,) for sha256, _ in victims.values()])
+            self._db.executemany("DELETE FROM refs WHERE sha256 = ?", [(sha256,) for sha256, _ in victims.values()])
+            self._db.executemany("DELETE FROM pins WHERE sha256 = ?", [(sha256,) for sha256, _ in victims.values()])
+            removed = remove_files(list(victims))
+        return len(victims), [victims[path][1] for path in removed]
+
+    def legacy_files(self, limit: int):
+        """
+        Find the files stored as `<user id>/<file name>` in the artifacts path, before the store,
+        and remove the directories left empty.
+
+        Parameters:
+        -----------
+        - limit: int
+            The maximum number of files returned.
+
+        Returns:
+        --------
+        - files: list
+            Tuples of user id and path of the files.
+        """
+        files = []
+        for directory in os.scandir(self.root):
+            if not directory.is_dir() or not directory.name.isdigit():
+                continue
+            entries = list(os.scandir(directory.path))
+            if not entries:
+                os.rmdir(directory.path)
+                continue
+            entries = [entry.path for entry in entries if entry.is_file()]
+            files.extend((int(directory.name), path) for path in entries[:limit - len(files)])
+            if len(files) >= limit:
+                break
+        return files
+
+    def close(self):
+        """Close the index, once the queries already running are done"""
+        self._executor.shutdown()
+        self._db.close()
+
+
+def remove_files(paths: list):
+    """
+    Remove files, skipping the ones already gone.
+
+    Parameters:
+    -----------
+    - paths: list
+        The paths of the files.
+
+    Returns:
+    --------
+    - removed: list
+        The paths of the files removed.
+    """
+    removed = []
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        removed.append(path)
+    return removed
+
+
+class ArtifactCollector():
+    """
+    Keeps an `ArtifactStore` within a byte budget and a maximum age.
+
+    Every round first moves the files stored per user before the store into it, a batch at a time.
+    It then removes the files not used for longer than the maximum age and, while the store is
+    over budget, the least recently used ones. Files are removed in batches from the thread of
+    the store, so the event loop is not blocked by the disk. Files pinned by a request are never
+    removed, unless the pin is older than `MAX_PIN_AGE` and was left by a process that stopped.
+    Downloads left behind in `tmp/` for `DOWNLOAD_GRACE` seconds are removed as well.
+    """
+
+    DOWNLOAD_GRACE = 300
+    MAX_PIN_AGE = 24 * 3600
+
+    def __init__(self, store: ArtifactStore, max_size: int, max_age: int, interval: int, batch_size: int):
+        """
+        Parameters:
+        -----------
+        - store: ArtifactStore object
+            The store to collect.
+        - max_size: int
+            The maximum bytes taken by the stored files, in megabytes.
+        - max_age: int
+            Hours a file is kept since it was last used.
+        - interval: int
+            Seconds between two collection rounds.
+        - batch_size: int
+            The maximum number of files removed at once.
+        """
+        self.store = store
+        self.max_size = max_size * 1024 * 1024
+        self.max_age = max_age * 3600
+        self.interval = interval
+        self.batch_size = batch_size
+        self.bytes_reclaimed = 0
+        self.files_removed = 0
+        self._task = None
+
+    def counters(self):
+        """
+        Returns:
+        --------
+        - counters: dict
+            The bytes reclaimed and files removed since the bot started, and the bytes taken by the store.
+        """
+        return {
+            "bytes_reclaimed": self.bytes_reclaimed,
+            "files_removed": self.files_removed,
+            "footprint": self.store.footprint(),
+        }
+
+    async def start(self):
+        """Start the collection loop"""
+        self._task = asyncio.create_task(self._collect_forever())
+
+    async def stop(self):
+        """Stop the collection loop"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def collect(self):
+        """
+        Remove the expired files and, while the store is over budget, the least recently used ones.
+        """
+        loop = asyncio.get_running_loop()
+        legacy_files = await self.store.run(self.store.legacy_files, self.batch_size)
+        for user_id, path in legacy_files:
+            digests = await loop.run_in_executor(None, get_file_digests, path)
+            await self.store.run(self.store.put, path, digests)
+            await self.store.run(self.store.add_reference, user_id, digests['sha256'], os.path.basename(path))
+
+        now = time.time()
+        bytes_reclaimed, files_removed = 0, 0
+        while True:
+            candidates, sizes = await self.store.run(
+                self.store.remove_unused, self.batch_size, used_before=now - self.max_age, max_size=self.max_size,
+                pinned_since=now - self.MAX_PIN_AGE
+            )
+            bytes_reclaimed += sum(sizes)
+            files_removed += len(sizes)
+            if candidates < self.batch_size:
+                break
+
+        temp_paths = [
+            entry.path for entry in os.scandir(self.store.tmp_path)
+            if entry.is_file() and entry.stat().st_mtime < now - self.DOWNLOAD_GRACE
+        ]
+        if temp_paths:
+            await loop.run_in_executor(None, remove_files, temp_paths)
+
+        self.bytes_reclaimed += bytes_reclaimed
+        self.files_removed += files_removed
+        logger.info(
+            "artifacts_collected", bytes_reclaimed=bytes_reclaimed, files_removed=files_removed,
+            temp_files_removed=len(temp_paths), legacy_files_moved=len(legacy_files), footprint=await self.store.run(self.store.footprint)
+        )
+
+    async def _collect_forever(self):
+        while True:
+            try:
+                await self.collect()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("artifacts_collection", error=e)
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,273 @@
+"""
+Microbenchmarks of the per-request hot paths, run with `virus_total_telegram_bot bench`.
+
+Every benchmark is timed with `timeit`, taking as many loops as needed for a run to last at
+least 0.2 seconds, and the best and median of `repeat` runs are reported. The results are a JSON
+document that can be saved and compared with the results of another commit to catch regressions.
+"""
+import contextvars
+import datetime
+import logging
+import os
+import platform
+import queue
+import statistics
+import tempfile
+import timeit
+
+import structlog
+import vt
+from telegram import Chat, Message, Update, User
+
+from virus_total_telegram_bot import __version__, config
+from virus_total_telegram_bot.utils import (
+    get_analysis_stats,
+    get_file_sha256,
+    parse_file_info,
+    parse_url_info,
+    request_arrived,
+    request_served,
+    stage,
+    Results
+)
+
+
+FILE_SIZES = (1024, 1024 * 1024, 16 * 1024 * 1024)
+ENGINES = (
+    "Acronis", "ADMINUSLabs", "AICC", "AlienVault", "Antiy-AVL", "Avast", "AVG", "Avira", "BitDefender",
+    "Bkav", "CMC", "CrowdStrike", "Cylance", "Cynet", "DrWeb", "Elastic", "Emsisoft", "ESET-NOD32",
+    "F-Secure", "Fortinet", "GData", "Google", "Gridinsoft", "Ikarus", "K7AntiVirus", "Kaspersky",
+    "Lionic", "Malwarebytes", "MaxSecure", "McAfee", "Microsoft", "Panda", "Rising", "Sangfor",
+    "SentinelOne", "Sophos", "Symantec", "Tencent", "TrendMicro", "VBA32", "VIPRE", "ViRobot",
+    "Webroot", "Xcitium", "Yandex", "Zillya", "ZoneAlarm", "Zoner",
+)
+
+
+def recorded_analysis(object_type: str):
+    """
+    Parameters:
+    -----------
+    - object_type: str
+        `file` or `url`.
+
+    Returns:
+    --------
+    - analysis: dict
+        A report as returned by the VirusTotal API, with the verdict of every engine.
+    """
+    results = {
+        engine: {
+            "category": "malicious" if index % 12 == 0 else "undetected",
+            "engine_name": engine,
+            "engine_version": "2023.1.17.0",
+            "engine_update": "20230117",
+            "method": "blacklist",
+            "result": "Trojan.Generic" if index % 12 == 0 else None,
+        }
+        for index, engine in enumerate(ENGINES)
+    }
+    malicious = sum(1 for result in results.values() if result["category"] == "malicious")
+    stats = {
+        "harmless": 0, "malicious": malicious, "suspicious": 0, "undetected": len(ENGINES) - malicious,
+        "timeout": 0, "type-unsupported": 0,
+    }
+    attributes = {
+        "last_analysis_date": 1673913600,
+        "last_analysis_results": results,
+        "last_analysis_stats": stats,
+        "reputation": -12,
+        "total_votes": {"harmless": 1, "malicious": 4},
+        "tags": ["peexe", "overlay"] if object_type == "file" else ["phishing"],
+    }
+    if object_type == "file":
+        object_id = "275a021bbfb6489e54d471899f7db9d1663fc695ec2fe2a2c4538aabf651fd0f"
+        attributes.update(size=68, type_description="Win32 EXE", meaningful_name="sample.exe")
+    else:
+        object_id = "aHR0cHM6Ly9leGFtcGxlLmNvbS9sb2dpbg"
+        attributes.update(url="https://example.com/login", title="Sign in", last_final_url="https://example.com/login")
+    return {"type": object_type, "id": object_id, "attributes": attributes}
+
+
+def bench_update():
+    """A message update like the ones the handlers get, built without a bot"""
+    user = User(id=123456, first_name="bench", is_bot=False, username="bench")
+    chat = Chat(id=123456, type=Chat.PRIVATE)
+    message = Message(message_id=1, date=datetime.datetime.now(), chat=chat, from_user=user, text="https://example.com")
+    return Update(update_id=1, message=message)
+
+
+def measure(function, repeat: int):
+    """
+    Time a function without arguments.
+
+    Parameters:
+    -----------
+    - function: callable
+    - repeat: int
+        The number of runs, the best and median of which are reported.
+
+    Returns:
+    --------
+    - result: dict
+        The loops of every run and the best and median microseconds per call.
+    """
+    timer = timeit.Timer(function)
+    loops, _ = timer.autorange()
+    seconds = [total / loops for total in timer.repeat(repeat, loops)]
+    return {
+        "loops": loops,
+        "best_us": round(min(seconds) * 1e6, 3),
+        "median_us": round(statistics.median(seconds) * 1e6, 3),
+    }
+
+
+def bench_file_sha256(sizes: tuple, repeat: int):
+    """`get_file_sha256` of a file of every size, with its throughput in megabytes per second"""
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            file_path = os.path.join(directory, str(size))
+            with open(file_path, "wb") as f:
+                f.write(os.urandom(size))
+            result = measure(lambda path=file_path: get_file_sha256(path), repeat)
+            result["mb_s"] = round(size / (1024 * 1024) / (result["best_us"] / 1e6), 2)
+            results[f"get_file_sha256[{size}]"] = result
+    return results
+
+
+def bench_parse_info(repeat: int):
+    """The stats and the message of recorded file and URL reports"""
+    file_report = vt.Object.from_dict(recorded_analysis("file"))
+    url_report = vt.Object.from_dict(recorded_analysis("url"))
+    return {
+        "parse_file_info": measure(lambda: parse_file_info(get_analysis_stats(file_report)), repeat),
+        "parse_url_info": measure(lambda: parse_url_info(get_analysis_stats(url_report)), repeat),
+    }
+
+
+def bench_request_bookkeeping(repeat: int):
+    """
+    `request_arrived`, a stage and `request_served` of a request, each one in its own context
+    like the task of an update, with the loggers writing to a temporary directory.
+    """
+    update = bench_update()
+
+    def serve():
+        request_arrived(update, None, action="text")
+        with stage("cache"):
+            pass
+        request_served(update, None, result=Results.SUCCESS)
+
+    return {"request_bookkeeping": measure(lambda: contextvars.copy_context().run(serve), repeat)}
+
+
+def bench_log_rendering(record_queue: queue.Queue, events: int, repeat: int):
+    """
+    Log `events` events with a recorded analysis and wait for the thread writing the logs to
+    render them, so the cost of every event includes its rendering.
+    """
+    logger = structlog.get_logger()
+    analysis = vt.Object.from_dict(recorded_analysis("file"))
+
+    def log():
+        for _ in range(events):
+            logger.info("file_received_analysis", request_id="bench", analysis=analysis)
+        record_queue.join()
+
+    seconds = [total / events for total in timeit.Timer(log).repeat(repeat, 1)]
+    return {"log_rendering": {
+        "loops": events,
+        "best_us": round(min(seconds) * 1e6, 3),
+        "median_us": round(statistics.median(seconds) * 1e6, 3),
+    }}
+
+
+def initialize_bench_logging(logs_path: str):
+    """
+    Log like the bot does in production, as JSON lines to a file in `logs_path`, and nowhere else.
+    The queue of the records is unbounded, so none is dropped while the benchmarks run.
+
+    Returns:
+    --------
+    - record_queue: queue.Queue
+        The queue of the records waiting to be written.
+    """
+    logging.getLogger().handlers.clear()
+    config._initialize_logging({  # pylint: disable=protected-access
+        "log_name": "",
+        "log_format": "json",
+        "log_handler": "file",
+        "log_max_bytes": 1048576,
+        "log_backup_count": 1,
+        "log_folder": logs_path,
+        "log_filename": "bench.log",
+        "log_level": "INFO",
+        "log_queue_size": 0
+    }, user_processors=(config.PayloadProcessor(fields=("analysis",), max_length=4096, sample_rate=1),))
+    return logging.getLogger().handlers[-1].queue
+
+
+def run_benchmarks(sizes: tuple = FILE_SIZES, repeat: int = 5, log_events: int = 1000):
+    """
+    Run every microbenchmark.
+
+    Parameters:
+    -----------
+    - sizes: tuple
+        The sizes of the files hashed, in bytes.
+    - repeat: int
+        The number of runs of every benchmark.
+    - log_events: int
+        The number of events logged in every run of the log rendering benchmark.
+
+    Returns:
+    --------
+    - results: dict
+        The versions the benchmarks ran with and the results of every benchmark, by name.
+    """
+    benchmarks = {}
+    benchmarks.update(bench_file_sha256(sizes, repeat))
+    benchmarks.update(bench_parse_info(repeat))
+    with tempfile.TemporaryDirectory() as logs_path:
+        record_queue = initialize_bench_logging(logs_path)
+        benchmarks.update(bench_request_bookkeeping(repeat))
+        record_queue.join()
+        benchmarks.update(bench_log_rendering(record_queue, log_events, repeat))
+        record_queue.join()
+    return {
+        "version": __version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "benchmarks": benchmarks,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    """
+    Compare the results of two runs.
+
+    Parameters:
+    -----------
+    - results: dict
+        The results of `run_benchmarks`.
+    - baseline: dict
+        The results of `run_benchmarks` the results are compared with, such as those of the
+        previous commit.
+    - tolerance: float
+        The fraction a benchmark can be slower than in the baseline without being a regression.
+
+    Returns:
+    --------
+    - regressions: dict
+        The benchmarks slower than in the baseline by more than the tolerance, with how many
+        times slower they are. Benchmarks missing from either run are left out.
+    """
+    regressions = {}
+    for name, result in results["benchmarks"].items():
+        previous = baseline.get("benchmarks", {}).get(name)
+        if previous is None or not previous["best_us"]:
+            continue
+        ratio = result["best_us"] / previous["best_us"]
+        if ratio > 1 + tolerance:
+            regressions[name] = round(ratio, 3)
+    return regressions
@@ -0,0 +1,182 @@
+"""
+Verdict cache, so the same URL or file is not sent to VirusTotal again while its last verdict is still valid.
+"""
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+
+import structlog
+
+
+logger = structlog.get_logger()
+
+
+def is_positive_verdict(stats: dict):
+    """
+    Check whether some engine flagged the analyzed item.
+
+    Parameters:
+    -----------
+    - stats: dict
+        The number of engines per verdict.
+
+    Returns:
+    --------
+    - positive: bool
+        True if at least one engine considered the item malicious or suspicious.
+    """
+    return stats.get('malicious', 0) > 0 or stats.get('suspicious', 0) > 0
+
+
+class VerdictCache():
+    """
+    Two-tier cache of VirusTotal verdicts: a bounded in-memory LRU in front of a SQLite database.
+
+    Entries are keyed by `file:<sha256>` or `url:<VirusTotal URL id>` and hold the stats needed to
+    render the results. Positive verdicts (some engine flagged the item) and negative verdicts
+    expire after different TTLs, since a clean item is the one most likely to change its verdict.
+
+    The database is shared by the worker processes and queried from the event loop, so once it is
+    set up a query only waits `BUSY_TIMEOUT` seconds for the lock of another process. A database
+    still locked after that is skipped: a lookup is served from memory only and a verdict is kept
+    in memory only.
+    """
+
+    BUSY_TIMEOUT = 0.05
+
+    def __init__(self, db_path: str, max_entries: int, positive_ttl: int, negative_ttl: int):
+        """
+        Parameters:
+        -----------
+        - db_path: str
+            The path of the SQLite database file.
+        - max_entries: int
+            The maximum number of entries kept in memory.
+        - positive_ttl: int
+            Time to live of the positive verdicts, in hours.
+        - negative_ttl: int
+            Time to live of the negative verdicts, in hours.
+        """
+        self.max_entries = max_entries
+        self.positive_ttl = positive_ttl * 3600
+        self.negative_ttl = negative_ttl * 3600
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._memory = OrderedDict()
+        # the processes starting together wait for each other to set up the database
+        self._db = sqlite3.connect(db_path, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS verdicts ("
+            "key TEXT PRIMARY KEY, stats TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._db.commit()
+        self._db.execute(f"PRAGMA busy_timeout = {int(self.BUSY_TIMEOUT * 1000)}")
+
+    @staticmethod
+    def file_key(file_sha256: str):
+        """Cache key of a file"""
+        return f"file:{file_sha256}"
+
+    @staticmethod
+    def url_key(url_id: str):
+        """Cache key of a URL, given its VirusTotal URL id"""
+        return f"url:{url_id}"
+
+    def get(self, key: str):
+        """
+        Get the stats of a cached verdict.
+
+        Parameters:
+        -----------
+        - key: str
+            The cache key of the file or URL.
+
+        Returns:
+        --------
+        - stats: dict or None
+            The cached stats, or None if there is no valid verdict for the key.
+        """
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is None:
+            try:
+                row = self._db.execute("SELECT stats, expires_at FROM verdicts WHERE key = ?", (key,)).fetchone()
+            except sqlite3.OperationalError as e:
+                logger.warning("verdict_cache_unavailable", key=key, error=e)
+                row = None
+            if row is not None:
+                entry = (json.loads(row[0]), row[1])
+                self._remember(key, entry)
+        if entry is None or entry[1] <= now:
+            if entry is not None:
+                self._forget(key)
+            self.misses += 1
+            logger.info("verdict_cache_miss", key=key)
+            return None
+        self._memory.move_to_end(key)
+        self.hits += 1
+        logger.info("verdict_cache_hit", key=key)
+        return entry[0]
+
+    def set(self, key: str, stats: dict):
+        """
+        Cache the stats of a verdict.
+
+        Parameters:
+        -----------
+        - key: str
+            The cache key of the file or URL.
+        - stats: dict
+            The number of engines per verdict.
+        """
+        ttl = self.positive_ttl if is_positive_verdict(stats) else self.negative_ttl
+        entry = (stats, time.time() + ttl)
+        self._remember(key, entry)
+        self._write(
+            key, "INSERT OR REPLACE INTO verdicts (key, stats, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(stats), entry[1])
+        )
+
+    def counters(self):
+        """
+        Get the cache counters.
+
+        Returns:
+        --------
+        - counters: dict
+            Hits, misses and evictions since the cache was created, and the current number of
+            entries in memory.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "memory_entries": len(self._memory),
+        }
+
+    def close(self):
+        """Close the database and log the cache counters"""
+        logger.info("verdict_cache_closed", **self.counters())
+        self._db.close()
+
+    def _remember(self, key: str, entry: tuple):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def _forget(self, key: str):
+        self._memory.pop(key, None)
+        self._write(key, "DELETE FROM verdicts WHERE key = ?", (key,))
+
+    def _write(self, key: str, statement: str, parameters: tuple):
+        try:
+            self._db.execute(statement, parameters)
+            self._db.commit()
+        except sqlite3.OperationalError as e:
+            self._db.rollback()
+            logger.warning("verdict_cache_unavailable", key=key, error=e)
@@ -1,22 +1,50 @@
 """All Bot Callbacks"""
+import asyncio
+import time
+
 import vt
 import structlog
 from telegram import Update
 from telegram.ext import ContextTypes
+from telegram.helpers import escape_markdown
 
 from virus_total_telegram_bot.utils import (
     request_arrived,
     request_served,
     parse_url_info,
     parse_file_info,
-    get_file_sha256,
+    parse_batch_info,
+    get_file_digests_async,
+    get_file_report,
+    get_url_report,
+    canonicalize_url,
+    extract_urls,
+    get_analysis_stats,
+    get_verdict_cache,
+    get_vt_client,
+    get_analysis_scheduler,
+    get_single_flight,
+    add_flight_data,
+    get_request,
+    current_milliseconds,
     get_user_id,
-    get_user_id_artifacts_path,
+    get_artifact_store,
+    get_admission_controller,
+    stage,
     add_file_data,
+    open_downloaded_file,
+    DownloadBuffer,
     Results
 )
 from virus_total_telegram_bot.strings import dialogs, ENGLISH
+from virus_total_telegram_bot.admission import Admission
 from virus_total_telegram_bot.entities import Config
+from virus_total_telegram_bot.jobs import AnalysisTimeout, Job, JobStatus
+from virus_total_telegram_bot.metrics import JOB_DURATION, STAGE_DURATION
+from virus_total_telegram_bot.progress import ProgressMessage
+from virus_total_telegram_bot.ratelimit import MessagePriority
+from virus_total_telegram_bot.requestcontext import RequestContext, current_request
+from virus_total_telegram_bot.singleflight import FlightRole
 
 
 logger = structlog.get_logger()
@@ -51,6 +79,322 @@ async def bot_help(update: Update, context: ContextTypes.DEFAULT_TYPE, files_max
     request_served(update, context, result=Results.SUCCESS)
 
 
+async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Callback for the /status command. Shows the analyses waiting in the background.
+
+    Parameters:
+    -----------
+    - update: telegram.Update object
+    - context: telegram.ext.ContextTypes.DEFAULT_TYPE object
+    """
+    request_arrived(update, context, action="/status")
+    scheduler = get_analysis_scheduler(context)
+    counters = scheduler.counters()
+    status_text = dialogs['status']['summary'][ENGLISH] % (counters[JobStatus.QUEUED], counters[JobStatus.RUNNING])
+    quota = get_vt_client(context).counters()
+    status_text += "\n" + dialogs['status']['quota'][ENGLISH] % (
+        quota['remaining_per_minute'], quota['remaining_per_day'], quota['queue_depth'])
+    user_id = get_user_id(update)
+    for job in scheduler.jobs():
+        if job.user_id == user_id:
+            status_text += "\n" + dialogs['status']['job'][ENGLISH] % (job.target, job.status)
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=status_text)
+    request_served(update, context, result=Results.SUCCESS)
+
+
+async def admit_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Admit a request before any download or call to VirusTotal, or tell the user why it is rejected.
+
+    Parameters:
+    -----------
+    - update: telegram.Update object
+    - context: telegram.ext.ContextTypes.DEFAULT_TYPE object
+
+    Returns:
+    --------
+    - admission: virus_total_telegram_bot.admission.Admission object or None
+        The admission to release once the request is handled, or None if it is rejected.
+    """
+    admission, rejection = get_admission_controller(context).admit(get_user_id(update))
+    if rejection is not None:
+        await reject_request(update, context, rejection)
+    return admission
+
+
+async def reject_request(update: Update, context: ContextTypes.DEFAULT_TYPE, rejection: str):
+    """
+    Tell the user that a request is rejected and serve it.
+
+    Parameters:
+    -----------
+    - update: telegram.Update object
+    - context: telegram.ext.ContextTypes.DEFAULT_TYPE object
+    - rejection: str
+        The `Results` value the request is rejected with.
+    """
+    rejection_text = dialogs[rejection][ENGLISH]
+    if rejection == Results.TOO_MANY_JOBS:
+        rejection_text %= get_admission_controller(context).max_jobs_per_user
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=rejection_text)
+    request_served(update, context, result=rejection)
+
+
+def api_error_text(error: vt.error.APIError, dialog: dict):
+    """
+    Get the text explaining an error of the VirusTotal API to the user.
+
+    Parameters:
+    -----------
+    - error: vt.error.APIError object
+    - dialog: dict
+        The dialog of the action that failed.
+
+    Returns:
+    --------
+    - text: str
+    """
+    if error.code == "QuotaExceededError":
+        return dialogs['quota_exceeded'][ENGLISH]
+    return dialog['error'][ENGLISH]
+
+
+async def start_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE, cache_key: str, target: str, submit,
+                         message_id: int = None):
+    """
+    Start the analysis of a URL or file, coalescing identical concurrent requests.
+
+    The first request for a URL or file (the leader) submits it to VirusTotal. The requests for
+    the same URL or file arriving meanwhile (the followers) reuse the leader's submission and
+    analysis instead of submitting it again.
+
+    Parameters:
+    -----------
+    - update: telegram.Update object
+    - context: telegram.ext.ContextTypes.DEFAULT_TYPE object
+    - cache_key: str
+        The verdict cache key of the URL or file, which identifies identical requests.
+    - target: str
+        The URL or the name of the file being analyzed.
+    - submit: callable
+        Coroutine function without arguments that submits the URL or file to VirusTotal and returns
+        the analysis (or a recent enough report).
+    - message_id: int
+        The progress message of the request, edited with the results of its job.
+
+    Returns:
+    --------
+    - started: tuple
+        The completed analysis or report (or None), the future resolved by the scheduler when the
+        analysis is not completed yet (or None), the job and the `FlightRole` of the request.
+    """
+    job = Job(
+        request_id=get_request().request_id,
+        user_id=get_user_id(update),
+        chat_id=update.effective_chat.id,
+        action=get_request().action,
+        target=target,
+        message_id=message_id
+    )
+    scheduler = get_analysis_scheduler(context)
+    analysis = None
+    future = scheduler.join(cache_key, job)
+    role = FlightRole.FOLLOWER
+    if future is None:
+        analysis, role = await get_single_flight(context).do(cache_key, submit)
+        if analysis.type == "analysis" and analysis.get('status') != "completed":
+            future = scheduler.submit(job, analysis, key=cache_key)
+            analysis = None
+    logger.info("analysis_requested", request_id=job.request_id, cache_key=cache_key, flight_role=role)
+    return analysis, future, job, role
+
+
+async def request_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE, cache_key: str, target: str, submit,
+                           message_id: int = None):
+    """
+    Get the analysis of a URL or file with `start_analysis`.
+
+    If the analysis is not completed yet, it is waited for in the background and its results are
+    sent when it completes, so the callback can finish right away.
+
+    Parameters:
+    -----------
+    - update: telegram.Update object
+    - context: telegram.ext.ContextTypes.DEFAULT_TYPE object
+    - cache_key: str
+        The verdict cache key of the URL or file, which identifies identical requests.
+    - target: str
+        The URL or the name of the file being analyzed.
+    - submit: callable
+        Coroutine function without arguments that submits the URL or file to VirusTotal and returns
+        the analysis (or a recent enough report).
+    - message_id: int
+        The progress message of the request, edited with the results when they are sent in the background.
+
+    Returns:
+    --------
+    - analysis: vt.object.Object object or None
+        The completed analysis or report, or None if it is being waited for in the background.
+    """
+    analysis, future, job, role = await start_analysis(update, context, cache_key, target, submit, message_id)
+    add_flight_data(role)
+    if future is None:
+        return analysis
+    await send_in_background(
+        context, send_job_results(context, job, future, cache_key),
+        key=f"job:{job.request_id}", payload={"job": job.to_dict(), "cache_key": cache_key}
+    )
+    return None
+
+
+async def send_in_background(context: ContextTypes.DEFAULT_TYPE, coroutine, key: str, payload: dict):
+    """
+    Send the results of a request from a task of the application, once its analyses complete.
+
+    In the multi-process mode the payload is kept in the work queue until the results are sent,
+    so another worker resumes it with `resume_in_background` if this one stops first.
+
+    Parameters:
+    -----------
+    - context: telegram.ext.ContextTypes.DEFAULT_TYPE object
+    - coroutine: coroutine
+        The sending of the results.
+    - key: str
+        The key of the payload in the work queue.
+    - payload: dict
+        What `resume_in_background` needs to send the results, serializable to JSON.
+    """
+    journal = context.bot_data.get('job_journal')
+    if journal is not None:
+        coroutine = journal.serve(await journal.record(key, payload), coroutine)
+    context.application.create_task(coroutine)
+
+
+async def resume_in_background(context: ContextTypes.DEFAULT_TYPE, payload: dict):
+    """
+    Wait again for the analyses of a request whose results were being waited for by a worker
+    that stopped, and send them.
+
+    Parameters:
+    -----------
+    - context: telegram.ext.ContextTypes.DEFAULT_TYPE object
+    - payload: dict
+        The payload given to `send_in_background`.
+    """
+    scheduler = get_analysis_scheduler(context)
+    if "job" in payload:
+        job = Job.from_dict(payload["job"])
+        logger.info("job_resumed", request_id=job.request_id, analysis_id=job.analysis_id)
+        await send_job_results(context, job, scheduler.resume(job, payload["cache_key"]), payload["cache_key"])
+        return
+    batch = payload["batch"]
+    logger.info("job_resumed", request_id=batch["request_id"], urls=len(batch["urls"]))
+    results = [
+        scheduler.resume(Job.from_dict(result["job"]), result["cache_key"])
+        if isinstance(result, dict) and "job" in result else result
+        for result in batch["results"]
+    ]
+    progress = ProgressMessage(context.bot, batch["chat_id"], batch["message_id"])
+    await send_batch_results(context, progress, batch["request_id"], batch["urls"], results)
+
+
+async def send_job_results(context: ContextTypes.DEFAULT_TYPE, job: Job, future, cache_key: str):
+    """
+    Edit the progress message of a background job with its results once its analysis completes.
+
+    Parameters:
+    -----------
+    - context: telegram.ext.ContextTypes.DEFAULT_TYPE object
+    - job: virus_total_telegram_bot.jobs.Job object
+    - future: asyncio.Future
+        The future returned by the scheduler when the job was submitted.
+    - cache_key: str
+        The verdict cache key the results are stored under.
+    """
+    dialog = dialogs[f"{job.action}_received"]
+    progress = ProgressMessage(context.bot, job.chat_id, job.message_id)
+    stages = {}
+    polling_start = time.perf_counter()
+    try:
+        analysis = await future
+    except asyncio.CancelledError:
+        logger.warning("job_served", request_id=job.request_id, result=Results.CANCELLED)
+        job_served(job, Results.CANCELLED, stages)
+        return
+    except AnalysisTimeout as e:
+        stages['vt_polling'] = time.perf_counter() - polling_start
+        sending_start = time.perf_counter()
+        await progress.update(dialogs['analysis_timeout'][ENGLISH] % job.target, priority=MessagePriority.RESULTS)
+        stages['send_message'] = time.perf_counter() - sending_start
+        logger.warning("job_served", request_id=job.request_id, result=Results.TIMEOUT, error=e, stages=stage_milliseconds(stages))
+        job_served(job, Results.TIMEOUT, stages)
+        return
+    except vt.error.APIError as e:
+        stages['vt_polling'] = time.perf_counter() - polling_start
+        sending_start = time.perf_counter()
+        await progress.update(api_error_text(e, dialog), priority=MessagePriority.RESULTS)
+        stages['send_message'] = time.perf_counter() - sending_start
+        logger.error("job_served", request_id=job.request_id, result=Results.ERROR, error=e, stages=stage_milliseconds(stages))
+        job_served(job, Results.ERROR, stages)
+        return
+    stages['vt_polling'] = time.perf_counter() - polling_start
+
+    logger.info(f"{job.action}_received_analysis", request_id=job.request_id, analysis=analysis)
+    stats = get_analysis_stats(analysis)
+    get_verdict_cache(context).set(cache_key, stats)
+    sending_start = time.perf_counter()
+    await progress.update(results_text(job.action, job.target, stats), parse_mode='Markdown', priority=MessagePriority.RESULTS)
+    stages['send_message'] = time.perf_counter() - sending_start
+    logger.info(
+        "job_served", request_id=job.request_id, result=Results.SUCCESS,
+        elapsed=current_milliseconds() - job.start_time, stages=stage_milliseconds(stages)
+    )
+    job_served(job, Results.SUCCESS, stages)
+
+
+def results_text(action: str, target: str, stats: dict):
+    """
+    Parameters:
+    -----------
+    - action: str
+        The action of the request (`text` or `file`).
+    - target: str
+        The URL or the name of the file analyzed.
+    - stats: dict
+        The number of engines per verdict, as returned by `get_analysis_stats`.
+
+    Returns:
+    --------
+    - text: str
+        The results of the analysis in Markdown, under a header naming the URL or file.
+    """
+    parse_info = parse_url_info if action == "text" else parse_file_info
+    return dialogs[f"{action}_received"]['results'][ENGLISH] % escape_markdown(target) + "\n" + parse_info(stats)
+
+
+def stage_milliseconds(stages: dict):
+    """The seconds spent in every stage, in milliseconds like the `stages` of the request events"""
+    return {name: round(seconds * 1000, 3) for name, seconds in stages.items()}
+
+
+def job_served(job: Job, result: str, stages: dict):
+    """
+    Measure the time from the request of a background job until it is served, and its stages.
+
+    Parameters:
+    -----------
+    - job: virus_total_telegram_bot.jobs.Job object
+    - result: str
+        The `Results` value the job is served with.
+    - stages: dict
+        The seconds spent in every stage of the job.
+    """
+    JOB_DURATION.observe((current_milliseconds() - job.start_time) / 1000, action=job.action, result=result)
+    for name, seconds in stages.items():
+        STAGE_DURATION.observe(seconds, action=job.action, stage=name)
+
+
 async def text(update: Update, context: ContextTypes.DEFAULT_TYPE, cfg: Config):
     """
     Callback for the text messages received by the bot.
@@ -62,31 +406,223 @@ async def text(update: Update, context: ContextTypes.DEFAULT_TYPE, cfg: Config):
     - cfg: virus_total_telegram_bot.entities.Config object
     """
     request_arrived(update, context, action="text")
+    admission = await admit_request(update, context)
+    if admission is None:
+        return
+    try:
+        await analyze_text(update, context, cfg)
+    finally:
+        get_admission_controller(context).release(admission)
 
+
+async def analyze_text(update: Update, context: ContextTypes.DEFAULT_TYPE, cfg: Config):
+    """
+    Analyze the URLs of an admitted text message.
+
+    Parameters:
+    -----------
+    - update: telegram.Update object
+    - context: telegram.ext.ContextTypes.DEFAULT_TYPE object
+    - cfg: virus_total_telegram_bot.entities.Config object
+    """
     text_received = update.message.text
     logger.info("text_received", text_received=text_received)
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=dialogs['text_received']['analyzing'][ENGLISH])
-
-    try:
-        client = vt.Client(cfg.virus_total_apikey)
-        analysis = await client.scan_url_async(text_received, wait_for_completion=True)
-    except vt.error.APIError as e:
-        logger.error("text_received_analysis", error=e, text_received=text_received)
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=dialogs['text_received']['error'][ENGLISH])
-        request_served(update, context, result=Results.ERROR)
-        await client.close_async()
+    urls = extract_urls(update.message)
+    if not urls:
+        try:
+            urls = [canonicalize_url(text_received)]
+        except ValueError as e:
+            logger.error("text_received_analysis", error=e, text_received=text_received)
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id, text=dialogs['text_received']['error'][ENGLISH],
+                rate_limit_args=MessagePriority.RESULTS)
+            request_served(update, context, result=Results.ERROR)
+            return
+    if len(urls) > 1:
+        await analyze_urls(update, context, cfg, urls)
         return
 
-    await client.close_async()
-    logger.info("text_received_analysis", analysis=analysis.to_dict())
-    url_info = parse_url_info(analysis)
-    await context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text=dialogs['text_received']['results'][ENGLISH] % text_received)
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=url_info, parse_mode='Markdown')
+    url = urls[0]
+    progress = ProgressMessage(context.bot, update.effective_chat.id)
+    verdict_cache = get_verdict_cache(context)
+    cache_key = verdict_cache.url_key(vt.url_id(url))
+    with stage("cache"):
+        stats = verdict_cache.get(cache_key)
+    if stats is None:
+        with stage("send_message"):
+            await progress.update(dialogs['text_received']['analyzing'][ENGLISH])
+        try:
+            analysis = await request_analysis(
+                update, context, cache_key, target=url, submit=lambda: submit_url(context, cfg, url),
+                message_id=progress.message_id)
+        except vt.error.APIError as e:
+            logger.error("text_received_analysis", error=e, text_received=text_received)
+            with stage("send_message"):
+                await progress.update(api_error_text(e, dialogs['text_received']), priority=MessagePriority.RESULTS)
+            request_served(update, context, result=Results.ERROR)
+            return
+
+        if analysis is None:
+            request_served(update, context, result=Results.QUEUED)
+            return
+        logger.info("text_received_analysis", request_id=get_request().request_id, analysis=analysis)
+        stats = get_analysis_stats(analysis)
+        with stage("cache"):
+            verdict_cache.set(cache_key, stats)
+    with stage("send_message"):
+        await progress.update(results_text("text", url, stats), parse_mode='Markdown', priority=MessagePriority.RESULTS)
     request_served(update, context, result=Results.SUCCESS)
 
 
+async def submit_url(context: ContextTypes.DEFAULT_TYPE, cfg: Config, url: str):
+    """
+    Get the recent report of a URL, or submit the URL to VirusTotal when there is none.
+
+    Parameters:
+    -----------
+    - context: telegram.ext.ContextTypes.DEFAULT_TYPE object
+    - cfg: virus_total_telegram_bot.entities.Config object
+    - url: str
+        The canonical URL.
+
+    Returns:
+    --------
+    - analysis: vt.object.Object object
+        The URL report or the analysis of the new scan.
+    """
+    client = get_vt_client(context)
+    with stage("vt_report"):
+        report = await get_url_report(client, url, cfg.url_report_max_age)
+    if report is not None:
+        return report
+    with stage("vt_scan"):
+        return await client.scan_url_async(url)
+
+
+async def analyze_urls(update: Update, context: ContextTypes.DEFAULT_TYPE, cfg: Config, urls: list):
+    """
+    Analyze a batch of URLs concurrently, up to `cfg.batch_max_concurrency` at a time, and reply
+    with a single summary table.
+
+    The table is sent right away when every URL was cached or had a recent report. Otherwise the
+    analyses not completed yet are waited for in the background and the table is sent when the
+    last one completes.
+
+    Parameters:
+    -----------
+    - update: telegram.Update object
+    - context: telegram.ext.ContextTypes.DEFAULT_TYPE object
+    - cfg: virus_total_telegram_bot.entities.Config object
+    - urls: list
+        The canonical URLs, without duplicates.
+    """
+    progress = ProgressMessage(context.bot, update.effective_chat.id)
+    with stage("send_message"):
+        await progress.update(dialogs['text_received']['analyzing_batch'][ENGLISH] % len(urls))
+    verdict_cache = get_verdict_cache(context)
+    semaphore = asyncio.Semaphore(cfg.batch_max_concurrency)
+    request = get_request()
+    jobs = {}
+    url_requests = {}
+
+    async def analyze(url):
+        # the URLs are analyzed concurrently, so the stages of every URL are recorded apart: added
+        # to the request, they would add up to more than its elapsed time
+        url_requests[url] = RequestContext(request.request_id, request.action, request.username, request.user_id)
+        current_request.set(url_requests[url])
+        cache_key = verdict_cache.url_key(vt.url_id(url))
+        with stage("cache"):
+            stats = verdict_cache.get(cache_key)
+        if stats is not None:
+            return stats
+        async with semaphore:
+            try:
+                analysis, future, job, _ = await start_analysis(
+                    update, context, cache_key, target=url, submit=lambda: submit_url(context, cfg, url))
+            except vt.error.APIError as e:
+                logger.error("text_received_analysis", error=e, text_received=url)
+                return None
+        if future is not None:
+            jobs[url] = {"job": job.to_dict(), "cache_key": cache_key}
+            return future
+        stats = get_analysis_stats(analysis)
+        with stage("cache"):
+            verdict_cache.set(cache_key, stats)
+        return stats
+
+    with stage("batch"):
+        results = await asyncio.gather(*(analyze(url) for url in urls))
+    for url, url_request in url_requests.items():
+        for name, seconds in (url_request.stages or {}).items():
+            STAGE_DURATION.observe(seconds, action=request.action, stage=name)
+        logger.info(
+            "batch_url_analyzed", url=url,
+            **{f"stage_{name}": round(seconds * 1000, 3) for name, seconds in (url_request.stages or {}).items()}
+        )
+    if not any(isinstance(result, asyncio.Future) for result in results):
+        with stage("send_message"):
+            await send_batch_results(context, progress, request.request_id, urls, results)
+        request_served(update, context, result=Results.SUCCESS)
+        return
+    request_id = request.request_id
+    await send_in_background(
+        context, send_batch_results(context, progress, request_id, urls, results),
+        key=f"batch:{request_id}",
+        payload={"batch": {
+            "request_id": request_id, "chat_id": progress.chat_id, "message_id": progress.message_id, "urls": urls,
+            "results": [jobs[url] if isinstance(result, asyncio.Future) else result for url, result in zip(urls, results)],
+        }}
+    )
+    request_served(update, context, result=Results.QUEUED)
+
+
+async def send_batch_results(context: ContextTypes.DEFAULT_TYPE, progress: ProgressMessage, request_id: str, urls: list,
+                             results: list):
+    """
+    Show the summary table of a batch of URLs in its progress message, once the analyses waited
+    for in the background complete. The parts of a table too long for one message are sent in
+    new messages.
+
+    Parameters:
+    -----------
+    - context: telegram.ext.ContextTypes.DEFAULT_TYPE object
+    - progress: virus_total_telegram_bot.progress.ProgressMessage object
+        The progress message of the batch.
+    - request_id: str
+        The id of the request that sent the batch.
+    - urls: list
+        The canonical URLs of the batch.
+    - results: list
+        For each URL, its analysis stats, the future resolved by the scheduler when its analysis
+        completes, or None if it failed.
+    """
+    verdict_cache = get_verdict_cache(context)
+    rows = []
+    for url, result in zip(urls, results):
+        if isinstance(result, asyncio.Future):
+            try:
+                analysis = await result
+            except asyncio.CancelledError:
+                logger.warning("job_served", request_id=request_id, result=Results.CANCELLED)
+                return
+            except (vt.error.APIError, AnalysisTimeout) as e:
+                logger.error("text_received_analysis", request_id=request_id, error=e, text_received=url)
+                result = None
+            else:
+                result = get_analysis_stats(analysis)
+                verdict_cache.set(verdict_cache.url_key(vt.url_id(url)), result)
+        rows.append((url, result))
+
+    header = dialogs['text_received']['batch_results'][ENGLISH] % len(urls)
+    for index, batch_info in enumerate(parse_batch_info(rows)):
+        if index == 0:
+            await progress.update(header + "\n" + batch_info, parse_mode='Markdown', priority=MessagePriority.RESULTS)
+        else:
+            await context.bot.send_message(
+                chat_id=progress.chat_id, text=batch_info, parse_mode='Markdown', rate_limit_args=MessagePriority.RESULTS)
+    logger.info("batch_served", request_id=request_id, urls=len(urls), errors=sum(1 for _, stats in rows if stats is None))
+
+
 async def file(update: Update, context: ContextTypes.DEFAULT_TYPE, cfg: Config):
     """
     Callback for the files received by the bot.
@@ -99,42 +635,122 @@ async def file(update: Update, context: ContextTypes.DEFAULT_TYPE, cfg: Config):
     """
     request_arrived(update, context, action="file")
 
-    file_id = update.message.document.file_id
-    new_file = await context.bot.get_file(file_id)
-    file_name = update.message.document.file_name
+    # everything before the download is decided from the metadata of the document
     file_size_in_bytes = update.message.document.file_size
-    file_size_in_megabytes = round(file_size_in_bytes / (1024 * 1024), 6)
-    if file_size_in_megabytes > cfg.files_max_size:
+    if file_size_in_bytes is not None and file_size_in_bytes > cfg.files_max_size * 1024 * 1024:
         await context.bot.send_message(chat_id=update.effective_chat.id, text=dialogs['file_received']['too_big'][ENGLISH] % cfg.files_max_size)
         request_served(update, context, result=Results.FILE_TOO_BIG)
         return
-    user_id = str(get_user_id(update))
-    user_id_artifacts_path = get_user_id_artifacts_path(cfg.artifacts_path, user_id)
-    file_path = f"{user_id_artifacts_path}/{file_name}"
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=dialogs['file_received']['downloading'][ENGLISH])
-    await new_file.download_to_drive(file_path)
-    logger.info("file_received", file_id=file_id, file_name=file_name, file_path=file_path)
+    admission = await admit_request(update, context)
+    if admission is None:
+        return
+    artifact_store = get_artifact_store(context)
+    request_id = get_request().request_id
+    try:
+        await analyze_file(update, context, cfg, admission)
+    finally:
+        get_admission_controller(context).release(admission)
+        # the file is uploaded by now, if it had to be
+        await artifact_store.run(artifact_store.unpin, request_id)
 
-    file_sha256 = get_file_sha256(file_path)
-    add_file_data(context, file_name, file_size_in_megabytes, file_sha256, file_id)
 
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=dialogs['file_received']['analyzing'][ENGLISH])
+async def analyze_file(update: Update, context: ContextTypes.DEFAULT_TYPE, cfg: Config, admission: Admission):
+    """
+    Download, store and analyze an admitted document.
 
-    try:
-        with open(file_path, 'rb') as f:
-            client = vt.Client(cfg.virus_total_apikey)
-            analysis = await client.scan_file_async(f, wait_for_completion=True)
-    except vt.error.APIError as e:
-        logger.error("file_received_analysis", error=e, file_path=file_path)
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=dialogs['file_received']['error'][ENGLISH])
-        request_served(update, context, result=Results.ERROR)
-        await client.close_async()
-        return
+    Parameters:
+    -----------
+    - update: telegram.Update object
+    - context: telegram.ext.ContextTypes.DEFAULT_TYPE object
+    - cfg: virus_total_telegram_bot.entities.Config object
+    - admission: virus_total_telegram_bot.admission.Admission object
+        The admission of the request, holding the size of its download.
+    """
+    file_id = update.message.document.file_id
+    file_name = update.message.document.file_name
+    file_size_in_bytes = update.message.document.file_size
+    file_size_in_megabytes = round((file_size_in_bytes or 0) / (1024 * 1024), 6)
+    artifact_store = get_artifact_store(context)
+    file_unique_id = update.message.document.file_unique_id
+    progress = ProgressMessage(context.bot, update.effective_chat.id)
+    buffer = None
+    file_digests = await artifact_store.run(artifact_store.find, file_unique_id, holder=get_request().request_id)
+    if file_digests is not None:
+        file_path = artifact_store.object_path(file_digests['sha256'])
+    else:
+        rejection = get_admission_controller(context).admit_download(admission, file_size_in_bytes)
+        if rejection is not None:
+            await reject_request(update, context, rejection)
+            return
+        with stage("send_message"):
+            await progress.update(dialogs['file_received']['downloading'][ENGLISH])
+        if cfg.in_memory_downloads and file_size_in_bytes is not None and file_size_in_megabytes <= cfg.in_memory_max_size:
+            file_path = None
+            buffer = DownloadBuffer(file_name, max_size=file_size_in_bytes)
+            with stage("download"):
+                new_file = await context.bot.get_file(file_id)
+                await new_file.download_to_memory(buffer)
+            with stage("hashing"):
+                file_digests = await get_file_digests_async(buffer)
+        else:
+            temp_path = artifact_store.temp_path()
+            with stage("download"):
+                new_file = await context.bot.get_file(file_id)
+                await new_file.download_to_drive(temp_path)
+            with stage("hashing"):
+                file_digests = await get_file_digests_async(temp_path)
+            with stage("store"):
+                file_path = await artifact_store.run(
+                    artifact_store.put, temp_path, file_digests, holder=get_request().request_id)
+    if file_path is not None:
+        with stage("store"):
+            await artifact_store.run(
+                artifact_store.add_reference, get_user_id(update), file_digests['sha256'], file_name, file_unique_id)
+    logger.info("file_received", file_id=file_id, file_name=file_name, file_path=file_path, **file_digests)
 
-    await client.close_async()
-    logger.info("file_received_analysis", analysis=analysis.to_dict())
-    await context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text=dialogs['file_received']['results'][ENGLISH] % file_name)
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=parse_file_info(analysis), parse_mode='Markdown')
+    file_sha256 = file_digests['sha256']
+    add_file_data(file_name, file_size_in_megabytes, file_sha256, file_id)
+
+    verdict_cache = get_verdict_cache(context)
+    cache_key = verdict_cache.file_key(file_sha256)
+    with stage("cache"):
+        stats = verdict_cache.get(cache_key)
+    if stats is None:
+        with stage("send_message"):
+            await progress.update(dialogs['file_received']['analyzing'][ENGLISH])
+        client = get_vt_client(context)
+
+        async def submit():
+            with stage("vt_report"):
+                report = await get_file_report(client, file_sha256, cfg.file_report_max_age)
+            if report is not None:
+                return report
+            with stage("vt_upload"), open_downloaded_file(buffer, file_path) as f:
+                return await client.scan_file_async(f)
+
+        try:
+            analysis = await request_analysis(
+                update, context, cache_key, target=file_name, submit=submit, message_id=progress.message_id)
+        except vt.error.APIError as e:
+            logger.error("file_received_analysis", error=e, file_path=file_path)
+            with stage("send_message"):
+                await progress.update(api_error_text(e, dialogs['file_received']), priority=MessagePriority.RESULTS)
+            request_served(update, context, result=Results.ERROR)
+            return
+        except OSError as e:
+            logger.error("file_received_analysis", error=e, file_path=file_path)
+            with stage("send_message"):
+                await progress.update(dialogs['file_received']['error'][ENGLISH], priority=MessagePriority.RESULTS)
+            request_served(update, context, result=Results.ERROR)
+            return
+
+        if analysis is None:
+            request_served(update, context, result=Results.QUEUED)
+            return
+        logger.info("file_received_analysis", request_id=get_request().request_id, analysis=analysis)
+        stats = get_analysis_stats(analysis)
+        with stage("cache"):
+            verdict_cache.set(cache_key, stats)
+    with stage("send_message"):
+        await progress.update(results_text("file", file_name, stats), parse_mode='Markdown', priority=MessagePriority.RESULTS)
     request_served(update, context, result=Results.SUCCESS)
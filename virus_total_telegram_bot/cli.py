@@ -1,17 +1,31 @@
 """
 Command-line interface that acts as the entrypoint from which the server can be started.
 """
+import json
 import os
+import sys
 
 import click
 
 from virus_total_telegram_bot import __version__
 from virus_total_telegram_bot import config
 from virus_total_telegram_bot import app
+from virus_total_telegram_bot import workers as workers_mode
+from virus_total_telegram_bot.entities import Config
 
 
-@click.command()
-def main():
+@click.group(invoke_without_command=True)
+@click.option("--mode", type=click.Choice(["polling", "webhook"]), help="How updates are received (BOT_MODE).")
+@click.option("--listen", help="Address the webhook server listens on (WEBHOOK_LISTEN).")
+@click.option("--port", type=int, help="Port the webhook server listens on (WEBHOOK_PORT).")
+@click.option("--path", help="Path of the webhook (WEBHOOK_PATH).")
+@click.option("--webhook-url", help="Public URL registered as the webhook in Telegram (WEBHOOK_URL).")
+@click.option("--secret-token", help="Token Telegram sends in every webhook request (WEBHOOK_SECRET_TOKEN).")
+@click.option("--max-connections", type=int, help="Simultaneous webhook connections from Telegram (WEBHOOK_MAX_CONNECTIONS).")
+@click.option("--workers", type=int, help="Worker processes handling the updates, 0 to handle them in this process (WORKERS).")
+@click.option("--metrics-port", type=int, help="Port of the /metrics endpoint, 0 to disable it (METRICS_PORT).")
+@click.pass_context
+def main(ctx, mode, listen, port, path, webhook_url, secret_token, max_connections, workers, metrics_port):  # pylint: disable=too-many-arguments
     """
     Entrypoint of the app.
 
@@ -20,13 +34,68 @@ def main():
     ```bash
     python virus_total_telegram_bot/cli.py
     ```
+
+    The options take precedence over their environment variables.
     """
+    if ctx.invoked_subcommand is not None:
+        return
     logs_path = os.getenv("LOGS_PATH", "/tmp")              # nosec
     artifacts_path = os.getenv("ARTIFACTS_PATH", "/tmp")    # nosec
     config.create_application_directories(logs_path, artifacts_path)
     config.initialize_loggers(logs_path)
     cfg = config.load_configuration(artifacts_path, logs_path)
-    app.run(cfg)
+    options = {
+        "bot_mode": mode,
+        "webhook_listen": listen,
+        "webhook_port": port,
+        "webhook_path": path,
+        "webhook_url": webhook_url,
+        "webhook_secret_token": secret_token,
+        "webhook_max_connections": max_connections,
+        "workers": workers,
+        "metrics_port": metrics_port,
+    }
+    # validated again, so the options are checked like the environment
+    cfg = Config(**{**cfg.dict(), **{name: value for name, value in options.items() if value is not None}})
+    if cfg.workers:
+        workers_mode.run_ingress(cfg)
+    else:
+        app.run(cfg)
+
+
+@main.command()
+@click.option("--size", "sizes", type=int, multiple=True, help="Bytes of a file hashed, can be repeated.")
+@click.option("--repeat", type=int, default=5, show_default=True, help="Runs of every benchmark.")
+@click.option("--log-events", type=int, default=1000, show_default=True, help="Events logged per run.")
+@click.option("--output", type=click.Path(dir_okay=False, writable=True), help="File the JSON results are written to.")
+@click.option("--baseline", type=click.Path(exists=True, dir_okay=False), help="JSON results to compare with.")
+@click.option("--tolerance", type=float, default=0.1, show_default=True, help="Slowdown allowed against the baseline.")
+def bench(sizes, repeat, log_events, output, baseline, tolerance):  # pylint: disable=too-many-arguments
+    """
+    Run the microbenchmarks of the per-request hot paths and print their results as JSON.
+
+    With `--baseline`, the benchmarks slower than in the baseline by more than the tolerance are
+    reported and the command fails, so it can catch regressions between commits:
+
+    ```bash
+    python virus_total_telegram_bot/cli.py bench --output before.json
+    python virus_total_telegram_bot/cli.py bench --baseline before.json
+    ```
+    """
+    # imported here so the bot does not load the benchmarks
+    from virus_total_telegram_bot import bench as benchmarks  # pylint: disable=import-outside-toplevel
+
+    results = benchmarks.run_benchmarks(sizes or benchmarks.FILE_SIZES, repeat, log_events)
+    if baseline:
+        with open(baseline, encoding="utf-8") as f:
+            results["regressions"] = benchmarks.compare(results, json.load(f), tolerance)
+    rendered = json.dumps(results, indent=2)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(rendered + "\n")
+    click.echo(rendered)
+    if results.get("regressions"):
+        sys.exit(1)
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -1,9 +1,14 @@
 """
 Configuration file
 """
+import atexit
+import json
 import os
+import queue
+import random
 import sys
 import logging.config
+import logging.handlers
 
 from socket import gethostname
 from getpass import getuser
@@ -11,6 +16,7 @@ from getpass import getuser
 import structlog
 
 from virus_total_telegram_bot.entities import Config
+from virus_total_telegram_bot.metrics import REGISTRY, FunctionMetric
 
 
 def extract_from_record(_, __, event_dict):  # pylint: disable=invalid-name
@@ -66,6 +72,171 @@ def add_user(_, __, event_dict):  # pylint: disable=invalid-name
     return event_dict
 
 
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands the log records to a `logging.handlers.QueueListener`, whose thread formats and writes them.
+
+    Records are not formatted before they are queued, so the caller only pays for putting them in
+    the queue, and they are dropped (and counted) instead of blocking when the queue is full.
+    """
+
+    def __init__(self, record_queue: queue.Queue):
+        super().__init__(record_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord):
+        # the message of a structlog record is its event dict, rendered by the formatter of the listener
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _json_default(value):
+    return value.to_dict() if hasattr(value, "to_dict") else str(value)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Formats records whose message is a dict as one JSON document per line.
+    """
+
+    def format(self, record: logging.LogRecord):
+        return json.dumps(record.msg, default=_json_default)
+
+
+class LazyPayload():
+    """
+    A payload converted, rendered and truncated only when its record is formatted, which happens
+    in the thread of the logging queue listener.
+    """
+
+    __slots__ = ("payload", "max_length")
+
+    def __init__(self, payload, max_length: int):
+        self.payload = payload
+        self.max_length = max_length
+
+    def __structlog__(self):
+        payload = self.payload.to_dict() if hasattr(self.payload, "to_dict") else self.payload
+        rendered = json.dumps(payload, default=_json_default)
+        if len(rendered) <= self.max_length:
+            return payload
+        return truncate(rendered, self.max_length)
+
+    def __repr__(self):
+        return repr(self.__structlog__())
+
+
+def truncate(value: str, max_length: int):
+    """
+    Parameters:
+    -----------
+    - value: str
+    - max_length: int
+        The number of characters kept.
+
+    Returns:
+    --------
+    - truncated: str
+        The first `max_length` characters of the value and how many more there were.
+    """
+    return f"{value[:max_length]}... ({len(value) - max_length} more characters)"
+
+
+class PayloadProcessor():
+    """
+    Keeps the big payloads of the events, like the VirusTotal analyses, out of the hot path.
+
+    Only a `sample_rate` fraction of the payloads is logged, and the rest are replaced with their
+    id. A logged payload is converted with its `to_dict` method, if it has one, rendered as JSON and
+    truncated to `max_length` characters by the thread writing the logs, not by the caller. When
+    there is an `archive` logger, the whole payloads are sent to it instead of being logged. Any
+    other string longer than `max_length` is truncated as well.
+    """
+
+    def __init__(self, fields: tuple, max_length: int, sample_rate: float, archive: logging.Logger = None):
+        """
+        Parameters:
+        -----------
+        - fields: tuple
+            The names of the payload fields.
+        - max_length: int
+            The maximum number of characters of a logged value.
+        - sample_rate: float
+            The fraction of the payloads logged, between 0 and 1.
+        - archive: logging.Logger object
+            The logger the whole payloads are sent to, if any.
+        """
+        self.fields = fields
+        self.max_length = max_length
+        self.sample_rate = sample_rate
+        self.archive = archive
+
+    def __call__(self, _, __, event_dict):
+        for field in self.fields:
+            if field not in event_dict:
+                continue
+            payload = event_dict[field]
+            payload_id = payload.get("id") if isinstance(payload, dict) else getattr(payload, "id", None)
+            if self.archive is not None:
+                self.archive.info({
+                    "timestamp": event_dict.get("timestamp"), "event": event_dict.get("event"),
+                    "request_id": event_dict.get("request_id"), field: payload
+                })
+                event_dict[field] = {"id": payload_id, "archived": True}
+            elif self.sample_rate < 1 and random.random() >= self.sample_rate:  # nosec
+                event_dict[field] = {"id": payload_id, "sampled": False}
+            else:
+                event_dict[field] = LazyPayload(payload, self.max_length)
+        for key, value in event_dict.items():
+            if isinstance(value, str) and len(value) > self.max_length:
+                event_dict[key] = truncate(value, self.max_length)
+        return event_dict
+
+
+_queue_handlers = []
+
+
+def dropped_log_records():
+    """
+    Returns:
+    --------
+    - dropped: int
+        The log records dropped because the queue of their handler was full.
+    """
+    return sum(handler.dropped for handler in _queue_handlers)
+
+
+def _queue_handler(handler: logging.Handler, queue_size: int):
+    """
+    Move a handler to a background thread.
+
+    Parameters:
+    -----------
+    - handler: logging.Handler object
+        The handler formatting and writing the records.
+    - queue_size: int
+        The maximum number of records waiting to be written.
+
+    Returns:
+    --------
+    - queue_handler: AsyncQueueHandler object
+        The handler to attach to the loggers instead of `handler`.
+    """
+    record_queue = queue.Queue(maxsize=queue_size)
+    listener = logging.handlers.QueueListener(record_queue, handler, respect_handler_level=True)
+    listener.start()
+    # the records still queued are written when the process exits
+    atexit.register(listener.stop)
+    queue_handler = AsyncQueueHandler(record_queue)
+    _queue_handlers.append(queue_handler)
+    return queue_handler
+
+
 def _initialize_logging(log_cfg: dict, user_processors=tuple()):
     """
     Initialize logging.
@@ -90,11 +261,13 @@ def _initialize_logging(log_cfg: dict, user_processors=tuple()):
 
     if not structlog.is_configured():
         structlog.configure(
-            processors=processors
+            # events below the level of the loggers are dropped before any other processor runs
+            processors=[structlog.stdlib.filter_by_level]
+            + processors
             + list(user_processors)
             + [structlog.stdlib.ProcessorFormatter.wrap_for_formatter],
             logger_factory=structlog.stdlib.LoggerFactory(),
-            context_class=structlog.threadlocal.wrap_dict(dict),
+            context_class=dict,
             wrapper_class=structlog.stdlib.BoundLogger,
         )
 
@@ -120,10 +293,37 @@ def _initialize_logging(log_cfg: dict, user_processors=tuple()):
 
     level = logging.getLevelName(log_cfg["log_level"])
     logger = logging.getLogger(log_cfg["log_name"])
-    logger.addHandler(handler)
+    logger.addHandler(_queue_handler(handler, log_cfg["log_queue_size"]))
     logger.setLevel(level)
 
 
+def _initialize_archive(archive_cfg: dict):
+    """
+    Initialize the logger the whole payloads of the events are archived to, as JSON lines.
+
+    Parameters:
+    -----------
+    - archive_cfg: dict
+        The archive configuration.
+
+    Returns:
+    --------
+    - archive: logging.Logger object
+    """
+    os.makedirs(archive_cfg["archive_folder"], exist_ok=True)
+    handler = logging.handlers.RotatingFileHandler(
+        filename=os.path.join(archive_cfg["archive_folder"], archive_cfg["archive_filename"]),
+        maxBytes=archive_cfg["archive_max_bytes"],
+        backupCount=archive_cfg["archive_backup_count"]
+    )
+    handler.setFormatter(JsonLinesFormatter())
+    archive = logging.getLogger(archive_cfg["archive_name"])
+    archive.propagate = False
+    archive.addHandler(_queue_handler(handler, archive_cfg["log_queue_size"]))
+    archive.setLevel(logging.INFO)
+    return archive
+
+
 def initialize_loggers(logs_path: str):
     """
     Load the loggers
@@ -133,11 +333,24 @@ def initialize_loggers(logs_path: str):
     - logs_path: str
       The path where the log files are going to be stored.
     """
+    LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))                  # pylint: disable=invalid-name
+    LOG_PAYLOAD_MAX_LENGTH = int(os.getenv("LOG_PAYLOAD_MAX_LENGTH", "4096"))   # pylint: disable=invalid-name
+    LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "1"))  # pylint: disable=invalid-name
+    ANALYSES_PATH = os.getenv("ANALYSES_PATH")                                  # pylint: disable=invalid-name
+    archive_config = {
+        "archive_name": "virus_total_telegram_bot.analyses",
+        "archive_folder": ANALYSES_PATH,
+        "archive_filename": "analyses.jsonl",
+        "archive_max_bytes": 10485760,
+        "archive_backup_count": 10,
+        "log_queue_size": LOG_QUEUE_SIZE
+    }
     console_config = {
         "log_name": "",
         "log_format": "console",
         "log_level": "DEBUG",
-        "log_handler": "stdout"
+        "log_handler": "stdout",
+        "log_queue_size": LOG_QUEUE_SIZE
     }
     file_config = {
         "log_name": "",
@@ -147,12 +360,24 @@ def initialize_loggers(logs_path: str):
         "log_backup_count": 10,
         "log_folder": logs_path,
         "log_filename": "siren_scoop.log",
-        "log_level": "INFO"
+        "log_level": "INFO",
+        "log_queue_size": LOG_QUEUE_SIZE
     }
 
-    _initialize_logging(console_config)
+    archive = _initialize_archive(archive_config) if ANALYSES_PATH else None
+    payload_processor = PayloadProcessor(
+        fields=("analysis",),
+        max_length=LOG_PAYLOAD_MAX_LENGTH,
+        sample_rate=LOG_PAYLOAD_SAMPLE_RATE,
+        archive=archive
+    )
+    _initialize_logging(console_config, user_processors=(payload_processor,))
     if os.getenv("PRODUCTION", "false").lower() == "true":
-        _initialize_logging(file_config)
+        _initialize_logging(file_config, user_processors=(payload_processor,))
+    REGISTRY.register(FunctionMetric(
+        "vt_bot_log_records_dropped_total", "Log records dropped because the logging queue was full.",
+        "counter", dropped_log_records
+    ))
 
 
 def create_application_directories(logs_path: str, artifacts_path: str):
@@ -194,12 +419,96 @@ def load_configuration(artifacts_path: str, logs_file_path: str):
 
     VIRUS_TOTAL_BOT_APIKEY = os.getenv("VIRUS_TOTAL_BOT_APIKEY")    # pylint: disable=invalid-name
     VIRUS_TOTAL_APIKEY = os.getenv("VIRUS_TOTAL_APIKEY")            # pylint: disable=invalid-name
+    BOT_API_URL = os.getenv("BOT_API_URL", "https://api.telegram.org/bot")  # pylint: disable=invalid-name
+    BOT_API_FILE_URL = os.getenv("BOT_API_FILE_URL", "https://api.telegram.org/file/bot")  # pylint: disable=invalid-name
+    VT_API_URL = os.getenv("VT_API_URL", "https://www.virustotal.com")     # pylint: disable=invalid-name
+    BOT_MODE = os.getenv("BOT_MODE", "polling")                     # pylint: disable=invalid-name
+    MAX_CONCURRENT_UPDATES = os.getenv("MAX_CONCURRENT_UPDATES", "16")      # pylint: disable=invalid-name
+    WORKERS = os.getenv("WORKERS", "0")                             # pylint: disable=invalid-name
+    QUEUE_VISIBILITY_TIMEOUT = os.getenv("QUEUE_VISIBILITY_TIMEOUT", "60")  # pylint: disable=invalid-name
+    QUEUE_MAX_ATTEMPTS = os.getenv("QUEUE_MAX_ATTEMPTS", "3")       # pylint: disable=invalid-name
+    METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")      # pylint: disable=invalid-name
+    METRICS_PORT = os.getenv("METRICS_PORT", "0")                   # pylint: disable=invalid-name
+    WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")         # pylint: disable=invalid-name  # nosec
+    WEBHOOK_PORT = os.getenv("WEBHOOK_PORT", "8443")                # pylint: disable=invalid-name
+    WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "")                    # pylint: disable=invalid-name
+    WEBHOOK_URL = os.getenv("WEBHOOK_URL")                          # pylint: disable=invalid-name
+    WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")        # pylint: disable=invalid-name
+    WEBHOOK_MAX_CONNECTIONS = os.getenv("WEBHOOK_MAX_CONNECTIONS", "40")    # pylint: disable=invalid-name
+    TELEGRAM_MESSAGES_PER_SECOND = os.getenv("TELEGRAM_MESSAGES_PER_SECOND", "30")              # pylint: disable=invalid-name
+    TELEGRAM_CHAT_MESSAGES_PER_MINUTE = os.getenv("TELEGRAM_CHAT_MESSAGES_PER_MINUTE", "20")    # pylint: disable=invalid-name
+    TELEGRAM_MAX_RETRIES = os.getenv("TELEGRAM_MAX_RETRIES", "3")                               # pylint: disable=invalid-name
     FILES_MAX_SIZE = os.getenv("FILES_MAX_SIZE", "5")               # pylint: disable=invalid-name
+    MAX_JOBS_PER_USER = os.getenv("MAX_JOBS_PER_USER", "5")         # pylint: disable=invalid-name
+    DOWNLOADS_MAX_SIZE = os.getenv("DOWNLOADS_MAX_SIZE", "100")     # pylint: disable=invalid-name
+    FILE_REPORT_MAX_AGE = os.getenv("FILE_REPORT_MAX_AGE", "24")    # pylint: disable=invalid-name
+    URL_REPORT_MAX_AGE = os.getenv("URL_REPORT_MAX_AGE", "24")      # pylint: disable=invalid-name
+    CACHE_MAX_ENTRIES = os.getenv("CACHE_MAX_ENTRIES", "1024")      # pylint: disable=invalid-name
+    CACHE_POSITIVE_TTL = os.getenv("CACHE_POSITIVE_TTL", "24")      # pylint: disable=invalid-name
+    CACHE_NEGATIVE_TTL = os.getenv("CACHE_NEGATIVE_TTL", "6")       # pylint: disable=invalid-name
+    VT_CONNECTIONS_LIMIT = os.getenv("VT_CONNECTIONS_LIMIT", "10")  # pylint: disable=invalid-name
+    VT_KEEPALIVE_TIMEOUT = os.getenv("VT_KEEPALIVE_TIMEOUT", "60")  # pylint: disable=invalid-name
+    VT_REQUESTS_PER_MINUTE = os.getenv("VT_REQUESTS_PER_MINUTE", "4")   # pylint: disable=invalid-name
+    VT_REQUESTS_PER_DAY = os.getenv("VT_REQUESTS_PER_DAY", "500")       # pylint: disable=invalid-name
+    VT_KEY_EJECTION_TIME = os.getenv("VT_KEY_EJECTION_TIME", "300")     # pylint: disable=invalid-name
+    IN_MEMORY_DOWNLOADS = os.getenv("IN_MEMORY_DOWNLOADS", "false").lower() == "true"  # pylint: disable=invalid-name
+    IN_MEMORY_MAX_SIZE = os.getenv("IN_MEMORY_MAX_SIZE", "5")       # pylint: disable=invalid-name
+    ANALYSIS_POLL_INTERVAL = os.getenv("ANALYSIS_POLL_INTERVAL", "15")          # pylint: disable=invalid-name
+    ANALYSIS_POLL_BATCH_SIZE = os.getenv("ANALYSIS_POLL_BATCH_SIZE", "10")      # pylint: disable=invalid-name
+    ANALYSIS_MAX_AGE = os.getenv("ANALYSIS_MAX_AGE", "900")                     # pylint: disable=invalid-name
+    ANALYSIS_MAX_POLL_FAILURES = os.getenv("ANALYSIS_MAX_POLL_FAILURES", "5")   # pylint: disable=invalid-name
+    BATCH_MAX_CONCURRENCY = os.getenv("BATCH_MAX_CONCURRENCY", "10")            # pylint: disable=invalid-name
+    ARTIFACTS_MAX_SIZE = os.getenv("ARTIFACTS_MAX_SIZE", "1024")                # pylint: disable=invalid-name
+    ARTIFACTS_MAX_AGE = os.getenv("ARTIFACTS_MAX_AGE", "168")                   # pylint: disable=invalid-name
+    ARTIFACTS_GC_INTERVAL = os.getenv("ARTIFACTS_GC_INTERVAL", "600")           # pylint: disable=invalid-name
+    ARTIFACTS_GC_BATCH_SIZE = os.getenv("ARTIFACTS_GC_BATCH_SIZE", "100")       # pylint: disable=invalid-name
     config = Config(
         artifacts_path=artifacts_path,
         logs_path=logs_file_path,
         bot_apikey=VIRUS_TOTAL_BOT_APIKEY,
-        virus_total_apikey=VIRUS_TOTAL_APIKEY,
-        files_max_size=FILES_MAX_SIZE
+        bot_api_url=BOT_API_URL,
+        bot_api_file_url=BOT_API_FILE_URL,
+        bot_mode=BOT_MODE,
+        max_concurrent_updates=MAX_CONCURRENT_UPDATES,
+        workers=WORKERS,
+        queue_visibility_timeout=QUEUE_VISIBILITY_TIMEOUT,
+        queue_max_attempts=QUEUE_MAX_ATTEMPTS,
+        metrics_listen=METRICS_LISTEN,
+        metrics_port=METRICS_PORT,
+        webhook_listen=WEBHOOK_LISTEN,
+        webhook_port=WEBHOOK_PORT,
+        webhook_path=WEBHOOK_PATH,
+        webhook_url=WEBHOOK_URL,
+        webhook_secret_token=WEBHOOK_SECRET_TOKEN,
+        webhook_max_connections=WEBHOOK_MAX_CONNECTIONS,
+        telegram_messages_per_second=TELEGRAM_MESSAGES_PER_SECOND,
+        telegram_chat_messages_per_minute=TELEGRAM_CHAT_MESSAGES_PER_MINUTE,
+        telegram_max_retries=TELEGRAM_MAX_RETRIES,
+        virus_total_apikeys=[apikey.strip() for apikey in (VIRUS_TOTAL_APIKEY or "").split(",") if apikey.strip()],
+        vt_api_url=VT_API_URL,
+        files_max_size=FILES_MAX_SIZE,
+        max_jobs_per_user=MAX_JOBS_PER_USER,
+        downloads_max_size=DOWNLOADS_MAX_SIZE,
+        file_report_max_age=FILE_REPORT_MAX_AGE,
+        url_report_max_age=URL_REPORT_MAX_AGE,
+        cache_max_entries=CACHE_MAX_ENTRIES,
+        cache_positive_ttl=CACHE_POSITIVE_TTL,
+        cache_negative_ttl=CACHE_NEGATIVE_TTL,
+        vt_connections_limit=VT_CONNECTIONS_LIMIT,
+        vt_keepalive_timeout=VT_KEEPALIVE_TIMEOUT,
+        vt_requests_per_minute=VT_REQUESTS_PER_MINUTE,
+        vt_requests_per_day=VT_REQUESTS_PER_DAY,
+        vt_key_ejection_time=VT_KEY_EJECTION_TIME,
+        in_memory_downloads=IN_MEMORY_DOWNLOADS,
+        in_memory_max_size=IN_MEMORY_MAX_SIZE,
+        analysis_poll_interval=ANALYSIS_POLL_INTERVAL,
+        analysis_poll_batch_size=ANALYSIS_POLL_BATCH_SIZE,
+        analysis_max_age=ANALYSIS_MAX_AGE,
+        analysis_max_poll_failures=ANALYSIS_MAX_POLL_FAILURES,
+        batch_max_concurrency=BATCH_MAX_CONCURRENCY,
+        artifacts_max_size=ARTIFACTS_MAX_SIZE,
+        artifacts_max_age=ARTIFACTS_MAX_AGE,
+        artifacts_gc_interval=ARTIFACTS_GC_INTERVAL,
+        artifacts_gc_batch_size=ARTIFACTS_GC_BATCH_SIZE
     )
     return config
@@ -1,7 +1,9 @@
 """
 All the entities needed for the bot. Here you will find all data structires.
 """
-from pydantic import BaseModel  # pylint: disable=no-name-in-module
+from typing import List, Literal, Optional
+
+from pydantic import BaseModel, root_validator, validator  # pylint: disable=no-name-in-module
 
 
 class Config(BaseModel):
@@ -11,5 +13,62 @@ class Config(BaseModel):
     artifacts_path: str
     logs_path: str
     bot_apikey: str
-    virus_total_apikey: str
+    bot_api_url: str
+    bot_api_file_url: str
+    max_concurrent_updates: int
+    workers: int
+    queue_visibility_timeout: int
+    queue_max_attempts: int
+    bot_mode: Literal["polling", "webhook"]
+    metrics_listen: str
+    metrics_port: int
+    webhook_listen: str
+    webhook_port: int
+    webhook_path: str
+    webhook_url: Optional[str]
+    webhook_secret_token: Optional[str]
+    webhook_max_connections: int
+    telegram_messages_per_second: int
+    telegram_chat_messages_per_minute: int
+    telegram_max_retries: int
+    virus_total_apikeys: List[str]
+    vt_api_url: str
     files_max_size: int
+    max_jobs_per_user: int
+    downloads_max_size: int
+    file_report_max_age: int
+    url_report_max_age: int
+    cache_max_entries: int
+    cache_positive_ttl: int
+    cache_negative_ttl: int
+    vt_connections_limit: int
+    vt_keepalive_timeout: int
+    vt_requests_per_minute: int
+    vt_requests_per_day: int
+    vt_key_ejection_time: int
+    in_memory_downloads: bool
+    in_memory_max_size: int
+    analysis_poll_interval: int
+    analysis_poll_batch_size: int
+    analysis_max_age: int
+    analysis_max_poll_failures: int
+    batch_max_concurrency: int
+    artifacts_max_size: int
+    artifacts_max_age: int
+    artifacts_gc_interval: int
+    artifacts_gc_batch_size: int
+
+    @validator('virus_total_apikeys')
+    def at_least_one_apikey(cls, apikeys):  # pylint: disable=no-self-argument
+        """The bot cannot call VirusTotal without a key"""
+        if not apikeys:
+            raise ValueError("VIRUS_TOTAL_APIKEY must have at least one key")
+        return apikeys
+
+    @root_validator(skip_on_failure=True)
+    def budgets_split_between_workers(cls, values):  # pylint: disable=no-self-argument
+        """Every worker takes a share of these budgets, which cannot be less than one"""
+        for budget in ("telegram_messages_per_second", "vt_requests_per_minute", "vt_requests_per_day", "downloads_max_size"):
+            if values["workers"] > values[budget]:
+                raise ValueError(f"{budget} ({values[budget]}) cannot be split between {values['workers']} workers")
+        return values
@@ -0,0 +1,354 @@
+"""
+Background analysis jobs.
+
+Handlers submit the analyses that VirusTotal has not finished yet and reply right away. A single
+scheduler owned by the application polls all the pending analyses in batches and resolves the
+jobs waiting for them when they complete, or fails them when they take too long.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+
+import structlog
+import vt
+
+from virus_total_telegram_bot.utils import current_milliseconds
+
+
+logger = structlog.get_logger()
+
+
+class JobStatus():
+    """
+    Status of a job, following the status of its VirusTotal analysis
+    """
+    QUEUED = "queued"
+    RUNNING = "running"
+
+
+class AnalysisTimeout(Exception):
+    """
+    An analysis that did not complete in time, or that could not be polled too many times in a row
+    """
+
+    def __init__(self, analysis_id: str, reason: str):
+        super().__init__(f"analysis {analysis_id} timed out: {reason}")
+        self.analysis_id = analysis_id
+        self.reason = reason
+
+
+class Job():
+    """
+    A request whose analysis is being waited for in the background
+    """
+
+    def __init__(self, request_id: str, user_id: int, chat_id: int, action: str, target: str, message_id: int = None):
+        """
+        Parameters:
+        -----------
+        - request_id: str
+            The id of the request that submitted the job.
+        - user_id: int
+            The telegram id of the user that sent the request.
+        - chat_id: int
+            The chat the results are sent to.
+        - action: str
+            The action of the request (`text` or `file`).
+        - target: str
+            The URL or the name of the file being analyzed.
+        - message_id: int
+            The progress message of the request, edited with the results.
+        """
+        self.request_id = request_id
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.action = action
+        self.target = target
+        self.message_id = message_id
+        self.status = JobStatus.QUEUED
+        self.start_time = current_milliseconds()
+        self.analysis_id = None
+
+    def to_dict(self):
+        """
+        Returns:
+        --------
+        - job: dict
+            The job, serializable to JSON, to be resumed with `from_dict` by another process.
+        """
+        return {
+            "request_id": self.request_id, "user_id": self.user_id, "chat_id": self.chat_id, "action": self.action,
+            "target": self.target, "message_id": self.message_id, "start_time": self.start_time,
+            "analysis_id": self.analysis_id,
+        }
+
+    @classmethod
+    def from_dict(cls, job: dict):
+        """
+        Parameters:
+        -----------
+        - job: dict
+            A job as returned by `to_dict`.
+
+        Returns:
+        --------
+        - job: Job object
+        """
+        fields = dict(job)
+        start_time = fields.pop("start_time")
+        analysis_id = fields.pop("analysis_id")
+        job = cls(**fields)
+        job.start_time = start_time
+        job.analysis_id = analysis_id
+        return job
+
+
+class PendingAnalysis():
+    """
+    An analysis not completed yet, with the jobs waiting for it
+    """
+
+    def __init__(self, analysis_id: str, key: str = None):
+        self.analysis_id = analysis_id
+        self.key = key
+        self.jobs = []
+        self.futures = []
+        self.submitted_at = time.monotonic()
+        self.failures = 0
+
+
+class AnalysisScheduler():
+    """
+    Polls every pending VirusTotal analysis from one loop, instead of one sleeping coroutine per request.
+
+    An analysis is given up with an `AnalysisTimeout` when it is still pending after `max_age`
+    seconds or when `max_failures` polls in a row fail, so it stops taking the quota and its users
+    get an answer.
+    """
+
+    def __init__(self, client: vt.Client, poll_interval: int, batch_size: int, max_age: int = 900, max_failures: int = 5):
+        """
+        Parameters:
+        -----------
+        - client: vt.Client object
+            The client used to poll the analyses.
+        - poll_interval: int
+            Seconds between two polling rounds.
+        - batch_size: int
+            The maximum number of analyses polled in each round.
+        - max_age: int
+            Seconds an analysis is waited for.
+        - max_failures: int
+            The number of polls in a row an analysis can fail.
+        """
+        self.client = client
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.max_failures = max_failures
+        self._pending = OrderedDict()
+        self._keys = {}
+        self._task = None
+
+    def submit(self, job: Job, analysis: vt.object.Object, key: str = None):
+        """
+        Wait in the background for an analysis to complete.
+
+        Parameters:
+        -----------
+        - job: Job object
+            The job waiting for the analysis.
+        - analysis: vt.object.Object object
+            The analysis returned by VirusTotal when the URL or the file was submitted.
+        - key: str
+            The key of the analyzed URL or file, so later jobs for it can `join` this analysis.
+
+        Returns:
+        --------
+        - future: asyncio.Future
+            Resolved with the completed analysis.
+        """
+        pending = self._pending.get(analysis.id)
+        if pending is None:
+            pending = self._pending[analysis.id] = PendingAnalysis(analysis.id, key)
+            if key is not None:
+                self._keys[key] = analysis.id
+        return self._add_job(pending, job)
+
+    def join(self, key: str, job: Job):
+        """
+        Wait for the pending analysis of a URL or file, if there is one.
+
+        Parameters:
+        -----------
+        - key: str
+            The key of the analyzed URL or file.
+        - job: Job object
+            The job waiting for the analysis.
+
+        Returns:
+        --------
+        - future: asyncio.Future or None
+            Resolved with the completed analysis, or None if nothing is pending for the key.
+        """
+        analysis_id = self._keys.get(key)
+        if analysis_id is None:
+            return None
+        return self._add_job(self._pending[analysis_id], job)
+
+    def resume(self, job: Job, key: str = None):
+        """
+        Wait again for the analysis of a job submitted by another process that stopped before it
+        completed. The analysis is as old as the job.
+
+        Parameters:
+        -----------
+        - job: Job object
+            The job, with the id of its analysis.
+        - key: str
+            The key of the analyzed URL or file.
+
+        Returns:
+        --------
+        - future: asyncio.Future
+            Resolved with the completed analysis.
+        """
+        future = self.join(key, job) if key is not None else None
+        if future is not None:
+            return future
+        future = self.submit(job, vt.Object("analysis", job.analysis_id), key)
+        age = max(0, current_milliseconds() - job.start_time) / 1000
+        pending = self._pending[job.analysis_id]
+        pending.submitted_at = min(pending.submitted_at, time.monotonic() - age)
+        return future
+
+    def jobs(self):
+        """
+        Returns:
+        --------
+        - jobs: list
+            All the jobs waiting for an analysis, oldest first.
+        """
+        return [job for pending in self._pending.values() for job in pending.jobs]
+
+    def user_jobs(self, user_id: int):
+        """
+        Parameters:
+        -----------
+        - user_id: int
+            The telegram id of a user.
+
+        Returns:
+        --------
+        - jobs: int
+            The number of jobs of the user waiting for an analysis.
+        """
+        return sum(1 for job in self.jobs() if job.user_id == user_id)
+
+    def counters(self):
+        """
+        Returns:
+        --------
+        - counters: dict
+            The number of queued and running jobs.
+        """
+        jobs = self.jobs()
+        return {
+            JobStatus.QUEUED: sum(1 for job in jobs if job.status == JobStatus.QUEUED),
+            JobStatus.RUNNING: sum(1 for job in jobs if job.status == JobStatus.RUNNING),
+        }
+
+    async def start(self):
+        """Start the polling loop"""
+        self._task = asyncio.create_task(self._poll_forever())
+
+    async def stop(self):
+        """Stop the polling loop and cancel the jobs still waiting"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for pending in self._pending.values():
+            for future in pending.futures:
+                future.cancel()
+        self._pending.clear()
+        self._keys.clear()
+
+    async def poll(self):
+        """
+        Poll the analyses that have waited the longest since their last poll, up to the batch size,
+        after giving up the ones pending for longer than the maximum age.
+        """
+        now = time.monotonic()
+        for pending in list(self._pending.values()):
+            if now - pending.submitted_at > self.max_age:
+                self._fail(pending.analysis_id, AnalysisTimeout(pending.analysis_id, "max_age"))
+        batch = list(self._pending)[:self.batch_size]
+        if not batch:
+            return
+        results = await asyncio.gather(
+            *(self.client.get_object_async('/analyses/{}', analysis_id) for analysis_id in batch),
+            return_exceptions=True
+        )
+        for analysis_id, result in zip(batch, results):
+            self._update(analysis_id, result)
+
+    def _add_job(self, pending: PendingAnalysis, job: Job):
+        future = asyncio.get_running_loop().create_future()
+        job.analysis_id = pending.analysis_id
+        pending.jobs.append(job)
+        pending.futures.append(future)
+        logger.info("job_submitted", request_id=job.request_id, analysis_id=pending.analysis_id)
+        return future
+
+    def _remove(self, analysis_id: str):
+        pending = self._pending.pop(analysis_id)
+        if pending.key is not None:
+            self._keys.pop(pending.key, None)
+        return pending
+
+    def _fail(self, analysis_id: str, error: Exception):
+        pending = self._remove(analysis_id)
+        if isinstance(error, AnalysisTimeout):
+            logger.warning("analysis_timeout", analysis_id=analysis_id, reason=error.reason, jobs=len(pending.jobs))
+        for future in pending.futures:
+            if not future.done():
+                future.set_exception(error)
+
+    async def _poll_forever(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.poll()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("analysis_poll", error=e)
+
+    def _update(self, analysis_id: str, result):
+        pending = self._pending.get(analysis_id)
+        if pending is None:
+            return
+        if isinstance(result, vt.error.APIError) and result.code == "NotFoundError":
+            self._fail(analysis_id, result)
+            return
+        if isinstance(result, Exception):
+            logger.warning("analysis_poll_failed", analysis_id=analysis_id, error=result)
+            pending.failures += 1
+            if pending.failures >= self.max_failures:
+                self._fail(analysis_id, AnalysisTimeout(analysis_id, "max_failures"))
+                return
+            self._pending.move_to_end(analysis_id)
+            return
+        pending.failures = 0
+        if result.status == "completed":
+            self._remove(analysis_id)
+            for future in pending.futures:
+                if not future.done():
+                    future.set_result(result)
+            return
+        if result.status == "in-progress":
+            for job in pending.jobs:
+                job.status = JobStatus.RUNNING
+        self._pending.move_to_end(analysis_id)
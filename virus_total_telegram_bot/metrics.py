@@ -0,0 +1,336 @@
+"""
+Metrics of the bot, exposed in the Prometheus text format over a local HTTP `/metrics` endpoint.
+
+Counters and histograms are updated where the events happen (requests served, background jobs
+served, calls to VirusTotal). The state of the services shared by the requests (caches, queues,
+budgets) is read from their `counters` when the metrics are scraped, so it costs nothing between
+two scrapes.
+"""
+import math
+
+import structlog
+from aiohttp import web
+
+
+logger = structlog.get_logger()
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def format_labels(labelnames: tuple, labelvalues: tuple):
+    """
+    Parameters:
+    -----------
+    - labelnames: tuple
+    - labelvalues: tuple
+
+    Returns:
+    --------
+    - labels: str
+        The labels as written in the Prometheus text format, empty if there are none.
+    """
+    if not labelnames:
+        return ""
+    pairs = []
+    for name, value in zip(labelnames, labelvalues):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value: float):
+    """The value of a sample as written in the Prometheus text format"""
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter():
+    """
+    A value that only goes up, one per combination of label values.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        """Add `amount` to the counter of the label values given"""
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        """The current value of the counter of the label values given"""
+        return self._values.get(tuple(str(labels[name]) for name in self.labelnames), 0)
+
+    def samples(self):
+        """
+        Returns:
+        --------
+        - samples: list
+            The name, label names, label values and value of every sample.
+        """
+        return [(self.name, self.labelnames, key, value) for key, value in self._values.items()]
+
+
+class Histogram():
+    """
+    Observations counted in cumulative buckets, one histogram per combination of label values.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        """Count an observation in the histogram of the label values given"""
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        counts = self._values.get(key)
+        if counts is None:
+            counts = self._values[key] = [[0] * len(self.buckets), 0.0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[0][index] += 1
+        counts[1] += value
+
+    def samples(self):
+        """
+        Returns:
+        --------
+        - samples: list
+            The name, label names, label values and value of every bucket, sum and count.
+        """
+        samples = []
+        for key, (buckets, total) in self._values.items():
+            for bound, count in zip(self.buckets, buckets):
+                samples.append((f"{self.name}_bucket", self.labelnames + ("le",), key + (format_value(bound),), count))
+            samples.append((f"{self.name}_sum", self.labelnames, key, total))
+            samples.append((f"{self.name}_count", self.labelnames, key, buckets[-1]))
+        return samples
+
+
+class FunctionMetric():
+    """
+    A counter or a gauge whose values are read from a function every time the metrics are scraped.
+    """
+
+    def __init__(self, name: str, documentation: str, kind: str, function, labelnames: tuple = ()):
+        """
+        Parameters:
+        -----------
+        - name: str
+        - documentation: str
+        - kind: str
+            `counter` or `gauge`.
+        - function: callable
+            Function without arguments returning the value, or a dict of values by label values
+            if there are label names.
+        - labelnames: tuple
+        """
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.function = function
+        self.labelnames = tuple(labelnames)
+
+    def samples(self):
+        """
+        Returns:
+        --------
+        - samples: list
+            The name, label names, label values and value of every sample.
+        """
+        values = self.function()
+        if not self.labelnames:
+            return [(self.name, (), (), values)]
+        return [
+            (self.name, self.labelnames, key if isinstance(key, tuple) else (key,), value)
+            for key, value in values.items()
+        ]
+
+
+class Registry():
+    """
+    The metrics exposed by a process, by name.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        """
+        Add a metric, replacing the one registered with the same name.
+
+        Returns:
+        --------
+        - metric: the metric registered
+        """
+        self._metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name: str):
+        """Remove the metric registered with a name, if any"""
+        self._metrics.pop(name, None)
+
+    def render(self):
+        """
+        Returns:
+        --------
+        - text: str
+            Every metric in the Prometheus text format.
+        """
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                samples = metric.samples()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.warning("metric_failed", metric=metric.name, error=e)
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labelnames, labelvalues, value in samples:
+                lines.append(f"{name}{format_labels(labelnames, labelvalues)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    "vt_bot_request_duration_seconds", "Time to serve a request, by action and result.", ("action", "result")
+))
+JOB_DURATION = REGISTRY.register(Histogram(
+    "vt_bot_job_duration_seconds", "Time from a request to the results of its background analysis, by action and result.",
+    ("action", "result")
+))
+STAGE_DURATION = REGISTRY.register(Histogram(
+    "vt_bot_stage_duration_seconds", "Time spent in every stage of a request, by action and stage.", ("action", "stage")
+))
+VT_CALLS = REGISTRY.register(Counter(
+    "vt_bot_virustotal_calls_total", "Calls to the VirusTotal API, by method.", ("method",)
+))
+VT_ERRORS = REGISTRY.register(Counter(
+    "vt_bot_virustotal_errors_total", "Calls to the VirusTotal API that failed, by method and error code.",
+    ("method", "code")
+))
+
+
+def add_service_metrics(registry: Registry, bot_data: dict):
+    """
+    Register the metrics read from the services of an application.
+
+    Only the services the application has are measured: the worker processes have no work
+    queue, and the ingress process of the multi-process mode has no VirusTotal client.
+
+    Parameters:
+    -----------
+    - registry: Registry object
+    - bot_data: dict
+        The `bot_data` of the application, holding its services.
+    """
+    def counter(name, documentation, function, labelnames=()):
+        registry.register(FunctionMetric(name, documentation, "counter", function, labelnames))
+
+    def gauge(name, documentation, function, labelnames=()):
+        registry.register(FunctionMetric(name, documentation, "gauge", function, labelnames))
+
+    if 'verdict_cache' in bot_data:
+        cache = bot_data['verdict_cache']
+        counter("vt_bot_verdict_cache_hits_total", "Verdict cache hits.", lambda: cache.counters()["hits"])
+        counter("vt_bot_verdict_cache_misses_total", "Verdict cache misses.", lambda: cache.counters()["misses"])
+        counter("vt_bot_verdict_cache_evictions_total", "Verdicts evicted from memory.", lambda: cache.counters()["evictions"])
+        gauge("vt_bot_verdict_cache_memory_entries", "Verdicts kept in memory.", lambda: cache.counters()["memory_entries"])
+    if 'vt_client' in bot_data:
+        client = bot_data['vt_client']
+        gauge("vt_bot_virustotal_queue_depth", "Calls to VirusTotal waiting for budget.", lambda: client.counters()["queue_depth"])
+        gauge(
+            "vt_bot_virustotal_remaining_requests", "VirusTotal budget left, by period.",
+            lambda: {"minute": client.counters()["remaining_per_minute"], "day": client.counters()["remaining_per_day"]},
+            ("period",)
+        )
+        gauge("vt_bot_virustotal_ejected_keys", "VirusTotal API keys left out.", lambda: client.counters()["ejected_keys"])
+    if 'analysis_scheduler' in bot_data:
+        scheduler = bot_data['analysis_scheduler']
+        gauge("vt_bot_jobs", "Background analyses being waited for, by status.", scheduler.counters, ("status",))
+    if 'update_serializer' in bot_data:
+        serializer = bot_data['update_serializer']
+        gauge("vt_bot_updates_in_flight", "Updates being handled.", lambda: serializer.counters()["running"])
+        gauge("vt_bot_update_keys_waiting", "Chats and users with updates being handled or waiting.",
+              lambda: serializer.counters()["keys"])
+    if 'admission_controller' in bot_data:
+        controller = bot_data['admission_controller']
+        gauge("vt_bot_requests_in_flight", "Admitted requests being handled.", lambda: controller.counters()["requests"])
+        gauge("vt_bot_downloads_in_flight_bytes", "Bytes of the files being downloaded.",
+              lambda: controller.counters()["inflight_size"])
+    if 'artifact_collector' in bot_data:
+        collector = bot_data['artifact_collector']
+        gauge("vt_bot_artifacts_bytes", "Bytes taken by the artifact store.", lambda: collector.counters()["footprint"])
+        counter("vt_bot_artifacts_reclaimed_bytes_total", "Bytes reclaimed by the artifact collector.",
+                lambda: collector.bytes_reclaimed)
+        counter("vt_bot_artifacts_removed_files_total", "Files removed by the artifact collector.",
+                lambda: collector.files_removed)
+    if 'telegram_limiter' in bot_data:
+        limiter = bot_data['telegram_limiter']
+        gauge("vt_bot_telegram_queue_depth", "Messages to Telegram waiting for budget.",
+              lambda: limiter.counters()["queue_depth"])
+        counter("vt_bot_telegram_retry_after_total", "Flood control errors answered by Telegram.",
+                lambda: limiter.counters()["retries"])
+    if 'work_queue' in bot_data:
+        queue = bot_data['work_queue']
+        gauge("vt_bot_queue_tasks", "Updates in the queue of the worker processes, by status.", queue.counters, ("status",))
+
+
+class MetricsServer():
+    """
+    Serves the metrics of a registry at `/metrics`.
+    """
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, registry: Registry, listen: str, port: int):
+        """
+        Parameters:
+        -----------
+        - registry: Registry object
+            The metrics served.
+        - listen: str
+            The address the server listens on.
+        - port: int
+            The port the server listens on.
+        """
+        self.registry = registry
+        self.listen = listen
+        self.port = port
+        self._runner = None
+
+    async def handle(self, request: web.Request):  # pylint: disable=unused-argument
+        """Render the metrics"""
+        return web.Response(body=self.registry.render().encode(), headers={"Content-Type": self.CONTENT_TYPE})
+
+    async def start(self):
+        """Start listening, or log why the metrics cannot be served"""
+        application = web.Application()
+        application.router.add_get("/metrics", self.handle)
+        self._runner = web.AppRunner(application, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, self.listen, self.port).start()
+        except OSError as e:
+            logger.error("metrics_server_failed", listen=self.listen, port=self.port, error=e)
+            await self.stop()
+            return
+        logger.info("metrics_server_started", listen=self.listen, port=self.port)
+
+    async def stop(self):
+        """Stop listening"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
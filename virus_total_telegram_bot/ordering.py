@@ -0,0 +1,121 @@
+"""
+Ordering of the updates handled concurrently.
+"""
+import asyncio
+import functools
+
+from telegram import Update
+
+
+class UpdateSerializer():
+    """
+    Handles the updates of different chats in parallel and the updates of the same chat one at a
+    time, in the order they arrived.
+
+    The application hands every update to its own task as soon as it arrives. The handlers wrapped
+    with `wrap` wait for the previous updates of their chat and of their user (so a user is answered
+    in order from every chat), which are served first come first served, and then for one
+    of the `max_concurrency` slots shared by all the chats. Updates waiting for their chat do not
+    take a slot, so a chat with a long backlog does not hold up the rest.
+    """
+
+    def __init__(self, max_concurrency: int):
+        """
+        Parameters:
+        -----------
+        - max_concurrency: int
+            The maximum number of updates handled at the same time.
+        """
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+        self._locks = {}
+        self._waiting = {}
+        self._running = 0
+
+    def wrap(self, callback):
+        """
+        Parameters:
+        -----------
+        - callback: callable
+            The coroutine function of a handler, taking the update and the context first.
+
+        Returns:
+        --------
+        - callback: callable
+            The same callback, serialized.
+        """
+        @functools.wraps(callback)
+        async def serialized(update: Update, context, *args, **kwargs):
+            return await self.run(update, callback(update, context, *args, **kwargs))
+        return serialized
+
+    async def run(self, update: Update, coroutine):
+        """
+        Run the coroutine handling an update after the previous updates of its chat and user.
+
+        Parameters:
+        -----------
+        - update: telegram.Update object
+        - coroutine: coroutine
+            The handling of the update.
+
+        Returns:
+        --------
+        - result: object
+            The result of the coroutine.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        keys = self.keys(update)
+        for key in keys:
+            self._waiting[key] = self._waiting.get(key, 0) + 1
+            self._locks.setdefault(key, asyncio.Lock())
+        acquired = []
+        try:
+            for key in keys:
+                await self._locks[key].acquire()
+                acquired.append(key)
+            async with self._semaphore:
+                self._running += 1
+                try:
+                    return await coroutine
+                finally:
+                    self._running -= 1
+        finally:
+            for key in acquired:
+                self._locks[key].release()
+            coroutine.close()
+            for key in keys:
+                self._waiting[key] -= 1
+                if not self._waiting[key]:
+                    del self._waiting[key]
+                    del self._locks[key]
+
+    @staticmethod
+    def keys(update: Update):
+        """
+        Parameters:
+        -----------
+        - update: telegram.Update object
+
+        Returns:
+        --------
+        - keys: list
+            The keys whose updates are handled in order: the chat and the user of the update.
+        """
+        keys = []
+        if update.effective_chat is not None:
+            keys.append(f"chat:{update.effective_chat.id}")
+        if update.effective_user is not None:
+            keys.append(f"user:{update.effective_user.id}")
+        return keys
+
+    def counters(self):
+        """
+        Returns:
+        --------
+        - counters: dict
+            The number of updates being handled and the number of chats and users with updates
+            being handled or waiting.
+        """
+        return {"running": self._running, "keys": len(self._waiting)}
@@ -0,0 +1,69 @@
+"""
+The single message through which a request tells its user how it is going.
+"""
+import structlog
+from telegram.error import BadRequest
+from telegram.ext import ExtBot
+
+from virus_total_telegram_bot.ratelimit import MessagePriority
+
+
+logger = structlog.get_logger()
+
+
+class ProgressMessage():
+    """
+    A message sent with the first text of a request and edited in place with the following ones,
+    ending with its results, so a request takes one message of the chat instead of one per stage.
+
+    If the message cannot be edited anymore (it was deleted, for instance), the text is sent in a
+    new message, which is edited from then on.
+    """
+
+    def __init__(self, bot: ExtBot, chat_id: int, message_id: int = None):
+        """
+        Parameters:
+        -----------
+        - bot: telegram.ext.ExtBot object
+            The bot of the application, whose rate limiter takes the priority of every text.
+        - chat_id: int
+            The chat the message is sent to.
+        - message_id: int
+            The message to edit, if it was already sent, like the one of a background job.
+        """
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = None
+
+    async def update(self, text: str, parse_mode: str = None, priority: int = MessagePriority.PROGRESS):
+        """
+        Show a text in the message, sending the message if it was not sent yet.
+
+        Parameters:
+        -----------
+        - text: str
+        - parse_mode: str
+            The parse mode of the text, if any.
+        - priority: int
+            The `MessagePriority` of the text, `MessagePriority.RESULTS` for the last one.
+        """
+        if text == self.text:
+            return
+        if self.message_id is not None:
+            try:
+                await self.bot.edit_message_text(
+                    chat_id=self.chat_id, message_id=self.message_id, text=text, parse_mode=parse_mode,
+                    rate_limit_args=priority
+                )
+                self.text = text
+                return
+            except BadRequest as e:
+                if "not modified" in e.message:
+                    self.text = text
+                    return
+                logger.warning("progress_message_not_edited", chat_id=self.chat_id, message_id=self.message_id, error=e)
+        message = await self.bot.send_message(
+            chat_id=self.chat_id, text=text, parse_mode=parse_mode, rate_limit_args=priority)
+        self.message_id = message.message_id
+        self.text = text
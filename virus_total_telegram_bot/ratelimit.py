@@ -0,0 +1,334 @@
+"""
+Rate limiting of the calls to the VirusTotal API, so the bot stays within the quota of its API key,
+and of the messages sent to Telegram, so the bot stays within its flood limits.
+"""
+import asyncio
+import contextvars
+import datetime
+import itertools
+import time
+from collections import OrderedDict, deque
+
+import structlog
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+
+logger = structlog.get_logger()
+
+quota_owner = contextvars.ContextVar("quota_owner", default=None)
+"""Who the VirusTotal calls made from the current context are queued for (the telegram user id)"""
+
+
+class TokenBucket():
+    """
+    Token bucket holding up to `capacity` tokens, refilled continuously over `period` seconds
+    """
+
+    def __init__(self, capacity: int, period: int):
+        """
+        Parameters:
+        -----------
+        - capacity: int
+            The maximum number of tokens.
+        - period: int
+            Seconds it takes to refill the whole bucket.
+        """
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def available(self):
+        """
+        Returns:
+        --------
+        - tokens: float
+            The number of tokens in the bucket.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def wait_time(self):
+        """
+        Returns:
+        --------
+        - seconds: float
+            Seconds until there is a whole token in the bucket.
+        """
+        return max(0.0, (1 - self.available()) / self.rate)
+
+    def take(self):
+        """Take a token from the bucket"""
+        self.available()
+        self.tokens -= 1
+
+
+class QuotaLimiter():
+    """
+    Limits the calls to the VirusTotal API to a per-minute and a per-day budget.
+
+    Calls over budget wait in a queue instead of failing. The queue is served round-robin between
+    owners (see `quota_owner`), so a user sending many requests at once does not starve the rest.
+    """
+
+    def __init__(self, per_minute: int, per_day: int):
+        """
+        Parameters:
+        -----------
+        - per_minute: int
+            The maximum number of calls per minute.
+        - per_day: int
+            The maximum number of calls per day.
+        """
+        self.buckets = (TokenBucket(per_minute, 60), TokenBucket(per_day, 24 * 3600))
+        self._queues = OrderedDict()
+        self._dispatcher = None
+
+    async def acquire(self):
+        """
+        Wait until a call can be made within the budget.
+        """
+        if not self._queues and self._wait_time() == 0:
+            self._take()
+            return
+        owner = quota_owner.get()
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(owner, deque()).append(future)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        logger.info("vt_quota_wait", owner=owner, **self.counters())
+        await future
+
+    def queue_depth(self):
+        """
+        Returns:
+        --------
+        - depth: int
+            The number of calls waiting for budget.
+        """
+        return sum(len(queue) for queue in self._queues.values())
+
+    def counters(self):
+        """
+        Returns:
+        --------
+        - counters: dict
+            The number of calls waiting and the remaining budget for the current minute and day.
+        """
+        minute_bucket, day_bucket = self.buckets
+        return {
+            "queue_depth": self.queue_depth(),
+            "remaining_per_minute": int(minute_bucket.available()),
+            "remaining_per_day": int(day_bucket.available()),
+        }
+
+    async def close(self):
+        """Stop serving the queue and cancel the calls still waiting"""
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for queue in self._queues.values():
+            for future in queue:
+                future.cancel()
+        self._queues.clear()
+
+    def _wait_time(self):
+        return max(bucket.wait_time() for bucket in self.buckets)
+
+    def _take(self):
+        for bucket in self.buckets:
+            bucket.take()
+
+    async def _dispatch(self):
+        while self._queues:
+            wait_time = self._wait_time()
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+                continue
+            owner, queue = next(iter(self._queues.items()))
+            future = queue.popleft()
+            if queue:
+                self._queues.move_to_end(owner)
+            else:
+                del self._queues[owner]
+            if future.done():
+                continue
+            self._take()
+            future.set_result(None)
+
+
+class MessagePriority():
+    """
+    Priority of a request to the Bot API, given as its `rate_limit_args`: the lower, the sooner it
+    is sent when requests are waiting. Requests without priority are replies.
+    """
+    RESULTS = 0
+    REPLY = 1
+    PROGRESS = 2
+
+
+class TelegramRateLimiter(BaseRateLimiter):
+    """
+    Limits the messages sent to Telegram to a global and a per-chat budget.
+
+    Messages over budget wait in a queue and the most urgent one (see `MessagePriority`) whose
+    chat has budget left is sent first, oldest first within a priority. When Telegram answers
+    with a flood control error, every message waits for the `retry_after` it asks for and the
+    message is sent again, up to `max_retries` times. Requests not sent to a chat, like
+    downloading a file, are not limited.
+    """
+
+    PRUNE_SIZE = 1024
+
+    def __init__(self, per_second: int, per_chat_per_minute: int, max_retries: int):
+        """
+        Parameters:
+        -----------
+        - per_second: int
+            The maximum number of messages per second to all chats.
+        - per_chat_per_minute: int
+            The maximum number of messages per minute to the same chat.
+        - max_retries: int
+            The maximum number of times a message is sent again after a flood control error.
+        """
+        self.bucket = TokenBucket(per_second, 1)
+        self.per_chat_per_minute = per_chat_per_minute
+        self.max_retries = max_retries
+        self.retries = 0
+        self._chats = {}
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._paused_until = 0.0
+        self._dispatcher = None
+
+    async def initialize(self):
+        """Nothing to initialize, the queue is served when messages wait in it"""
+
+    async def shutdown(self):
+        """Stop serving the queue and cancel the messages still waiting"""
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for _, _, _, future in self._waiting:
+            future.cancel()
+        self._waiting.clear()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):  # pylint: disable=too-many-arguments
+        """
+        Send a request to the Bot API within the budget.
+
+        Parameters:
+        -----------
+        - callback: callable
+            Coroutine function sending the request.
+        - args: tuple
+        - kwargs: dict
+            The arguments of `callback`.
+        - endpoint: str
+            The Bot API method.
+        - data: dict
+            The parameters of the request.
+        - rate_limit_args: int
+            The `MessagePriority` of the request, if any.
+
+        Returns:
+        --------
+        - result: the result of `callback`
+        """
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+        priority = MessagePriority.REPLY if rate_limit_args is None else rate_limit_args
+        attempt = 0
+        while True:
+            await self._acquire(chat_id, priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                attempt += 1
+                self.retries += 1
+                retry_after = e.retry_after
+                if isinstance(retry_after, datetime.timedelta):
+                    retry_after = retry_after.total_seconds()
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                logger.warning(
+                    "telegram_retry_after", endpoint=endpoint, chat_id=chat_id, retry_after=retry_after, attempt=attempt
+                )
+                if attempt > self.max_retries:
+                    raise
+
+    def queue_depth(self):
+        """
+        Returns:
+        --------
+        - depth: int
+            The number of messages waiting for budget.
+        """
+        return sum(1 for _, _, _, future in self._waiting if not future.done())
+
+    def counters(self):
+        """
+        Returns:
+        --------
+        - counters: dict
+            The number of messages waiting and of flood control errors.
+        """
+        return {"queue_depth": self.queue_depth(), "retries": self.retries}
+
+    async def _acquire(self, chat_id, priority: int):
+        chat = self._chat_bucket(chat_id)
+        if not self._waiting and self._wait_time(chat) == 0:
+            self._take(chat)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append((priority, next(self._sequence), chat_id, future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.PRUNE_SIZE:
+                # a full bucket is the same as a new one
+                self._chats = {chat: bucket for chat, bucket in self._chats.items() if bucket.available() < bucket.capacity}
+            bucket = self._chats[chat_id] = TokenBucket(self.per_chat_per_minute, 60)
+        return bucket
+
+    def _global_wait_time(self):
+        return max(self._paused_until - time.monotonic(), self.bucket.wait_time())
+
+    def _wait_time(self, chat: TokenBucket):
+        return max(self._global_wait_time(), chat.wait_time())
+
+    def _take(self, chat: TokenBucket):
+        self.bucket.take()
+        chat.take()
+
+    async def _dispatch(self):
+        while self._waiting:
+            wait_time = self._global_wait_time()
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+                continue
+            self._waiting = [entry for entry in self._waiting if not entry[3].done()]
+            ready = [entry for entry in self._waiting if self._chat_bucket(entry[2]).wait_time() == 0]
+            if not ready:
+                if self._waiting:
+                    await asyncio.sleep(min(self._chat_bucket(entry[2]).wait_time() for entry in self._waiting))
+                continue
+            entry = min(ready)
+            self._waiting.remove(entry)
+            self._take(self._chat_bucket(entry[2]))
+            entry[3].set_result(None)
@@ -0,0 +1,99 @@
+"""
+Context of the request being served.
+
+Every update is handled in its own task, so the request of a task is kept in a context variable:
+concurrent requests of the same user do not share it, and the background tasks created while
+serving a request inherit it.
+"""
+import contextvars
+import time
+
+
+SERVICE = "virus total telegram bot"
+INTEGRATOR = "clarriu97"
+
+
+class RequestContext():
+    """
+    The data of a request, logged as one flat record when the request is served.
+    """
+
+    __slots__ = (
+        "request_id", "action", "username", "user_id", "start_time", "started", "result", "end_time", "elapsed",
+        "flight_role", "file_name", "file_size", "file_hash", "file_id", "stages",
+    )
+
+    def __init__(self, request_id: str, action: str, username: str, user_id: int):
+        """
+        Parameters:
+        -----------
+        - request_id: str
+        - action: str
+            The action that the user sent to the bot.
+        - username: str
+            The username of the user that sent the message.
+        - user_id: int
+            The telegram id of the user that sent the message.
+        """
+        self.request_id = request_id
+        self.action = action
+        self.username = username
+        self.user_id = user_id
+        self.start_time = round(time.time() * 1000)
+        self.started = time.perf_counter()
+        self.result = None
+        self.end_time = None
+        self.elapsed = None
+        self.flight_role = None
+        self.file_name = None
+        self.file_size = None
+        self.file_hash = None
+        self.file_id = None
+        self.stages = None
+
+    def add_stage(self, name: str, seconds: float):
+        """
+        Add the time spent in a stage of the request.
+
+        Parameters:
+        -----------
+        - name: str
+            The name of the stage.
+        - seconds: float
+        """
+        if self.stages is None:
+            self.stages = {}
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def finish(self, result: str):
+        """
+        Record the result of the request and its elapsed milliseconds, measured with a monotonic clock.
+
+        Parameters:
+        -----------
+        - result: str
+            The `Results` value the request is served with.
+        """
+        self.result = result
+        self.end_time = round(time.time() * 1000)
+        self.elapsed = round((time.perf_counter() - self.started) * 1000)
+
+    def to_record(self):
+        """
+        Returns:
+        --------
+        - record: dict
+            The fields of the request that are set, with the milliseconds of every stage as
+            `stage_<name>`, and the service metadata.
+        """
+        record = {"service": SERVICE, "integrator": INTEGRATOR}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is not None and name not in ("started", "stages"):
+                record[name] = value
+        for name, seconds in (self.stages or {}).items():
+            record[f"stage_{name}"] = round(seconds * 1000, 3)
+        return record
+
+
+current_request = contextvars.ContextVar("current_request", default=None)
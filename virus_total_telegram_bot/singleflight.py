@@ -0,0 +1,72 @@
+"""
+Coalescing of identical concurrent calls.
+"""
+import asyncio
+
+
+class FlightRole():
+    """
+    Role of a call in its flight
+    """
+    LEADER = "leader"
+    FOLLOWER = "follower"
+
+
+class SingleFlight():
+    """
+    Runs a single call per key at a time.
+
+    The first caller of a key (the leader) runs the call, and every caller arriving for the same
+    key while it is in flight (the followers) waits for the leader's result instead of running
+    the call again.
+    """
+
+    def __init__(self):
+        self._flights = {}
+
+    async def do(self, key: str, function):
+        """
+        Run `function`, unless there is a call in flight for `key` already.
+
+        Parameters:
+        -----------
+        - key: str
+            The key identifying identical calls.
+        - function: callable
+            Coroutine function without arguments doing the call.
+
+        Returns:
+        --------
+        - result: tuple
+            The result of the call (or its exception raised) and the role of the caller,
+            a `FlightRole`.
+        """
+        flight = self._flights.get(key)
+        if flight is not None:
+            return await asyncio.shield(flight), FlightRole.FOLLOWER
+
+        flight = self._flights[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await function()
+        except asyncio.CancelledError:
+            flight.cancel()
+            raise
+        except Exception as e:
+            flight.set_exception(e)
+            # followers get the exception as well, this one is already raised to the leader
+            flight.exception()
+            raise
+        else:
+            flight.set_result(result)
+        finally:
+            del self._flights[key]
+        return result, FlightRole.LEADER
+
+    def in_flight(self):
+        """
+        Returns:
+        --------
+        - count: int
+            The number of keys with a call in flight.
+        """
+        return len(self._flights)
@@ -33,6 +33,14 @@ dialogs = {
             ENGLISH: "📊 Here are the results of the analysis for the domain %s:",
             SPANISH: "📊 Aquí están los resultados del análisis para el dominio %s:",
         },
+        "analyzing_batch": {
+            ENGLISH: "🔎 I am analyzing the %s URLs you sent me, I will send you back a summary when all of them are done...",
+            SPANISH: "🔎 Estoy analizando las %s URLs que me enviaste, te enviaré un resumen cuando terminen todas...",
+        },
+        "batch_results": {
+            ENGLISH: "📊 Here is the summary of the analysis for the %s URLs (malicious, suspicious, URL):",
+            SPANISH: "📊 Aquí está el resumen del análisis para las %s URLs (maliciosos, sospechosos, URL):",
+        },
     },
     "file_received": {
         "analyzing": {
@@ -58,4 +66,34 @@ dialogs = {
             SPANISH: "📊 Aquí están los resultados del análisis para el archivo %s:",
         },
     },
+    "quota_exceeded": {
+        ENGLISH: "🚦 I have run out of VirusTotal requests for now. Please, try again in a while.",
+        SPANISH: "🚦 Me he quedado sin peticiones de VirusTotal por ahora. Por favor, inténtalo de nuevo en un rato.",
+    },
+    "analysis_timeout": {
+        ENGLISH: "⌛ VirusTotal is taking too long to analyze %s. Please, send it to me again later.",
+        SPANISH: "⌛ VirusTotal está tardando demasiado en analizar %s. Por favor, vuelve a enviármelo más tarde.",
+    },
+    "too_many_jobs": {
+        ENGLISH: "⏳ You already have %s analyses in progress. Please, wait for their results before sending me more.",
+        SPANISH: "⏳ Ya tienes %s análisis en curso. Por favor, espera a sus resultados antes de enviarme más.",
+    },
+    "downloads_busy": {
+        ENGLISH: "🚦 I am downloading too many files right now. Please, send me yours again in a minute.",
+        SPANISH: "🚦 Estoy descargando demasiados archivos ahora mismo. Por favor, vuelve a enviarme el tuyo en un minuto.",
+    },
+    "status": {
+        "summary": {
+            ENGLISH: "📋 There are %s queued and %s running analyses.",
+            SPANISH: "📋 Hay %s análisis en cola y %s en curso.",
+        },
+        "quota": {
+            ENGLISH: "🧮 VirusTotal budget left: %s requests this minute and %s today, %s requests waiting.",
+            SPANISH: "🧮 Presupuesto de VirusTotal restante: %s peticiones este minuto y %s hoy, %s peticiones esperando.",
+        },
+        "job": {
+            ENGLISH: "⏳ %s: %s",
+            SPANISH: "⏳ %s: %s",
+        },
+    },
 }
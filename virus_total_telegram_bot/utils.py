@@ -1,22 +1,40 @@
 """
 Utils to be used around the bot
 """
-import os
+import asyncio
+import io
 import hashlib
+import re
 import time
+import urllib.parse
 import uuid
+from contextlib import contextmanager
 
 import structlog
 import vt
 
-from telegram import Update
+from telegram import Message, MessageEntity, Update
 from telegram.ext import CallbackContext
 
+from virus_total_telegram_bot.metrics import REQUEST_DURATION, STAGE_DURATION
+from virus_total_telegram_bot.ratelimit import quota_owner
+from virus_total_telegram_bot.requestcontext import RequestContext, current_request
 from virus_total_telegram_bot.strings import ENGLISH
 
 
 logger = structlog.get_logger()
 
+FILE_DIGESTS = ('md5', 'sha1', 'sha256')
+HASH_CHUNK_SIZE = 1024 * 1024
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+URL_PATTERN = re.compile(
+    r"\b(?:https?://)?(?:(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z]{2,63}|\d{1,3}(?:\.\d{1,3}){3})"
+    r"(?::\d{1,5})?(?:[/?#][^\s<>\"']*[^\s<>\"'.,;:!?)\]])?",
+    re.IGNORECASE
+)
+MESSAGE_MAX_LENGTH = 4000
+TRACKING_PARAMETERS = {'fbclid', 'gclid', 'dclid', 'msclkid', 'yclid', 'igshid', 'mc_cid', 'mc_eid', '_ga', '_hsenc', '_hsmi'}
+
 
 class Results():
     """
@@ -26,6 +44,10 @@ class Results():
     CANCELLED = "cancelled"
     ERROR = "error"
     FILE_TOO_BIG = "file_too_big"
+    QUEUED = "queued"
+    TOO_MANY_JOBS = "too_many_jobs"
+    DOWNLOADS_BUSY = "downloads_busy"
+    TIMEOUT = "timeout"
 
 
 def get_username(update: Update):
@@ -48,10 +70,13 @@ def get_username(update: Update):
     return username
 
 
-def request_arrived(update: Update, context: CallbackContext, action: str):
+def request_arrived(update: Update, context: CallbackContext, action: str):  # pylint: disable=unused-argument
     """
     Performs the configuration needed for every request that arrives.
 
+    The request gets its `RequestContext`, and its id and user are bound to every event logged
+    while it is served.
+
     Parameters:
     -----------
     - update: telegram.Update object
@@ -62,11 +87,20 @@ def request_arrived(update: Update, context: CallbackContext, action: str):
     username = get_username(update)
     user_id = get_user_id(update)
     request_id = str(uuid.uuid4())
-    context.user_data['request_id'] = request_id
-    context.user_data['username'] = username
-    context.user_data['id'] = user_id
-    add_request_arrived_data(context, action, username, user_id, request_id)
-    logger.info("request_arrived", action=action, username=username, user_id=user_id, request_id=request_id)
+    current_request.set(RequestContext(request_id, action, username, user_id))
+    quota_owner.set(user_id)
+    structlog.contextvars.bind_contextvars(request_id=request_id, user_id=user_id)
+    logger.info("request_arrived", action=action, username=username)
+
+
+def get_request():
+    """
+    Returns:
+    --------
+    - request: virus_total_telegram_bot.requestcontext.RequestContext object or None
+        The request being served by the current task.
+    """
+    return current_request.get()
 
 
 def get_user_id(update: Update):
@@ -105,45 +139,12 @@ def get_user_language(update: Update):  # pylint: disable=unused-argument
     return lang
 
 
-def add_request_arrived_data(context: CallbackContext, action: str, username: str, user_id: int, request_id: str):
+def add_file_data(file_name: str, file_size: int, file_hash: str, file_id: str):
     """
-    Add request arrived data and application metadata to the context.
+    Add file data to the request being served.
 
     Parameters:
     -----------
-    - context: telegram.ext.ContextTypes.DEFAULT_TYPE object
-    - action: str
-        The action that the user sent to the bot.
-    - username: str
-        The username of the user that sent the message.
-    - user_id: str
-        The telegram id of the user that sent the message.
-    """
-    context.user_data['event_info'] = {
-        "metadata": {
-            "service": "virus total telegram bot",
-            "integrator": "clarriu97"
-        },
-        "request": {
-            "action": action,
-            "username": username,
-            "user_id": user_id,
-            "result": None,
-            "request_id": request_id,
-            "start_time": current_milliseconds(),
-            "end_time": None,
-            "elapsed": None,
-        }
-    }
-
-
-def add_file_data(context: CallbackContext, file_name: str, file_size: int, file_hash: str, file_id: str):
-    """
-    Add file data to the context.
-
-    Parameters:
-    -----------
-    - context: telegram.ext.ContextTypes.DEFAULT_TYPE object
     - file_name: str
         The name of the file.
     - file_size: int
@@ -153,11 +154,45 @@ def add_file_data(context: CallbackContext, file_name: str, file_size: int, file
     - file_id: str
         The id that Telegram gives to the file.
     """
-    context.user_data['event_info']['file'] = {}
-    context.user_data['event_info']['file']['name'] = file_name
-    context.user_data['event_info']['file']['size'] = file_size
-    context.user_data['event_info']['file']['hash'] = file_hash
-    context.user_data['event_info']['file']['id'] = file_id
+    request = get_request()
+    request.file_name = file_name
+    request.file_size = file_size
+    request.file_hash = file_hash
+    request.file_id = file_id
+
+
+def add_flight_data(role: str):
+    """
+    Add to the request being served whether it submitted its URL or file to VirusTotal or reused
+    the submission of an identical request.
+
+    Parameters:
+    -----------
+    - role: str
+        The role of the request in its flight, a `FlightRole`.
+    """
+    get_request().flight_role = role
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Measure a stage of the request being served, with a monotonic clock.
+
+    The time spent in every stage is added up, so a stage run several times (like sending
+    messages) is counted once with its total time. The time of a request not spent in any stage
+    is `elapsed` minus the stages.
+
+    Parameters:
+    -----------
+    - name: str
+        The name of the stage.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        get_request().add_stage(name, time.perf_counter() - start)
 
 
 def current_milliseconds():
@@ -171,53 +206,289 @@ def current_milliseconds():
     return round(time.time() * 1000)
 
 
-def save_request_data(context: CallbackContext, result: str):
-    event_info = get_event_info(context)
-    end_time = current_milliseconds()
-    event_info['request']['end_time'] = end_time
-    elapsed = end_time - event_info['request']['start_time']
-    event_info['request']['elapsed'] = elapsed
-    event_info['request']['result'] = result
-
+def request_served(update: Update, context: CallbackContext, result: str):  # pylint: disable=unused-argument
+    """
+    Log the request being served as one `request_served` record and measure it, and unbind its
+    id and user from the events logged afterwards.
 
-def request_served(update: Update, context: CallbackContext, result: str, save_artifacts: bool = False):  # pylint: disable=unused-argument
-    """Request served function"""
-    if 'request_id' not in context.user_data:
+    Parameters:
+    -----------
+    - update: telegram.Update object
+    - context: telegram.ext.ContextTypes.DEFAULT_TYPE object
+    - result: str
+        The `Results` value the request is served with.
+    """
+    request = get_request()
+    if request is None:
         logger.warning('request_served_no_request_id')
         return
-    request_id = context.user_data['request_id']
-    save_request_data(context, result)
-    logger.info("request_served", request_id=request_id, user_data=context.user_data)
-    clear_user_data(context)
+    request.finish(result)
+    REQUEST_DURATION.observe(request.elapsed / 1000, action=request.action, result=result)
+    for name, seconds in (request.stages or {}).items():
+        STAGE_DURATION.observe(seconds, action=request.action, stage=name)
+    logger.info("request_served", **request.to_record())
+    current_request.set(None)
+    structlog.contextvars.unbind_contextvars("request_id", "user_id")
 
 
-def get_event_info(context: CallbackContext):
-    return context.user_data['event_info']
+def get_verdict_cache(context: CallbackContext):
+    return context.bot_data['verdict_cache']
 
 
-def clear_user_data(context: CallbackContext):
-    context.user_data.clear()
+def get_vt_client(context: CallbackContext):
+    return context.bot_data['vt_client']
 
 
-def parse_url_info(analysis: vt.object.Object):
+def get_analysis_scheduler(context: CallbackContext):
+    return context.bot_data['analysis_scheduler']
+
+
+def get_admission_controller(context: CallbackContext):
+    return context.bot_data['admission_controller']
+
+
+def get_artifact_store(context: CallbackContext):
+    return context.bot_data['artifact_store']
+
+
+def get_single_flight(context: CallbackContext):
+    return context.bot_data['single_flight']
+
+
+def get_analysis_stats(analysis: vt.object.Object):
     """
-    Parse the url info from the analysis object.
+    Get the engine stats from an analysis object or from a file/URL report.
+
+    Analyses returned by a scan keep the stats under `stats`, while the
+    reports of already known files and URLs keep them under `last_analysis_stats`.
 
     Parameters:
     -----------
     - analysis: vt.object.Object object
-        The analysis object returned by the VirusTotal API.
+        The analysis object or the file/URL report returned by the VirusTotal API.
+
+    Returns:
+    --------
+    - stats: dict
+        The number of engines per verdict.
+    """
+    attributes = analysis.to_dict()['attributes']
+    if 'stats' in attributes:
+        return attributes['stats']
+    return attributes['last_analysis_stats']
+
+
+def is_report_fresh(report: vt.object.Object, max_age: int):
+    """
+    Check whether the last analysis of a file/URL report is recent enough to be reused.
+
+    Parameters:
+    -----------
+    - report: vt.object.Object object
+        The file/URL report returned by the VirusTotal API.
+    - max_age: int
+        The maximum age of the last analysis, in hours.
+
+    Returns:
+    --------
+    - fresh: bool
+        True if the report has a last analysis younger than `max_age` hours.
+    """
+    attributes = report.to_dict()['attributes']
+    last_analysis_date = attributes.get('last_analysis_date')
+    if not last_analysis_date or 'last_analysis_stats' not in attributes:
+        return False
+    return time.time() - last_analysis_date <= max_age * 3600
+
+
+async def get_report(client: vt.Client, collection: str, object_id: str, max_age: int):
+    """
+    Look up the existing VirusTotal report of a file or URL.
+
+    Parameters:
+    -----------
+    - client: vt.Client object
+    - collection: str
+        The VirusTotal collection of the object (`files` or `urls`).
+    - object_id: str
+        The VirusTotal identifier of the object.
+    - max_age: int
+        The maximum age of the last analysis, in hours.
+
+    Returns:
+    --------
+    - report: vt.object.Object object or None
+        The report, or None if the object is unknown to VirusTotal or its
+        last analysis is older than `max_age` hours.
+    """
+    try:
+        report = await client.get_object_async(f'/{collection}/{{}}', object_id)
+    except vt.error.APIError as e:
+        if e.code == "NotFoundError":
+            logger.info("report_not_found", collection=collection, object_id=object_id)
+            return None
+        raise
+    if not is_report_fresh(report, max_age):
+        logger.info("report_outdated", collection=collection, object_id=object_id)
+        return None
+    logger.info("report_found", collection=collection, object_id=object_id)
+    return report
+
+
+async def get_file_report(client: vt.Client, file_sha256: str, max_age: int):
+    """
+    Look up the existing VirusTotal report of a file by its sha256 hash.
+
+    Parameters:
+    -----------
+    - client: vt.Client object
+    - file_sha256: str
+        The sha256 hash of the file.
+    - max_age: int
+        The maximum age of the last analysis, in hours.
+
+    Returns:
+    --------
+    - report: vt.object.Object object or None
+        The file report, or None if the file is unknown to VirusTotal or its
+        last analysis is older than `max_age` hours.
+    """
+    return await get_report(client, 'files', file_sha256, max_age)
+
+
+async def get_url_report(client: vt.Client, url: str, max_age: int):
+    """
+    Look up the existing VirusTotal report of a URL by its VirusTotal URL identifier.
+
+    Parameters:
+    -----------
+    - client: vt.Client object
+    - url: str
+        The URL, already canonicalized with `canonicalize_url`.
+    - max_age: int
+        The maximum age of the last analysis, in hours.
+
+    Returns:
+    --------
+    - report: vt.object.Object object or None
+        The URL report, or None if the URL is unknown to VirusTotal or its
+        last analysis is older than `max_age` hours.
+    """
+    return await get_report(client, 'urls', vt.url_id(url), max_age)
+
+
+def canonicalize_url(url: str):
+    """
+    Canonicalize a URL, so the different ways of writing the same URL share their VirusTotal
+    URL identifier, cache entries and reports.
+
+    The scheme defaults to http, scheme and host are lowercased, default ports, fragments and
+    tracking parameters are removed, and so is the trailing slash of the path. The rest of the
+    query is kept as it was written, since it can change the page that is scanned.
+
+    Parameters:
+    -----------
+    - url: str
+        The URL as sent by the user.
+
+    Returns:
+    --------
+    - url: str
+        The canonical URL.
+
+    Raises:
+    -------
+    - ValueError
+        If the text is not a valid URL, like a text with brackets around its host or with an
+        invalid port.
+    """
+    url = url.strip()
+    if '://' not in url:
+        url = f"http://{url}"
+    parts = urllib.parse.urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').rstrip('.')
+    if ':' in host:
+        host = f"[{host}]"
+    port = parts.port
+    netloc = host if port is None or DEFAULT_PORTS.get(scheme) == port else f"{host}:{port}"
+    if parts.username:
+        userinfo = parts.username if parts.password is None else f"{parts.username}:{parts.password}"
+        netloc = f"{userinfo}@{netloc}"
+    path = parts.path.rstrip('/') or '/'
+    query = '&'.join(
+        parameter for parameter in parts.query.split('&')
+        if not is_tracking_parameter(urllib.parse.unquote_plus(parameter.partition('=')[0]))
+    )
+    return urllib.parse.urlunsplit((scheme, netloc, path, query, ''))
+
+
+def is_tracking_parameter(name: str):
+    """
+    Check whether a query parameter is only used to track the visitor.
+
+    Parameters:
+    -----------
+    - name: str
+        The name of the query parameter.
+
+    Returns:
+    --------
+    - tracking: bool
+    """
+    name = name.lower()
+    return name.startswith('utm_') or name in TRACKING_PARAMETERS
+
+
+def extract_urls(message: Message):
+    """
+    Extract every URL and domain of a message.
+
+    The URLs and text links marked by Telegram in the entities of the message are used, and
+    the text is only scanned with `URL_PATTERN` when the message has none.
+
+    Parameters:
+    -----------
+    - message: telegram.Message object
+
+    Returns:
+    --------
+    - urls: list
+        The canonical URLs, without duplicates, in the order they appear in the message. The ones
+        that are not valid URLs are left out.
+    """
+    entities = message.parse_entities([MessageEntity.URL, MessageEntity.TEXT_LINK])
+    if entities:
+        found = [entity.url if entity.type == MessageEntity.TEXT_LINK else text for entity, text in entities.items()]
+    else:
+        found = URL_PATTERN.findall(message.text or '')
+    urls = []
+    for url in found:
+        try:
+            urls.append(canonicalize_url(url))
+        except ValueError as e:
+            logger.warning("invalid_url", url=url, error=e)
+    return list(dict.fromkeys(urls))
+
+
+def parse_url_info(stats: dict):
+    """
+    Parse the url info from the analysis stats.
+
+    Parameters:
+    -----------
+    - stats: dict
+        The number of engines per verdict, as returned by `get_analysis_stats`.
 
     Returns:
     --------
     - url_info: str
         The url info in a human readable format.
     """
-    analysis_dict = analysis.to_dict()
-    harmless = analysis_dict['attributes']['stats']['harmless']
-    malicious = analysis_dict['attributes']['stats']['malicious']
-    suspicious = analysis_dict['attributes']['stats']['suspicious']
-    undetected = analysis_dict['attributes']['stats']['undetected']
+    harmless = stats['harmless']
+    malicious = stats['malicious']
+    suspicious = stats['suspicious']
+    undetected = stats['undetected']
     url_info = (
         f"🟢 **Harmless**: {harmless}\n"
         f"🔴 **Malicious**: {malicious}\n"
@@ -227,26 +498,25 @@ def parse_url_info(analysis: vt.object.Object):
     return url_info
 
 
-def parse_file_info(analysis: vt.object.Object):
+def parse_file_info(stats: dict):
     """
-    Parse the file info from the analysis object.
+    Parse the file info from the analysis stats.
 
     Parameters:
     -----------
-    - analysis: vt.object.Object object
-        The analysis object returned by the VirusTotal API.
+    - stats: dict
+        The number of engines per verdict, as returned by `get_analysis_stats`.
 
     Returns:
     --------
     - file_info: str
         The file info in a human readable format.
     """
-    analysis_dict = analysis.to_dict()
-    harmless = analysis_dict['attributes']['stats']['harmless']
-    malicious = analysis_dict['attributes']['stats']['malicious']
-    suspicious = analysis_dict['attributes']['stats']['suspicious']
-    undetected = analysis_dict['attributes']['stats']['undetected']
-    type_unsupported = analysis_dict['attributes']['stats']['type-unsupported']
+    harmless = stats['harmless']
+    malicious = stats['malicious']
+    suspicious = stats['suspicious']
+    undetected = stats['undetected']
+    type_unsupported = stats['type-unsupported']
     file_info = (
         f"🟢 **Harmless**: {harmless}\n"
         f"🔴 **Malicious**: {malicious}\n"
@@ -257,6 +527,134 @@ def parse_file_info(analysis: vt.object.Object):
     return file_info
 
 
+def parse_batch_info(results: list):
+    """
+    Parse the results of a batch of URLs into a summary table, most detected URLs first.
+
+    Parameters:
+    -----------
+    - results: list
+        Tuples of URL and analysis stats, as returned by `get_analysis_stats`. The stats are
+        None for the URLs whose analysis failed.
+
+    Returns:
+    --------
+    - batch_info: list
+        The table in a human readable format, split in messages that fit in a Telegram message.
+    """
+    def sort_key(result):
+        url, stats = result
+        if stats is None:
+            return (1, 0, 0, url)
+        return (0, -stats['malicious'], -stats['suspicious'], url)
+
+    lines = []
+    for url, stats in sorted(results, key=sort_key):
+        url = url.replace('`', '%60')
+        if stats is None:
+            lines.append(f"⚪   -   - {url}")
+            continue
+        icon = "🔴" if stats['malicious'] else "🟡" if stats['suspicious'] else "🟢"
+        lines.append(f"{icon} {stats['malicious']:>3} {stats['suspicious']:>3} {url}")
+
+    batch_info = []
+    chunk = []
+    for line in lines:
+        if chunk and sum(len(chunk_line) + 1 for chunk_line in chunk) + len(line) > MESSAGE_MAX_LENGTH:
+            batch_info.append(chunk)
+            chunk = []
+        chunk.append(line)
+    if chunk:
+        batch_info.append(chunk)
+    return ["```\n" + "\n".join(chunk) + "\n```" for chunk in batch_info]
+
+
+class DownloadBuffer(io.BytesIO):
+    """
+    Bounded in-memory file a document is downloaded to and uploaded from, without touching the disk.
+
+    python-telegram-bot retrieves the whole document before writing it to the buffer, in one
+    piece, so the document is held twice in memory while it is written. What the buffer saves is
+    the round trip through the disk. It is hashed once downloaded, like a file on disk, with
+    `get_file_digests_async`.
+    """
+
+    def __init__(self, name: str, max_size: int):
+        """
+        Parameters:
+        -----------
+        - name: str
+            The name of the file, sent to VirusTotal on upload.
+        - max_size: int
+            The maximum number of bytes the buffer accepts.
+        """
+        super().__init__()
+        self.name = name
+        self.max_size = max_size
+
+    def write(self, b):
+        if self.tell() + len(b) > self.max_size:
+            raise ValueError(f"{self.name} does not fit in a buffer of {self.max_size} bytes")
+        return super().write(b)
+
+
+def get_file_digests(file_path, algorithms: tuple = FILE_DIGESTS, chunk_size: int = HASH_CHUNK_SIZE):
+    """
+    Get several digests of the file reading it only once, in chunks.
+
+    Memory usage is bounded by `chunk_size` whatever the size of the file.
+
+    Parameters:
+    -----------
+    - file_path: str or file object
+        The path of the file, or the file itself opened in binary mode, such as a `DownloadBuffer`.
+    - algorithms: tuple
+        The names of the hashlib algorithms to compute.
+    - chunk_size: int
+        The number of bytes read from the file at a time.
+
+    Returns:
+    --------
+    - digests: dict
+        The hex digest of the file for each algorithm.
+    """
+    if isinstance(file_path, str):
+        with open(file_path, 'rb') as f:
+            return get_file_digests(f, algorithms, chunk_size)
+    hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    file_path.seek(0)
+    while True:
+        read = file_path.readinto(buffer)
+        if not read:
+            break
+        for file_hash in hashes:
+            file_hash.update(view[:read])
+    return {algorithm: file_hash.hexdigest() for algorithm, file_hash in zip(algorithms, hashes)}
+
+
+async def get_file_digests_async(file_path, algorithms: tuple = FILE_DIGESTS):
+    """
+    Like `get_file_digests`, but hashing the file in a worker thread so the event loop keeps
+    serving other updates meanwhile.
+
+    Parameters:
+    -----------
+    - file_path: str or file object
+        The path of the file, or the file itself opened in binary mode.
+    - algorithms: tuple
+        The names of the hashlib algorithms to compute.
+
+    Returns:
+    --------
+    - digests: dict
+        The hex digest of the file for each algorithm.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, get_file_digests, file_path, algorithms)
+
+
 def get_file_sha256(file_path: str):
     """
     Get the file sha256 hash of the file.
@@ -271,28 +669,26 @@ def get_file_sha256(file_path: str):
     - sha256: str
         The sha256 hash of the file.
     """
-    with open(file_path, 'rb') as f:
-        sha256 = hashlib.sha256(f.read()).hexdigest()
-    return sha256
+    return get_file_digests(file_path, ('sha256',))['sha256']
 
 
-def get_user_id_artifacts_path(artifacts_path: str, user_id: str):
+def open_downloaded_file(buffer: DownloadBuffer, file_path: str):
     """
-    Get the path of the artifacts folder of the user.
+    Open a downloaded file to upload it, wherever it was downloaded.
 
     Parameters:
     -----------
-    - artifacts_path: str
-        The path of the artifacts folder.
-    - user_id: str
-        The telegram id of the user.
+    - buffer: DownloadBuffer or None
+        The buffer the file was downloaded to, if it was kept in memory.
+    - file_path: str or None
+        The path the file was downloaded to, if it was written to disk.
 
     Returns:
     --------
-    - user_id_artifacts_path: str
-        The path of the artifacts folder of the user.
+    - file: file object
+        The file, positioned at its beginning.
     """
-    user_id_artifacts_path = os.path.join(artifacts_path, user_id)
-    if not os.path.exists(user_id_artifacts_path):
-        os.makedirs(user_id_artifacts_path)
-    return user_id_artifacts_path
+    if buffer is not None:
+        buffer.seek(0)
+        return buffer
+    return open(file_path, 'rb')  # pylint: disable=consider-using-with
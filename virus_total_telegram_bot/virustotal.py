@@ -0,0 +1,221 @@
+"""
+VirusTotal clients shared by all the requests served by the bot.
+"""
+import time
+
+import aiohttp
+import structlog
+import vt
+from vt.client import _USER_AGENT_FMT
+from vt.version import __version__ as vt_version
+
+from virus_total_telegram_bot.metrics import VT_CALLS, VT_ERRORS
+from virus_total_telegram_bot.ratelimit import QuotaLimiter
+
+
+logger = structlog.get_logger()
+
+
+class VirusTotalClient(vt.Client):
+    """
+    Long-lived VirusTotal client.
+
+    It is created once when the bot starts and closed on shutdown, so every request reuses the
+    same aiohttp session and its pool of keep-alive connections instead of paying new TCP and TLS
+    handshakes.
+
+    Every call to the API waits for the budget of its `QuotaLimiter` first.
+
+    vt-py has no option for the pool of its session, so `_get_session` is overridden after the
+    one of vt-py 0.17.5, which is pinned in `requirements.in`. `test_virustotal` fails if the
+    session of an upgraded vt-py is built differently.
+    """
+
+    def __init__(self, apikey: str, connections_limit: int, keepalive_timeout: int, limiter: QuotaLimiter, **kwargs):
+        """
+        Parameters:
+        -----------
+        - apikey: str
+            The VirusTotal API key.
+        - connections_limit: int
+            The maximum number of simultaneous connections to VirusTotal.
+        - keepalive_timeout: int
+            Seconds an idle connection is kept open to be reused.
+        - limiter: virus_total_telegram_bot.ratelimit.QuotaLimiter object
+            The limiter that keeps the calls within the quota of the API key.
+        """
+        super().__init__(apikey, **kwargs)
+        self._connections_limit = connections_limit
+        self._keepalive_timeout = keepalive_timeout
+        self.limiter = limiter
+
+    async def get_async(self, path, *path_args, params=None):
+        await self.limiter.acquire()
+        return await super().get_async(path, *path_args, params=params)
+
+    async def post_async(self, path, *path_args, data=None, json_data=None):
+        await self.limiter.acquire()
+        return await super().post_async(path, *path_args, data=data, json_data=json_data)
+
+    async def patch_async(self, path, *path_args, data=None, json_data=None):
+        await self.limiter.acquire()
+        return await super().patch_async(path, *path_args, data=data, json_data=json_data)
+
+    async def delete_async(self, path, *path_args):
+        await self.limiter.acquire()
+        return await super().delete_async(path, *path_args)
+
+    async def scan_url_async(self, url, wait_for_completion=False):
+        await self.limiter.acquire()
+        return await super().scan_url_async(url, wait_for_completion=wait_for_completion)
+
+    async def scan_file_async(self, file, wait_for_completion=False):
+        # the upload URL is requested through get_async, this one is for the upload itself
+        await self.limiter.acquire()
+        return await super().scan_file_async(file, wait_for_completion=wait_for_completion)
+
+    async def close_async(self):
+        await self.limiter.close()
+        await super().close_async()
+
+    def _get_session(self):
+        if not self._session:
+            headers = {
+                'X-Apikey': self._apikey,
+                'Accept-Encoding': 'gzip',
+                'User-Agent': _USER_AGENT_FMT.format_map({'agent': self._agent, 'version': vt_version})
+            }
+            if self._user_headers:
+                headers.update(self._user_headers)
+
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    ssl=self._verify_ssl,
+                    limit=self._connections_limit,
+                    keepalive_timeout=self._keepalive_timeout
+                ),
+                headers=headers,
+                trust_env=self._trust_env,
+                timeout=aiohttp.ClientTimeout(total=self._timeout)
+            )
+        return self._session
+
+
+class VirusTotalPool():
+    """
+    Spreads the calls to VirusTotal across several API keys.
+
+    There is one `VirusTotalClient`, with its own quota limiter, per key. Every call goes to the
+    key with the shortest queue and the largest remaining budget, so the throughput grows with the
+    number of keys. A key answering with a quota or an authentication error is ejected for a while
+    and the call is retried with the next key.
+    """
+
+    EJECTING_ERRORS = ("QuotaExceededError", "TooManyRequestsError", "WrongCredentialsError", "AuthenticationRequiredError")
+
+    def __init__(self, apikeys: list, connections_limit: int, keepalive_timeout: int,
+                 requests_per_minute: int, requests_per_day: int, ejection_time: int, host: str = None):
+        """
+        Parameters:
+        -----------
+        - apikeys: list
+            The VirusTotal API keys.
+        - connections_limit: int
+            The maximum number of simultaneous connections to VirusTotal per key.
+        - keepalive_timeout: int
+            Seconds an idle connection is kept open to be reused.
+        - requests_per_minute: int
+            The maximum number of calls per minute and key.
+        - requests_per_day: int
+            The maximum number of calls per day and key.
+        - ejection_time: int
+            Seconds a key is left out after a quota or an authentication error.
+        - host: str
+            The VirusTotal API host, if not the public one.
+        """
+        self.clients = [
+            VirusTotalClient(
+                apikey,
+                connections_limit=connections_limit,
+                keepalive_timeout=keepalive_timeout,
+                limiter=QuotaLimiter(per_minute=requests_per_minute, per_day=requests_per_day),
+                host=host
+            )
+            for apikey in apikeys
+        ]
+        self.ejection_time = ejection_time
+        self._ejected_until = [0.0] * len(self.clients)
+
+    async def get_object_async(self, path, *path_args, params=None):
+        """Like `vt.Client.get_object_async`, using the best available key"""
+        return await self._call('get_object_async', path, *path_args, params=params)
+
+    async def scan_url_async(self, url, wait_for_completion=False):
+        """Like `vt.Client.scan_url_async`, using the best available key"""
+        return await self._call('scan_url_async', url, wait_for_completion=wait_for_completion)
+
+    async def scan_file_async(self, file, wait_for_completion=False):
+        """Like `vt.Client.scan_file_async`, using the best available key"""
+        position = file.tell()
+        return await self._call(
+            'scan_file_async', file, wait_for_completion=wait_for_completion, before_retry=lambda: file.seek(position)
+        )
+
+    def counters(self):
+        """
+        Returns:
+        --------
+        - counters: dict
+            The calls waiting for budget and the remaining budget, added up for all the keys
+            in service, and the number of keys ejected.
+        """
+        now = time.monotonic()
+        in_service = [client for index, client in enumerate(self.clients) if self._ejected_until[index] <= now]
+        counters = {"queue_depth": 0, "remaining_per_minute": 0, "remaining_per_day": 0}
+        for client in self.clients:
+            counters["queue_depth"] += client.limiter.queue_depth()
+        for client in in_service:
+            client_counters = client.limiter.counters()
+            counters["remaining_per_minute"] += client_counters["remaining_per_minute"]
+            counters["remaining_per_day"] += client_counters["remaining_per_day"]
+        counters["keys"] = len(self.clients)
+        counters["ejected_keys"] = len(self.clients) - len(in_service)
+        return counters
+
+    async def close_async(self):
+        """Close the clients of every key"""
+        for client in self.clients:
+            await client.close_async()
+
+    def _pick(self, tried: set):
+        now = time.monotonic()
+        candidates = [index for index in range(len(self.clients)) if index not in tried]
+        in_service = [index for index in candidates if self._ejected_until[index] <= now]
+        if not in_service:
+            return min(candidates, key=lambda index: self._ejected_until[index])
+        return min(in_service, key=lambda index: (
+            self.clients[index].limiter.queue_depth(),
+            -self.clients[index].limiter.counters()["remaining_per_minute"]
+        ))
+
+    async def _call(self, method: str, *args, before_retry=None, **kwargs):
+        tried = set()
+        while True:
+            index = self._pick(tried)
+            VT_CALLS.inc(method=method)
+            try:
+                return await getattr(self.clients[index], method)(*args, **kwargs)
+            except vt.error.APIError as e:
+                VT_ERRORS.inc(method=method, code=e.code)
+                if e.code not in self.EJECTING_ERRORS:
+                    raise
+                self._ejected_until[index] = time.monotonic() + self.ejection_time
+                logger.warning("vt_key_ejected", key_index=index, error=e, ejection_time=self.ejection_time)
+                tried.add(index)
+                if len(tried) == len(self.clients):
+                    raise
+                if before_retry is not None:
+                    before_retry()
+            except Exception as e:
+                VT_ERRORS.inc(method=method, code=type(e).__name__)
+                raise
@@ -0,0 +1,336 @@
+"""
+Multi-process mode: one ingress process receives the updates and several worker processes handle them.
+
+The ingress process puts every update in a `WorkQueue` under the artifacts path and returns right
+away. Every worker process runs its own application, without an updater, that leases updates from
+the queue and handles them with the same handlers as the single-process mode, so hashing,
+rendering and logging are spread across the cores of the machine.
+
+The queue hands the updates of a chat to one worker at a time and in order. Updates whose worker
+dies or hangs are leased again to another worker once their lease expires.
+
+The results of the analyses waited for in the background are kept in the queue too, leased to the
+worker waiting for them until they are sent, so another worker resumes them if it stops first.
+"""
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+
+import structlog
+from telegram import Update
+from telegram.ext import Application, CallbackContext, ContextTypes, TypeHandler
+
+from virus_total_telegram_bot import app, config
+from virus_total_telegram_bot.artifacts import ArtifactStore
+from virus_total_telegram_bot.callbacks import resume_in_background
+from virus_total_telegram_bot.entities import Config
+from virus_total_telegram_bot.workqueue import WorkQueue
+
+
+logger = structlog.get_logger()
+
+
+def get_work_queue(cfg: Config):
+    """
+    Parameters:
+    -----------
+    - cfg: virus_total_telegram_bot.entities.Config
+        The Config instance for the service.
+
+    Returns:
+    --------
+    - queue: virus_total_telegram_bot.workqueue.WorkQueue object
+        The queue shared by the ingress and the worker processes.
+    """
+    return WorkQueue(
+        os.path.join(cfg.artifacts_path, "queue.sqlite3"),
+        visibility_timeout=cfg.queue_visibility_timeout,
+        max_attempts=cfg.queue_max_attempts
+    )
+
+
+async def enqueue_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Callback of the ingress process for every update: put it in the queue for the workers.
+
+    Parameters:
+    -----------
+    - update: telegram.Update object
+    - context: telegram.ext.ContextTypes.DEFAULT_TYPE object
+    """
+    key = f"chat:{update.effective_chat.id}" if update.effective_chat else f"update:{update.update_id}"
+    queue = context.bot_data['work_queue']
+    task_id = await queue.run(queue.put, key, update.to_dict())
+    logger.info("update_enqueued", update_id=update.update_id, task_id=task_id)
+
+
+def run_ingress(cfg: Config):
+    """
+    Entrypoint of the service in the multi-process mode: start `cfg.workers` worker processes and
+    receive the updates for them until the bot is stopped.
+
+    Parameters:
+    -----------
+    - cfg: virus_total_telegram_bot.entities.Config
+        The Config instance for the service.
+    """
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_worker, args=(cfg.dict(), index), name=f"worker-{index}")
+        for index in range(cfg.workers)
+    ]
+    for process in processes:
+        process.start()
+
+    async def stop_workers(application: Application):
+        await app.on_shutdown(application)
+        application.bot_data['work_queue'].close()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+    application = app.application_builder(cfg).post_shutdown(stop_workers).build()
+    application.bot_data['work_queue'] = get_work_queue(cfg)
+    application.bot_data['artifact_store'] = ArtifactStore(cfg.artifacts_path)
+    app.add_artifact_collector(application, cfg)
+    app.add_metrics(application, cfg)
+    application.add_handler(TypeHandler(Update, enqueue_update))
+    app.serve(application, cfg)
+
+
+def run_worker(cfg: dict, index: int):
+    """
+    Entrypoint of a worker process.
+
+    Parameters:
+    -----------
+    - cfg: dict
+        The Config instance for the service, as a dict.
+    - index: int
+        The number of the worker.
+    """
+    cfg = Config(**cfg)
+    config.initialize_loggers(cfg.logs_path)
+    asyncio.run(serve_worker(cfg, index))
+
+
+async def serve_worker(cfg: Config, index: int):
+    """
+    Handle the updates in the queue until the process is stopped.
+
+    Parameters:
+    -----------
+    - cfg: virus_total_telegram_bot.entities.Config
+        The Config instance for the service.
+    - index: int
+        The number of the worker.
+    """
+    application = app.application_builder(cfg, processes=cfg.workers, index=index).updater(None).build()
+    app.add_services(application, cfg, processes=cfg.workers, index=index)
+    app.add_handlers(application, cfg)
+    # the ingress process serves its metrics on the metrics port, and every worker on the next ones
+    app.add_metrics(application, cfg, port=cfg.metrics_port + 1 + index)
+    queue = get_work_queue(cfg)
+    name = f"{socket.gethostname()}-{os.getpid()}-{index}"
+    journal = application.bot_data['job_journal'] = JobJournal(queue, name)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(stop_signal, stop.set)
+
+    await application.initialize()
+    await app.on_startup(application)
+    await application.start()
+    try:
+        worker = Worker(application, queue, name, cfg.max_concurrent_updates, journal)
+        await worker.serve(stop)
+    finally:
+        # the results still waited for are left to the other workers
+        await journal.release_all()
+        await application.stop()
+        await app.on_shutdown(application)
+        await application.shutdown()
+        queue.close()
+
+
+class Worker():
+    """
+    Leases updates from the queue and has the application handle them.
+
+    The application hands the exceptions of its handlers to its error handlers instead of raising
+    them, so the worker registers one that records them, and fails the task of an update whose
+    handler raised to have it retried.
+    """
+
+    IDLE_WAIT = 0.05
+
+    def __init__(self, application: Application, queue: WorkQueue, name: str, max_tasks: int, journal: "JobJournal"):
+        """
+        Parameters:
+        -----------
+        - application: telegram.ext.Application object
+            The application whose handlers handle the updates.
+        - queue: virus_total_telegram_bot.workqueue.WorkQueue object
+        - name: str
+            The owner of the leases of this worker.
+        - max_tasks: int
+            The maximum number of updates handled at the same time.
+        - journal: JobJournal object
+            The journal of the results this worker waits for in the background.
+        """
+        self.application = application
+        self.queue = queue
+        self.name = name
+        self.max_tasks = max_tasks
+        self.journal = journal
+        self._leases = {}
+        self._errors = {}
+        application.add_error_handler(self._record_error)
+
+    async def serve(self, stop: asyncio.Event):
+        """
+        Lease and handle updates until `stop` is set, then wait for the updates being handled.
+
+        Parameters:
+        -----------
+        - stop: asyncio.Event
+        """
+        logger.info("worker_started", worker=self.name)
+        heartbeat = asyncio.create_task(self._heartbeat())
+        while not stop.is_set():
+            task = await self.queue.run(self.queue.lease, self.name) if len(self._leases) < self.max_tasks else None
+            if task is None:
+                try:
+                    await asyncio.wait_for(stop.wait(), self.IDLE_WAIT)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task_id, payload, attempt = task
+            handling = asyncio.create_task(self.handle(task_id, payload, attempt))
+            self._leases[handling] = task_id
+            handling.add_done_callback(self._leases.pop)
+            await asyncio.sleep(0)
+        if self._leases:
+            await asyncio.wait(list(self._leases))
+        heartbeat.cancel()
+        logger.info("worker_stopped", worker=self.name)
+
+    async def handle(self, task_id: int, payload: dict, attempt: int):
+        """
+        Handle a leased update and complete its task, or fail it to have it retried. Results left
+        by another worker are resumed in the background instead.
+
+        Parameters:
+        -----------
+        - task_id: int
+        - payload: dict
+            The update, as put by the ingress process, or the results, as put by `JobJournal.record`.
+        - attempt: int
+        """
+        if "update_id" not in payload:
+            logger.info("results_leased", worker=self.name, task_id=task_id, attempt=attempt)
+            self.journal.adopt(task_id)
+            self.application.create_task(
+                self.journal.serve(task_id, resume_in_background(CallbackContext(self.application), payload)))
+            return
+        update_id = payload.get("update_id")
+        self._errors[update_id] = None
+        try:
+            update = Update.de_json(payload, self.application.bot)
+            logger.info("update_leased", worker=self.name, task_id=task_id, update_id=update_id, attempt=attempt)
+            await self.application.process_update(update)
+            error = self._errors[update_id]
+        except Exception as e:  # pylint: disable=broad-except
+            error = e
+        finally:
+            del self._errors[update_id]
+        if error is not None:
+            await self.queue.run(self.queue.fail, task_id, self.name, repr(error))
+        else:
+            await self.queue.run(self.queue.complete, task_id, self.name)
+
+    async def _record_error(self, update: object, context: ContextTypes.DEFAULT_TYPE):
+        logger.error(
+            "update_failed", worker=self.name, update_id=getattr(update, "update_id", None), exc_info=context.error
+        )
+        if isinstance(update, Update) and update.update_id in self._errors:
+            self._errors[update.update_id] = context.error
+
+    async def _heartbeat(self):
+        # keep the leases of the updates taking longer than the visibility timeout
+        while True:
+            await asyncio.sleep(self.queue.visibility_timeout / 3)
+            for task_id in [*self._leases.values(), *self.journal.task_ids]:
+                if not await self.queue.run(self.queue.extend, task_id, self.name):
+                    logger.warning("lease_lost", worker=self.name, task_id=task_id)
+
+
+class JobJournal():
+    """
+    Keeps the results a worker waits for in the background in the work queue, leased to the worker
+    and extended by its heartbeat until they are sent. If the worker stops first, they are
+    released, or their lease expires, and another worker leases and resumes them.
+    """
+
+    def __init__(self, queue: WorkQueue, owner: str):
+        """
+        Parameters:
+        -----------
+        - queue: virus_total_telegram_bot.workqueue.WorkQueue object
+        - owner: str
+            The worker the results are leased to.
+        """
+        self.queue = queue
+        self.owner = owner
+        self.task_ids = set()
+
+    async def record(self, key: str, payload: dict):
+        """
+        Parameters:
+        -----------
+        - key: str
+            The key of the results, unique to their request.
+        - payload: dict
+            What is needed to resume waiting for the results, serializable to JSON.
+
+        Returns:
+        --------
+        - task_id: int
+            The task of the results, leased to this worker.
+        """
+        task_id = await self.queue.run(self.queue.put, key, payload, owner=self.owner)
+        self.task_ids.add(task_id)
+        return task_id
+
+    def adopt(self, task_id: int):
+        """Keep the lease of results recorded by another worker and leased by this one"""
+        self.task_ids.add(task_id)
+
+    async def serve(self, task_id: int, coroutine):
+        """
+        Send the results and complete their task, or fail it to have them sent again.
+
+        Parameters:
+        -----------
+        - task_id: int
+        - coroutine: coroutine
+            The sending of the results.
+        """
+        try:
+            await coroutine
+        except Exception as e:
+            await self.queue.run(self.queue.fail, task_id, self.owner, repr(e))
+            raise
+        else:
+            await self.queue.run(self.queue.complete, task_id, self.owner)
+        finally:
+            self.task_ids.discard(task_id)
+
+    async def release_all(self):
+        """Give the results still waited for back to the queue, for the other workers to resume them"""
+        for task_id in self.task_ids:
+            await self.queue.run(self.queue.release, task_id, self.owner)
+        self.task_ids.clear()
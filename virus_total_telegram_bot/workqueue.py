@@ -0,0 +1,215 @@
+"""
+Durable local queue shared by the processes of the bot.
+"""
+import asyncio
+import functools
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import structlog
+
+
+logger = structlog.get_logger()
+
+
+class TaskStatus():
+    """
+    Status of a task in the queue
+    """
+    READY = "ready"
+    LEASED = "leased"
+    FAILED = "failed"
+
+
+class WorkQueue():
+    """
+    Queue of tasks in a SQLite database, safe to share between processes.
+
+    A task is leased to one consumer at a time and stays invisible to the rest until the lease
+    expires. The consumer completes the task, fails it to have it retried, or extends the lease
+    while it is still working on it. A consumer that dies leaves its lease to expire, and the task
+    is leased again to another consumer. Completed tasks are removed, and tasks that failed
+    `max_attempts` times are kept as failed.
+
+    Tasks with the same key are leased one at a time and in the order they were put.
+
+    The processes wait for each other's locks on the database, so the event loop calls the methods
+    through `run`, which queries the database from the thread of the queue.
+    """
+
+    def __init__(self, db_path: str, visibility_timeout: int, max_attempts: int, retry_delay: float = 1.0):
+        """
+        Parameters:
+        -----------
+        - db_path: str
+            The path of the SQLite database file.
+        - visibility_timeout: int
+            Seconds a lease lasts unless it is extended.
+        - max_attempts: int
+            The maximum number of times a task is leased.
+        - retry_delay: float
+            Seconds a failed task waits before it is leased again, multiplied by its attempts.
+        """
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="work-queue")
+        self._db = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, payload TEXT NOT NULL, "
+            "status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, available_at REAL NOT NULL, "
+            "lease_owner TEXT, lease_expires_at REAL, error TEXT)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, id)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS tasks_key ON tasks (key, status, id)")
+
+    async def run(self, method, *args, **kwargs):
+        """
+        Call a method of the queue from the thread of the queue, without blocking the event loop.
+
+        Parameters:
+        -----------
+        - method: callable
+            The method of the queue, such as `lease`.
+        - args, kwargs
+            The arguments of the method.
+
+        Returns:
+        --------
+        - result
+            What the method returns.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(method, *args, **kwargs))
+
+    def put(self, key: str, payload: dict, owner: str = None):
+        """
+        Parameters:
+        -----------
+        - key: str
+            The key of the tasks handled in order, such as the chat of an update.
+        - payload: dict
+            The task, serializable to JSON.
+        - owner: str
+            The consumer the task is leased to right away, if it is already working on it.
+
+        Returns:
+        --------
+        - task_id: int
+        """
+        now = time.time()
+        if owner is None:
+            cursor = self._db.execute(
+                "INSERT INTO tasks (key, payload, status, available_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(payload), TaskStatus.READY, now)
+            )
+        else:
+            cursor = self._db.execute(
+                "INSERT INTO tasks (key, payload, status, attempts, available_at, lease_owner, lease_expires_at) "
+                "VALUES (?, ?, ?, 1, ?, ?, ?)",
+                (key, json.dumps(payload), TaskStatus.LEASED, now, owner, now + self.visibility_timeout)
+            )
+        return cursor.lastrowid
+
+    def lease(self, owner: str):
+        """
+        Lease the oldest task available.
+
+        Parameters:
+        -----------
+        - owner: str
+            The consumer leasing the task.
+
+        Returns:
+        --------
+        - task: tuple or None
+            The id, the payload and the attempt number of the task, or None if none is available.
+        """
+        now = time.time()
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            # expired leases count as failed attempts
+            self._db.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, lease_owner = NULL, "
+                "error = 'lease expired' WHERE status = ? AND lease_expires_at < ?",
+                (self.max_attempts, TaskStatus.FAILED, TaskStatus.READY, TaskStatus.LEASED, now)
+            )
+            row = self._db.execute(
+                "SELECT id, payload, attempts FROM tasks AS task WHERE status = ? AND available_at <= ? "
+                "AND NOT EXISTS (SELECT 1 FROM tasks AS previous WHERE previous.key = task.key "
+                "AND previous.status IN (?, ?) AND previous.id < task.id) "
+                "ORDER BY id LIMIT 1",
+                (TaskStatus.READY, now, TaskStatus.READY, TaskStatus.LEASED)
+            ).fetchone()
+            if row is None:
+                self._db.execute("COMMIT")
+                return None
+            task_id, payload, attempts = row
+            self._db.execute(
+                "UPDATE tasks SET status = ?, attempts = ?, lease_owner = ?, lease_expires_at = ? WHERE id = ?",
+                (TaskStatus.LEASED, attempts + 1, owner, now + self.visibility_timeout, task_id)
+            )
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        return task_id, json.loads(payload), attempts + 1
+
+    def extend(self, task_id: int, owner: str):
+        """
+        Extend the lease of a task still being worked on.
+
+        Returns:
+        --------
+        - extended: bool
+            False if the lease is no longer held by `owner`.
+        """
+        cursor = self._db.execute(
+            "UPDATE tasks SET lease_expires_at = ? WHERE id = ? AND status = ? AND lease_owner = ?",
+            (time.time() + self.visibility_timeout, task_id, TaskStatus.LEASED, owner)
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, task_id: int, owner: str):
+        """Remove a leased task once it is done"""
+        self._db.execute(
+            "DELETE FROM tasks WHERE id = ? AND status = ? AND lease_owner = ?", (task_id, TaskStatus.LEASED, owner)
+        )
+
+    def fail(self, task_id: int, owner: str, error: str):
+        """Release a leased task to be retried later, or mark it as failed after its last attempt"""
+        self._db.execute(
+            "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, lease_owner = NULL, "
+            "available_at = ? + attempts * ?, error = ? WHERE id = ? AND status = ? AND lease_owner = ?",
+            (self.max_attempts, TaskStatus.FAILED, TaskStatus.READY, time.time(), self.retry_delay, error,
+             task_id, TaskStatus.LEASED, owner)
+        )
+        logger.warning("task_failed", task_id=task_id, owner=owner, error=error)
+
+    def release(self, task_id: int, owner: str):
+        """Give a leased task back to be leased again right away, without counting the attempt"""
+        self._db.execute(
+            "UPDATE tasks SET status = ?, attempts = attempts - 1, lease_owner = NULL, available_at = ? "
+            "WHERE id = ? AND status = ? AND lease_owner = ?",
+            (TaskStatus.READY, time.time(), task_id, TaskStatus.LEASED, owner)
+        )
+
+    def counters(self):
+        """
+        Returns:
+        --------
+        - counters: dict
+            The number of tasks per status.
+        """
+        counters = {TaskStatus.READY: 0, TaskStatus.LEASED: 0, TaskStatus.FAILED: 0}
+        counters.update(self._db.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+        return counters
+
+    def close(self):
+        """Close the database, once the queries already running are done"""
+        self._executor.shutdown()
+        self._db.close()